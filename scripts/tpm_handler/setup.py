@@ -9,7 +9,7 @@ setuptools.setup(
     long_description="A small script to convert raw counts to TPM.",
     long_description_content_type="text/markdown",
     url="https://github.com/NoahHenrikKleinschmidt/scRNASeq2022",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=["tests"]),
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
@@ -21,5 +21,11 @@ setuptools.setup(
             "tpm_handler=tpm_handler.main:main",
         ]
     },
+    extras_require={
+        "columnar": [ "pyarrow" ],
+        "store": [ "h5py" ],
+        "zstd": [ "zstandard" ],
+        "gtftools": [ "gtftools" ],
+    },
     python_requires='>=3.6',
 )
\ No newline at end of file
@@ -0,0 +1,97 @@
+"""
+Shared fixtures: a small countTable (with a few genes that have no length), its lengths and a small GTF.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import tpm_handler as tpm
+
+
+@pytest.fixture
+def counts( tmp_path ) -> pd.DataFrame:
+    """
+    A countTable of 300 genes and 12 samples (saved as `counts.tsv`).
+    """
+    rng = np.random.default_rng( 42 )
+    values = rng.negative_binomial( 2, 0.05, size = ( 300, 12 ) )
+    values[ rng.random( values.shape ) < 0.3 ] = 0
+    df = pd.DataFrame(
+                        values,
+                        index = pd.Index( [ f"ENSG{i:06d}.{i % 3 + 1}" for i in range( 300 ) ], name = "gene_id" ),
+                        columns = [ f"S{i}" for i in range( 12 ) ],
+                    )
+    df.to_csv( tmp_path / "counts.tsv", sep = "\t" )
+    return df
+
+@pytest.fixture
+def lengths( tmp_path, counts ) -> str:
+    """
+    A lengths file for all but the last 20 genes of `counts` (saved as `counts.lengths`).
+    """
+    rng = np.random.default_rng( 7 )
+    ids = counts.index[ :-20 ]
+    df = pd.DataFrame( { "gene_name" : [ f"G{i}" for i in range( len( ids ) ) ], "merged" : rng.integers( 200, 5000, len( ids ) ) }, index = pd.Index( ids, name = "gene_id" ) )
+    df.to_csv( tmp_path / "counts.lengths", sep = "\t" )
+    return str( tmp_path / "counts.lengths" )
+
+@pytest.fixture
+def counts_file( tmp_path, counts ) -> str:
+    return str( tmp_path / "counts.tsv" )
+
+
+def gtf_entry( feature, start, end, gene, transcript = None, name = None ) -> str:
+    attributes = f'gene_id "{gene}";'
+    if transcript is not None:
+        attributes += f' transcript_id "{transcript}";'
+    if name is not None:
+        attributes += f' gene_name "{name}";'
+    return "\t".join( [ "chr1", "test", feature, str( start ), str( end ), ".", "+", ".", attributes ] )
+
+@pytest.fixture
+def gtf( tmp_path ) -> str:
+    """
+    A GTF of two genes. GeneA has two transcripts with overlapping exons:
+
+    - T1: 1-100 and 201-300 (200 bp)
+    - T2: 51-150 and 201-250 (150 bp)
+
+    so its merged exons are 1-150 and 201-300 (250 bp). GeneB has a single exon of 100 bp.
+    """
+    lines = [
+                "#!genome-build test",
+                gtf_entry( "gene", 1, 300, "GeneA.1", name = "A" ),
+                gtf_entry( "transcript", 1, 300, "GeneA.1", "T1", "A" ),
+                gtf_entry( "exon", 1, 100, "GeneA.1", "T1", "A" ),
+                gtf_entry( "exon", 201, 300, "GeneA.1", "T1", "A" ),
+                gtf_entry( "transcript", 51, 250, "GeneA.1", "T2", "A" ),
+                gtf_entry( "exon", 51, 150, "GeneA.1", "T2", "A" ),
+                gtf_entry( "exon", 201, 250, "GeneA.1", "T2", "A" ),
+                gtf_entry( "gene", 1000, 1099, "GeneB.2", name = "B" ),
+                gtf_entry( "transcript", 1000, 1099, "GeneB.2", "T3", "B" ),
+                gtf_entry( "exon", 1000, 1099, "GeneB.2", "T3", "B" ),
+            ]
+    filename = tmp_path / "test.gtf"
+    filename.write_text( "\n".join( lines ) + "\n" )
+    return str( filename )
+
+def reference( filename : str, lengths : str, method : str = "tpm", **kwargs ) -> pd.DataFrame:
+    """
+    Normalises a countTable in memory with `Table.normalise` (without rounding), which all other modes are compared to.
+    """
+    table = tpm.Table( filename, **kwargs )
+    table.set_lengths( lengths )
+    table.normalise( digits = None, method = method )
+    return table.get().copy()
+
+def read_output( filename : str ) -> pd.DataFrame:
+    return pd.read_csv( filename, sep = "\t", index_col = 0 )
+
+def assert_same( result : pd.DataFrame, expected : pd.DataFrame, digits : int = 5 ):
+    """
+    Checks that a (rounded) result matches the reference in its genes, samples and values.
+    """
+    assert list( result.index.astype( str ) ) == list( expected.index.astype( str ) )
+    assert list( result.columns.astype( str ) ) == list( expected.columns.astype( str ) )
+    np.testing.assert_allclose( np.asarray( result, dtype = float ), np.asarray( expected, dtype = float ), rtol = 0, atol = 10.0**-digits )
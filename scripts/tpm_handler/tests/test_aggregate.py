@@ -0,0 +1,60 @@
+"""
+Tests for aggregating the rows of duplicate gene names.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+import tpm_handler as tpm
+from tpm_handler.aggregate import aggregate_rows
+
+from .conftest import reference, read_output, assert_same
+
+
+@pytest.fixture
+def named_lengths( tmp_path, lengths ) -> str:
+    """
+    The fixture lengths where every three genes share a name.
+    """
+    df = pd.read_csv( lengths, sep = "\t", index_col = 0 )
+    df[ "gene_name" ] = [ f"G{i // 3}" for i in range( len( df ) ) ]
+    filename = str( tmp_path / "named.lengths" )
+    df.to_csv( filename, sep = "\t" )
+    return filename
+
+def _expected( counts_file : str, lengths : str, how : str ) -> pd.DataFrame:
+    values = reference( counts_file, lengths )
+    names = pd.read_csv( lengths, sep = "\t", index_col = 0 )[ "gene_name" ].reindex( values.index )
+    return values.groupby( names.to_numpy(), sort = False ).agg( how )
+
+@pytest.mark.parametrize( "how", [ "sum", "max", "mean" ] )
+def test_aggregate_rows( how ):
+    array = np.arange( 12, dtype = float ).reshape( 6, 2 )
+    names = [ "a", "b", "a", "c", "b", "a" ]
+    values, index = aggregate_rows( array, names, how )
+    expected = pd.DataFrame( array ).groupby( names, sort = False ).agg( how )
+    assert list( index ) == [ "a", "b", "c" ]
+    np.testing.assert_array_equal( values, expected.to_numpy() )
+
+    values, index = aggregate_rows( sparse.csr_matrix( array ), names, how )
+    np.testing.assert_array_equal( values.toarray(), expected.to_numpy() )
+
+@pytest.mark.parametrize( "how", [ "sum", "max", "mean" ] )
+def test_aggregate_in_memory( tmp_path, counts_file, named_lengths, how ):
+    table = tpm.Table( counts_file )
+    table.set_lengths( named_lengths )
+    table.normalise( digits = None )
+    outfile = str( tmp_path / "aggregated.tsv" )
+    table.save( outfile, use_names = True, digits = 5, aggregate = how )
+    assert_same( read_output( outfile ), _expected( counts_file, named_lengths, how ) )
+
+@pytest.mark.parametrize( "how", [ "sum", "max", "mean" ] )
+def test_aggregate_stream( tmp_path, counts_file, named_lengths, how ):
+    outfile = str( tmp_path / "aggregated.tsv" )
+    tpm.normalise_stream( counts_file, tpm.read_lengths( named_lengths ), outfile, digits = 5, chunksize = 64, use_names = True, aggregate = how )
+    # the aggregated rows of duplicated names are written after all other rows
+    result, expected = read_output( outfile ), _expected( counts_file, named_lengths, how )
+    assert sorted( result.index ) == sorted( expected.index )
+    assert_same( result.loc[ expected.index ], expected )
@@ -0,0 +1,49 @@
+"""
+Tests for the in-memory API (`Table.from_array`, `Table.from_frame`, `Table.to_array` and `Table.to_frame`).
+"""
+
+import numpy as np
+import pandas as pd
+
+import tpm_handler as tpm
+
+from .conftest import reference, assert_same
+
+
+def test_from_array_without_copy( counts ):
+    array = counts.to_numpy( dtype = float )
+    table = tpm.Table.from_array( array, counts.index, counts.columns )
+    values, index, columns = table.to_array()
+    assert np.shares_memory( values, array )
+    assert index.equals( counts.index ) and columns.equals( counts.columns )
+
+def test_lean_in_place( counts, counts_file, lengths ):
+    array = np.array( counts.to_numpy(), dtype = float, order = "F" )
+    table = tpm.Table.from_array( array, counts.index, counts.columns, lean = True )
+    table.set_lengths( lengths )
+    table.normalise( digits = None )
+
+    # the values are computed in the array that was passed in and handed on as they are
+    values, index, columns = table.to_array()
+    assert np.shares_memory( values, array )
+    frame = table.to_frame()
+    assert np.shares_memory( frame.to_numpy(), array )
+    assert_same( frame, reference( counts_file, lengths ), digits = 10 )
+
+def test_from_frame( counts, counts_file, lengths ):
+    expected = reference( counts_file, lengths )
+    for df in ( counts, counts.reset_index() ):
+        table = tpm.Table.from_frame( df )
+        table.set_lengths( lengths )
+        table.normalise( digits = None )
+        assert_same( table.to_frame(), expected, digits = 10 )
+
+def test_to_frame_names( counts, lengths ):
+    table = tpm.Table.from_frame( counts )
+    table.set_lengths( lengths )
+    table.normalise( digits = None )
+    names = pd.read_csv( lengths, sep = "\t", index_col = 0 )[ "gene_name" ]
+    frame = table.to_frame( use_names = True )
+    assert list( frame.index ) == list( names.reindex( table.get().index ) )
+    # the table itself keeps its IDs
+    assert table.get().index.equals( table.to_frame().index )
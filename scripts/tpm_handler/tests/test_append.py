@@ -0,0 +1,74 @@
+"""
+Tests for appending new samples to an existing table.
+"""
+
+import sys
+
+import pytest
+
+import tpm_handler as tpm
+from tpm_handler.main import main
+
+from .conftest import reference, read_output, assert_same
+
+
+@pytest.fixture
+def parts( tmp_path, counts, lengths ) -> tuple:
+    """
+    The first seven samples normalised as an existing table, and a file with the other samples.
+    """
+    first, second = str( tmp_path / "first.tsv" ), str( tmp_path / "second.tsv" )
+    counts.iloc[ :,:7 ].to_csv( first, sep = "\t" )
+    counts.iloc[ :,7: ].to_csv( second, sep = "\t" )
+
+    existing = str( tmp_path / "existing.tpm" )
+    table = tpm.Table( first )
+    table.set_lengths( lengths )
+    table.normalise( digits = 5 )
+    table.save( existing, digits = 5 )
+    return existing, second
+
+def _new_samples( filename : str, lengths : str, reverse : bool = False ):
+    table = tpm.Table( filename )
+    table.set_lengths( lengths )
+    values, ids = table.compute( "tpm" ), table.ids
+    if reverse:
+        values, ids = values[ ::-1 ], ids[ ::-1 ]
+    return values, ids, table.get().columns
+
+@pytest.mark.parametrize( "reorder", [ False, True ] )
+def test_append( counts_file, lengths, parts, reorder ):
+    existing, second = parts
+    values, ids, columns = _new_samples( second, lengths, reverse = reorder )
+    tpm.append_samples( existing, values, ids, columns, digits = 5, reorder = reorder )
+    assert_same( read_output( existing ), reference( counts_file, lengths ) )
+
+def test_append_rejects_reordered_genes( lengths, parts ):
+    existing, second = parts
+    before = open( existing ).read()
+    with pytest.raises( ValueError, match = "same order" ):
+        tpm.append_samples( existing, *_new_samples( second, lengths, reverse = True ) )
+    assert open( existing ).read() == before
+
+def test_append_rejects_duplicate_genes( lengths, parts ):
+    existing, second = parts
+    lines = open( existing ).read().splitlines()
+    open( existing, "w" ).write( "\n".join( lines + lines[ 1:2 ] ) + "\n" )
+    with pytest.raises( ValueError, match = "multiple times" ):
+        tpm.append_samples( existing, *_new_samples( second, lengths ), reorder = True )
+
+def test_append_rejects_existing_samples( lengths, parts ):
+    existing, _ = parts
+    first = existing.replace( "existing.tpm", "first.tsv" )
+    with pytest.raises( ValueError, match = "already part" ):
+        tpm.append_samples( existing, *_new_samples( first, lengths ) )
+
+@pytest.mark.parametrize( "flag", [ [ "--sidecar" ], [ "--max-bytes", "1M" ], [ "--aggregate", "sum" ] ] )
+def test_append_rejects_unsupported_flags( lengths, parts, monkeypatch, flag ):
+    existing, second = parts
+    before = open( existing ).read()
+    monkeypatch.setattr( sys, "argv", [ "tpm_handler", "normalise", second, "-l", lengths, "--append-to", existing ] + flag )
+    with pytest.raises( SystemExit ) as error:
+        main()
+    assert error.value.code != 0
+    assert open( existing ).read() == before
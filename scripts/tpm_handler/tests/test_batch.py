@@ -0,0 +1,39 @@
+"""
+Tests for the batch normalisation of many countTables.
+"""
+
+import os
+
+import pytest
+
+import tpm_handler as tpm
+
+from .conftest import reference, read_output, assert_same
+
+
+@pytest.fixture
+def batch( tmp_path, counts ) -> list:
+    """
+    The fixture countTable split into three tables of four samples each.
+    """
+    files = []
+    for i in range( 3 ):
+        filename = str( tmp_path / f"part{i}.tsv" )
+        counts.iloc[ :,4 * i:4 * i + 4 ].to_csv( filename, sep = "\t" )
+        files.append( filename )
+    return files
+
+@pytest.mark.parametrize( "workers", [ 1, 2 ] )
+def test_batch( tmp_path, batch, lengths, workers ):
+    outdir = str( tmp_path / "out" )
+    reports = tpm.normalise_batch( [ str( tmp_path / "part*.tsv" ) ], tpm.read_lengths( lengths ), outdir = outdir, workers = workers )
+    assert sorted( i[ "file" ] for i in reports ) == batch
+    for infile in batch:
+        outfile = os.path.join( outdir, os.path.basename( infile ) + ".tpm" )
+        assert_same( read_output( outfile ), reference( infile, lengths ) )
+
+def test_batch_next_to_inputs( batch, lengths ):
+    reports = tpm.normalise_batch( batch[ :1 ], tpm.read_lengths( lengths ), suffix = ".out", lean = True )
+    assert reports[0][ "output" ] == batch[0] + ".out"
+    assert reports[0][ "rows" ] == 280 and reports[0][ "samples" ] == 4
+    assert_same( read_output( batch[0] + ".out" ), reference( batch[0], lengths ) )
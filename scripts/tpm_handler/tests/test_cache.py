@@ -0,0 +1,64 @@
+"""
+Tests for the cache of parsed countTables.
+"""
+
+import os
+
+import numpy as np
+
+import tpm_handler as tpm
+from tpm_handler.cache import CountCache
+
+from .conftest import reference, assert_same
+
+
+def _fail( *args, **kwargs ):
+    raise AssertionError( "The countTable was parsed again instead of being loaded from the cache." )
+
+def test_cache_hit( tmp_path, counts, counts_file, lengths, monkeypatch ):
+    directory = str( tmp_path / "cache" )
+    first = reference( counts_file, lengths, cache = directory )
+    assert CountCache( directory ).load( counts_file, index_col = 0 ) is not None
+
+    # the second read must come from the cache, not from the file
+    monkeypatch.setattr( tpm.Table, "_read_owned", _fail )
+    second = reference( counts_file, lengths, cache = directory )
+    assert_same( second, first, digits = 10 )
+
+def test_cache_invalidated( tmp_path, counts, counts_file ):
+    cache = CountCache( str( tmp_path / "cache" ) )
+    cache.store( counts_file, counts.astype( float ) )
+    assert np.array_equal( cache.load( counts_file ).to_numpy(), counts.to_numpy() )
+
+    # a changed source file is a different entry
+    counts.iloc[ :5 ].to_csv( counts_file, sep = "\t" )
+    os.utime( counts_file, ns = ( 1, 1 ) )
+    assert cache.load( counts_file ) is None
+
+def test_eviction( tmp_path, counts ):
+    cache = CountCache( str( tmp_path / "cache" ) )
+    files = []
+    for i in range( 3 ):
+        filename = str( tmp_path / f"counts{i}.tsv" )
+        counts.to_csv( filename, sep = "\t" )
+        files.append( filename )
+        cache.store( filename, counts.astype( float ) )
+        os.utime( cache._path( cache.key( filename ) ) + ".json", ( i + 1, i + 1 ) )
+    size = max( size for _, _, size in cache.entries() )
+
+    # only the most recently used entries fit
+    cache.max_bytes = 2 * size
+    cache.evict()
+    assert [ cache.load( i ) is not None for i in files ] == [ False, True, True ]
+
+def test_interrupted_store_is_evicted( tmp_path, counts, counts_file ):
+    cache = CountCache( str( tmp_path / "cache" ) )
+    orphan = tmp_path / "cache" / "0123abcd.npy"
+    orphan.write_bytes( b"\0" * 1000 )
+    os.utime( orphan, ( 1, 1 ) )
+    assert "0123abcd" in [ key for key, _, _ in cache.entries() ]
+
+    cache.max_bytes = 1
+    cache.store( counts_file, counts.astype( float ) )
+    assert not orphan.exists()
+    assert cache.load( counts_file ) is not None
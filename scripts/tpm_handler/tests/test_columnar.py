@@ -0,0 +1,51 @@
+"""
+Tests for Parquet and Feather input and output.
+"""
+
+import numpy as np
+import pytest
+
+import tpm_handler as tpm
+
+from .conftest import reference, assert_same
+
+pytest.importorskip( "pyarrow" )
+
+
+@pytest.mark.parametrize( "suffix", [ ".parquet", ".feather" ] )
+def test_columnar_roundtrip( tmp_path, counts, suffix ):
+    filename = str( tmp_path / f"counts{suffix}" )
+    tpm.write_columnar( filename, counts.to_numpy(), counts.index, counts.columns, index_name = "gene_id", dtype = np.int32 )
+    result = tpm.read_columnar( filename )
+    assert result.index.name == "gene_id"
+    assert list( result.index ) == list( counts.index ) and list( result.columns ) == list( counts.columns )
+    np.testing.assert_array_equal( result.to_numpy(), counts.to_numpy() )
+    assert result.to_numpy().flags.f_contiguous
+
+def test_columnar_projection( tmp_path, counts ):
+    filename = str( tmp_path / "counts.parquet" )
+    tpm.write_columnar( filename, counts.to_numpy(), counts.index, counts.columns, dtype = np.int32 )
+    result = tpm.read_columnar( filename, samples = [ "S5", "S2" ], dtype = np.float64 )
+    assert list( result.columns ) == [ "S5", "S2" ]
+    assert result.to_numpy().dtype == np.float64
+    np.testing.assert_array_equal( result.to_numpy(), counts[ [ "S5", "S2" ] ].to_numpy() )
+    with pytest.raises( KeyError ):
+        tpm.read_columnar( filename, samples = [ "S99" ] )
+
+@pytest.mark.parametrize( "suffix", [ ".parquet", ".feather" ] )
+def test_columnar_table( tmp_path, counts, counts_file, lengths, suffix ):
+    # normalising a columnar input and saving a columnar output gives the values of the text table
+    infile = str( tmp_path / f"counts{suffix}" )
+    tpm.write_columnar( infile, counts.to_numpy(), counts.index, counts.columns, index_name = "gene_id", dtype = np.int32 )
+    expected = reference( counts_file, lengths )
+    assert_same( reference( infile, lengths ), expected, digits = 10 )
+
+    table = tpm.Table( infile )
+    table.set_lengths( lengths )
+    table.normalise( digits = None )
+    outfile = str( tmp_path / f"counts.tpm{suffix}" )
+    table.save( outfile, digits = 3, columnar_compression = "lz4" )
+    # the values are stored as float32
+    result = tpm.read_columnar( outfile )
+    assert list( result.index ) == list( expected.index ) and list( result.columns ) == list( expected.columns )
+    np.testing.assert_allclose( result.to_numpy(), np.round( expected.to_numpy(), 3 ), rtol = 1e-6 )
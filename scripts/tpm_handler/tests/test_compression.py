@@ -0,0 +1,22 @@
+"""
+Tests for reading and writing compressed tables.
+"""
+
+import pytest
+
+import tpm_handler as tpm
+
+from .conftest import reference, read_output, assert_same
+
+
+@pytest.mark.parametrize( "suffix", [ ".gz", ".zst" ] )
+def test_stream_compressed( tmp_path, counts, lengths, suffix ):
+    infile = str( tmp_path / f"counts.tsv{suffix}" )
+    with tpm.compression.open_file( infile, "w" ) as f:
+        counts.to_csv( f, sep = "\t" )
+    outfile = str( tmp_path / f"stream.tsv{suffix}" )
+    tpm.normalise_stream( infile, tpm.read_lengths( lengths ), outfile, digits = 5, chunksize = 64 )
+
+    with tpm.compression.open_file( outfile ) as f:
+        result = read_output( f )
+    assert_same( result, reference( str( tmp_path / "counts.tsv" ), lengths ) )
@@ -0,0 +1,49 @@
+"""
+Tests for the vectorised TPM kernel (`array_to_tpm`) and rounding.
+"""
+
+import numpy as np
+from scipy import sparse
+
+import tpm_handler as tpm
+
+
+def _naive_tpm( array : np.ndarray, lengths : np.ndarray ) -> np.ndarray:
+    # the column-by-column definition that the kernel replaces
+    result = np.empty( array.shape )
+    for i in range( array.shape[1] ):
+        rate = array[ :,i ] / lengths
+        result[ :,i ] = rate / rate.sum() * 10**6
+    return result
+
+def test_array_to_tpm( counts ):
+    array = counts.to_numpy( dtype = float )
+    lengths = np.random.default_rng( 1 ).integers( 200, 5000, len( array ) ).astype( float )
+    expected = _naive_tpm( array, lengths )
+
+    np.testing.assert_allclose( tpm.array_to_tpm( array, lengths ), expected, rtol = 1e-12 )
+    np.testing.assert_allclose( tpm.array_to_tpm( array, lengths ).sum( axis = 0 ), 10**6 )
+
+    # in place
+    out = array.copy()
+    assert tpm.array_to_tpm( out, lengths, out = out ) is out
+    np.testing.assert_allclose( out, expected, rtol = 1e-12 )
+
+def test_array_to_tpm_with_factors( counts ):
+    # converting chunks of rows with the factors of the whole matrix gives the same values
+    array = counts.to_numpy( dtype = float )
+    lengths = np.random.default_rng( 1 ).integers( 200, 5000, len( array ) ).astype( float )
+    factors = ( array / lengths[ :,None ] ).sum( axis = 0 )
+    chunks = [ tpm.array_to_tpm( array[ i:i + 64 ], lengths[ i:i + 64 ], factors ) for i in range( 0, len( array ), 64 ) ]
+    np.testing.assert_allclose( np.vstack( chunks ), _naive_tpm( array, lengths ), rtol = 1e-12 )
+
+def test_round_tpm():
+    values = np.array( [ [ 1.234567, 2.0 ], [ 0.000004, 3.3333333 ] ] )
+    rounded = tpm.round_tpm( values, 2 )
+    assert rounded is values
+    np.testing.assert_array_equal( values, [ [ 1.23, 2.0 ], [ 0.0, 3.33 ] ] )
+
+    matrix = sparse.csc_matrix( [ [ 1.234567, 0.0 ], [ 0.000004, 3.3333333 ] ] )
+    rounded = tpm.round_tpm( matrix, 2 )
+    np.testing.assert_array_equal( rounded.toarray(), [ [ 1.23, 0.0 ], [ 0.0, 3.33 ] ] )
+    assert rounded.nnz == 2
@@ -0,0 +1,33 @@
+"""
+Tests for filtering genes and samples while reading a countTable.
+"""
+
+import pytest
+
+import tpm_handler as tpm
+
+from .conftest import reference, read_output, assert_same
+
+
+@pytest.mark.parametrize( "stream", [ False, True ] )
+def test_filters( tmp_path, counts, lengths, stream ):
+    allowlist = list( counts.index[ ::2 ].str.split( "." ).str[0] )
+    gene_filters = tpm.Filters( min_gene_total = 400, min_detected = 100, allowlist = allowlist )
+
+    # the reference is normalised from a table that was filtered beforehand
+    kept = counts.iloc[ ::2 ]
+    kept = kept.loc[ :,( kept != 0 ).sum() >= 100 ]
+    kept = kept[ kept.sum( axis = 1 ) >= 400 ]
+    assert 0 < len( kept ) < len( counts ) // 2
+    prefiltered = str( tmp_path / "prefiltered.tsv" )
+    kept.to_csv( prefiltered, sep = "\t" )
+    expected = reference( prefiltered, lengths )
+
+    infile = str( tmp_path / "counts.tsv" )
+    if stream:
+        outfile = str( tmp_path / "filtered.tsv" )
+        tpm.normalise_stream( infile, tpm.read_lengths( lengths ), outfile, digits = 5, chunksize = 64, filters = gene_filters )
+        result = read_output( outfile )
+    else:
+        result = reference( infile, lengths, filters = gene_filters )
+    assert_same( result, expected )
@@ -0,0 +1,63 @@
+"""
+Tests for reading GTF files and computing gene lengths natively.
+"""
+
+import pandas as pd
+import pytest
+
+import tpm_handler as tpm
+
+from .conftest import gtf_entry as _entry
+
+
+def test_compute_lengths( gtf ):
+    lengths = tpm.compute_lengths( gtf, modes = [ "mean", "longest_isoform", "merged" ] )
+    assert list( lengths.index ) == [ "GeneA.1", "GeneB.2" ]
+    assert lengths.loc[ "GeneA.1" ].to_dict() == { "mean" : 175, "longest_isoform" : 200, "merged" : 250 }
+    assert lengths.loc[ "GeneB.2" ].to_dict() == { "mean" : 100, "longest_isoform" : 100, "merged" : 100 }
+
+def test_compute_lengths_with_names( tmp_path, gtf ):
+    outfile = str( tmp_path / "test.lengths" )
+    tpm.compute_lengths( gtf, outfile, modes = [ "merged" ], add_names = True )
+    lengths = pd.read_csv( outfile, sep = "\t", index_col = 0 )
+    assert list( lengths.columns ) == [ "gene_name", "merged" ]
+    assert list( lengths[ "gene_name" ] ) == [ "A", "B" ]
+
+def test_unknown_mode( gtf ):
+    with pytest.raises( ValueError ):
+        tpm.compute_lengths( gtf, modes = [ "shortest" ] )
+
+def test_read_gtf_attributes( tmp_path ):
+    # the attributes are extracted irrespective of their order, missing ones are NaN
+    lines = [
+                "\t".join( [ "chr1", "test", "gene", "1", "10", ".", "+", ".", 'gene_name "A"; gene_id "GeneA.1"; gene_type "x";' ] ),
+                "\t".join( [ "chr1", "test", "gene", "20", "30", ".", "+", ".", 'gene_id "GeneB.2";' ] ),
+                _entry( "exon", 1, 10, "GeneA.1", "T1", "A" ),
+            ]
+    filename = tmp_path / "attributes.gtf"
+    filename.write_text( "\n".join( lines ) + "\n" )
+    genes = tpm.read_gtf( str( filename ), columns = [ "start" ] )
+    assert list( genes[ "gene_id" ] ) == [ "GeneA.1", "GeneB.2" ]
+    assert genes[ "gene_name" ].iloc[0] == "A" and pd.isna( genes[ "gene_name" ].iloc[1] )
+    assert list( genes[ "start" ] ) == [ 1, 20 ]
+
+@pytest.mark.parametrize( "gene_entries", [ True, False ] )
+def test_add_gtf_gene_names( tmp_path, gtf, gene_entries ):
+    if not gene_entries:
+        # e.g. StringTie output has no gene entries
+        lines = [ i for i in open( gtf ).read().splitlines() if "\tgene\t" not in i ]
+        open( gtf, "w" ).write( "\n".join( lines ) + "\n" )
+
+    outfile = str( tmp_path / "test.lengths" )
+    tpm.compute_lengths( gtf, outfile, modes = [ "merged" ] )
+    tpm.add_gtf_gene_names( gtf, outfile )
+    lengths = pd.read_csv( outfile, sep = "\t" )
+    assert list( lengths.columns ) == [ "gene", "gene_name", "merged" ]
+    assert list( lengths[ "gene_name" ] ) == [ "A", "B" ]
+    assert list( lengths[ "merged" ] ) == [ 250, 100 ]
+
+def test_add_gtf_gene_names_without_matches( tmp_path, gtf ):
+    outfile = tmp_path / "other.lengths"
+    outfile.write_text( "gene\tmerged\nGeneC.1\t100\n" )
+    with pytest.raises( ValueError ):
+        tpm.add_gtf_gene_names( gtf, str( outfile ) )
@@ -0,0 +1,36 @@
+"""
+Tests for the lean (copy-free) memory mode of Table.
+"""
+
+import numpy as np
+import pytest
+
+import tpm_handler as tpm
+
+from .conftest import reference, assert_same
+
+
+@pytest.mark.parametrize( "dtype", [ np.float64, np.float32 ] )
+def test_lean( counts_file, lengths, dtype ):
+    expected = reference( counts_file, lengths )
+    result = reference( counts_file, lengths, lean = True, dtype = dtype )
+    assert_same( result, expected, digits = 5 if dtype == np.float64 else 1 )
+
+def test_lean_converts_in_place( counts_file, lengths ):
+    table = tpm.Table( counts_file, lean = True )
+    array = table._array
+    assert array.flags.writeable and array.flags.f_contiguous
+    assert np.shares_memory( array, table.get().to_numpy() )
+
+    table.set_lengths( lengths )
+    table.normalise( digits = 5 )
+    # the values replace the counts in the reader's own array
+    assert np.shares_memory( table.tpm, array )
+    assert_same( table.get(), reference( counts_file, lengths ) )
+
+def test_read_array( counts, counts_file ):
+    array, index, columns = tpm.reader.read_array( counts_file )
+    assert array.flags.writeable and array.flags.f_contiguous
+    assert list( index ) == list( counts.index ) and index.name == "gene_id"
+    assert list( columns ) == list( counts.columns )
+    np.testing.assert_array_equal( array, counts.to_numpy() )
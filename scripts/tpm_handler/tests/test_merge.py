@@ -0,0 +1,52 @@
+"""
+Tests for merging per-sample count files.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import tpm_handler as tpm
+
+from .conftest import reference, assert_same
+
+
+def _write_samples( tmp_path, counts ) -> list:
+    files = []
+    for sample in counts.columns:
+        filename = str( tmp_path / f"{sample}.counts.txt" )
+        counts[ sample ].to_csv( filename, sep = "\t", header = False )
+        files.append( filename )
+    return files
+
+def test_merge( tmp_path, counts, lengths ):
+    merged = str( tmp_path / "merged.tsv" )
+    tpm.merge_counts( _write_samples( tmp_path, counts ), merged, workers = 2 )
+    result = reference( merged, lengths )
+    assert_same( result, reference( str( tmp_path / "counts.tsv" ), lengths ), digits = 10 )
+
+def test_merge_unordered( tmp_path, counts ):
+    files = _write_samples( tmp_path, counts.iloc[ ::-1 ] )
+    merged = tpm.merge_counts( files, workers = 2 )
+    assert merged.dtypes.unique().tolist() == [ np.int32 ]
+    assert_same( merged.loc[ counts.index ], counts, digits = 10 )
+
+def test_merge_fractional_counts( tmp_path, counts ):
+    fractional = counts.iloc[ :,:3 ] + 0.25
+    files = _write_samples( tmp_path, counts.iloc[ :,3: ] ) + _write_samples( tmp_path, fractional )
+    merged = str( tmp_path / "merged.tsv" )
+    result = tpm.merge_counts( files, merged )
+    assert result.dtypes.unique().tolist() == [ np.float64 ]
+
+    expected = pd.concat( [ counts.iloc[ :,3: ], fractional ], axis = 1 )
+    assert_same( result, expected, digits = 10 )
+    assert_same( pd.read_csv( merged, sep = "\t", index_col = 0 ), expected, digits = 10 )
+
+    with pytest.raises( ValueError, match = "fractional" ):
+        tpm.read_counts( files[-1], dtype = np.int32 )
+
+def test_merge_duplicate_genes( tmp_path, counts ):
+    filename = str( tmp_path / "S0.counts.txt" )
+    counts[ "S0" ].iloc[ [ 0, 1, 1 ] ].to_csv( filename, sep = "\t", header = False )
+    with pytest.raises( ValueError, match = "S0.counts.txt lists 1 gene IDs more than once" ):
+        tpm.merge_counts( [ filename ] )
@@ -0,0 +1,35 @@
+"""
+Tests for the multi-process (column-sharded) normalisation.
+"""
+
+import numpy as np
+import pytest
+
+import tpm_handler as tpm
+from tpm_handler.parallel import parallel_normalise, _shards
+
+from .conftest import reference, assert_same
+
+
+@pytest.mark.parametrize( "lean", [ False, True ] )
+def test_parallel( counts_file, lengths, lean ):
+    expected = reference( counts_file, lengths )
+    table = tpm.Table( counts_file, lean = lean )
+    table.set_lengths( lengths )
+    table.normalise( digits = None, workers = 2 )
+    assert_same( table.get(), expected, digits = 10 )
+
+def test_parallel_factors_and_out( counts ):
+    array = np.asfortranarray( counts.to_numpy( dtype = float ) )
+    lengths = np.random.default_rng( 1 ).integers( 200, 5000, len( array ) ).astype( float )
+    expected = tpm.array_to_tpm( array, lengths )
+
+    out = array.copy( order = "F" )
+    values, factors = parallel_normalise( array, lengths, workers = 3, out = out, return_factors = True )
+    assert values is out
+    np.testing.assert_allclose( values, expected )
+    np.testing.assert_allclose( factors, ( array / lengths[ :,None ] ).sum( axis = 0 ) )
+
+def test_shards():
+    assert _shards( 10, 3 ) == [ ( 0, 3 ), ( 3, 6 ), ( 6, 10 ) ]
+    assert _shards( 2, 8 ) == [ ( 0, 1 ), ( 1, 2 ) ]
@@ -0,0 +1,51 @@
+"""
+Tests for the memory planner.
+"""
+
+import sys
+
+import pandas as pd
+import pytest
+
+import tpm_handler as tpm
+from tpm_handler import planner
+from tpm_handler.main import main
+
+
+def test_estimate_rows( counts, counts_file ):
+    rows, samples, exact = planner.estimate_rows( counts_file )
+    assert list( samples ) == list( counts.columns )
+    assert rows == len( counts ) or not exact
+
+def test_plan_without_budget( counts_file ):
+    # without workers the parallel mode is never considered
+    plan = tpm.Plan( counts_file )
+    assert "parallel" not in plan.estimates and plan.mode == "in-memory"
+    assert tpm.Plan( counts_file, workers = 2 ).mode == "parallel"
+
+@pytest.mark.parametrize( "mode", [ "parallel", "in-memory", "lean" ] )
+def test_plan_budget( counts_file, mode ):
+    estimates = tpm.Plan( counts_file, workers = 4 ).estimates
+    assert estimates[ "parallel" ] > estimates[ "in-memory" ] > estimates[ "lean" ]
+    # the fastest mode that fits is selected
+    plan = tpm.Plan( counts_file, workers = 4, budget = estimates[ mode ] )
+    assert plan.mode == mode and plan.peak <= plan.budget
+
+def test_plan_stream( tmp_path, counts ):
+    # a table that is too large for any in-memory mode is streamed in smaller chunks
+    filename = str( tmp_path / "large.tsv" )
+    pd.concat( [ counts ] * 100 ).to_csv( filename, sep = "\t" )
+    plan = tpm.Plan( filename, chunksize = 10000 )
+    budget = plan.estimates[ "lean" ] - 1
+    plan = tpm.Plan( filename, chunksize = 10000, budget = budget )
+    assert plan.mode == "stream" and 100 <= plan.chunksize < 10000
+    assert plan.peak <= budget
+    assert tpm.Plan( filename, budget = 1024 ).mode is None
+
+def test_plan_cli_keeps_workers( counts_file, capsys, monkeypatch ):
+    monkeypatch.setattr( sys, "argv", [ "tpm_handler", "normalise", counts_file, "--plan" ] )
+    main()
+    assert "parallel" not in capsys.readouterr().out
+    monkeypatch.setattr( sys, "argv", [ "tpm_handler", "normalise", counts_file, "--plan", "-w", "3" ] )
+    main()
+    assert "3 workers" in capsys.readouterr().out
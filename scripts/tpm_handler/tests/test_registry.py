@@ -0,0 +1,59 @@
+"""
+Tests for the content-addressed gene-lengths registry.
+"""
+
+import shutil
+
+import pytest
+
+import tpm_handler as tpm
+from tpm_handler import registry
+
+
+@pytest.fixture
+def computed( monkeypatch ) -> list:
+    """
+    Records the GTF files whose lengths are computed (instead of being taken from the registry).
+    """
+    calls = []
+    compute = registry.compute_lengths
+    def record( filename, *args, **kwargs ):
+        calls.append( filename )
+        return compute( filename, *args, **kwargs )
+    monkeypatch.setattr( registry, "compute_lengths", record )
+    return calls
+
+def test_registry_reuse( tmp_path, gtf, computed ):
+    lengths = tpm.LengthsRegistry( str( tmp_path / "registry" ) )
+    first = lengths.lengths( gtf, modes = [ "merged", "mean" ] )
+    assert computed == [ gtf ]
+    expected = tpm.compute_lengths( gtf, modes = [ "merged", "mean" ], add_names = True )
+    assert first.equals( expected.loc[ :,[ "gene_name", "merged", "mean" ] ] )
+
+    # the same content under another name (and in a new process) is found in the registry
+    copy = str( tmp_path / "copy.gtf" )
+    shutil.copy( gtf, copy )
+    second = tpm.LengthsRegistry( str( tmp_path / "registry" ) ).lengths( copy, modes = [ "merged", "mean" ] )
+    assert computed == [ gtf ]
+    assert second.equals( first )
+
+    # only modes that are not registered yet are computed
+    lengths.lengths( gtf, modes = [ "merged", "longest_isoform" ] )
+    assert computed == [ gtf, gtf ]
+
+def test_registry_changed_content( tmp_path, gtf, computed ):
+    lengths = tpm.LengthsRegistry( str( tmp_path / "registry" ) )
+    lengths.lengths( gtf, modes = [ "merged" ] )
+    with open( gtf, "a" ) as f:
+        f.write( "chr1\ttest\texon\t5000\t5049\t.\t+\t.\tgene_id \"GeneC.1\"; transcript_id \"T4\";\n" )
+    result = lengths.lengths( gtf, modes = [ "merged" ] )
+    assert computed == [ gtf, gtf ]
+    assert result.loc[ "GeneC.1", "merged" ] == 50
+
+def test_gtf_lengths( tmp_path, gtf, computed ):
+    lengths = tpm.LengthsRegistry( str( tmp_path / "registry" ) )
+    first = registry.gtf_lengths( gtf, "merged", registry = lengths )
+    second = registry.gtf_lengths( gtf, "merged", registry = lengths )
+    assert computed == [ gtf ]
+    assert first.equals( second )
+    assert list( first.iloc[ :,-1 ] ) == [ 250, 100 ]
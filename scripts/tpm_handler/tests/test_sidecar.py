@@ -0,0 +1,44 @@
+"""
+Tests for the scaling-factor sidecar and re-exporting without recomputing.
+"""
+
+import numpy as np
+import pytest
+
+import tpm_handler as tpm
+
+from .conftest import read_output, assert_same
+
+
+@pytest.fixture
+def normalised( tmp_path, counts_file, lengths ):
+    """
+    The normalised fixture table saved (at full precision) with a sidecar.
+    """
+    table = tpm.Table( counts_file )
+    table.set_lengths( lengths )
+    table.normalise( digits = None )
+    outfile = str( tmp_path / "counts.tpm" )
+    table.save( outfile, digits = None, sidecar = True )
+    return table, outfile
+
+def test_sidecar_factors( counts, normalised ):
+    table, outfile = normalised
+    sidecar = tpm.Sidecar.read( outfile )
+    values = counts.loc[ table.get().index ].to_numpy()
+    np.testing.assert_allclose( sidecar.factors, ( values / table.lengths[ :,None ] ).sum( axis = 0 ) )
+    assert list( sidecar.genes ) == list( table.get().index )
+
+def test_reexport_counts( tmp_path, counts, normalised ):
+    # the counts are recovered from the TPM values and their scaling factors
+    table, outfile = normalised
+    recovered = str( tmp_path / "recovered.tsv" )
+    tpm.reexport( outfile, recovered, digits = 3, to = "counts" )
+    assert_same( read_output( recovered ), counts.loc[ table.get().index ], digits = 3 )
+
+def test_reexport_precision( tmp_path, normalised ):
+    # re-exporting at a lower precision matches rounding the original values
+    table, outfile = normalised
+    rounded = str( tmp_path / "rounded.tsv" )
+    tpm.reexport( outfile, rounded, digits = 2 )
+    assert_same( read_output( rounded ), table.get(), digits = 2 )
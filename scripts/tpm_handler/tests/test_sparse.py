@@ -0,0 +1,47 @@
+"""
+Tests for the sparse (MatrixMarket) normalisation path.
+"""
+
+import sys
+
+import numpy as np
+import pytest
+from scipy import io, sparse
+
+import tpm_handler as tpm
+from tpm_handler.main import main
+
+from .conftest import reference, assert_same
+
+
+@pytest.fixture
+def mtx_file( tmp_path, counts ) -> str:
+    """
+    The fixture countTable as a MatrixMarket file (with its gene IDs and sample names).
+    """
+    filename = str( tmp_path / "counts.mtx" )
+    io.mmwrite( filename, sparse.csc_matrix( counts.to_numpy() ) )
+    ( tmp_path / "counts.mtx_rows" ).write_text( "\n".join( counts.index ) + "\n" )
+    ( tmp_path / "counts.mtx_cols" ).write_text( "\n".join( counts.columns ) + "\n" )
+    return filename
+
+@pytest.mark.parametrize( "method", [ "tpm", "cpm" ] )
+def test_sparse_equals_dense( counts_file, mtx_file, lengths, method ):
+    table = tpm.Table( mtx_file )
+    assert table.is_sparse
+    table.set_lengths( lengths )
+    table.normalise( digits = None, method = method )
+    assert sparse.issparse( table.tpm )
+    result = table.get()
+    assert_same( result.to_frame(), reference( counts_file, lengths, method ), digits = 10 )
+
+def test_stream_rejects_mtx( tmp_path, mtx_file, lengths, monkeypatch ):
+    outfile = tmp_path / "counts.out"
+    monkeypatch.setattr( sys, "argv", [ "tpm_handler", "normalise", mtx_file, "-l", lengths, "--stream", "-o", str( outfile ) ] )
+    with pytest.raises( SystemExit ) as error:
+        main()
+    assert error.value.code != 0
+    assert not outfile.exists()
+
+    with pytest.raises( ValueError ):
+        list( tpm.stream.read_chunks( mtx_file ) )
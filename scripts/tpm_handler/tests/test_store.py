@@ -0,0 +1,42 @@
+"""
+Tests for the chunked HDF5 matrix store.
+"""
+
+import numpy as np
+import pytest
+
+import tpm_handler as tpm
+
+from .conftest import reference, read_output, assert_same
+
+pytest.importorskip( "h5py" )
+
+
+@pytest.fixture
+def store_file( tmp_path, counts_file ) -> str:
+    filename = str( tmp_path / "counts.h5" )
+    tpm.build_store( counts_file, filename, chunksize = 64 )
+    return filename
+
+@pytest.mark.parametrize( "method", [ "tpm", "cpm" ] )
+def test_store( tmp_path, counts_file, lengths, store_file, method ):
+    outfile = str( tmp_path / "store.tsv" )
+    with tpm.MatrixStore( store_file, "r+" ) as store:
+        store.normalise( tpm.read_lengths( lengths ), method, block_rows = 50 )
+        store.export( outfile, method, digits = 5 )
+    assert_same( read_output( outfile ), reference( counts_file, lengths, method ) )
+
+def test_store_get( counts, store_file ):
+    with tpm.MatrixStore( store_file ) as store:
+        assert store.shape == counts.shape
+        genes = [ counts.index[9], counts.index[2], counts.index[9] ]
+        samples = [ "S7", "S1", "S7" ]
+        subset = store.get( genes = genes, samples = samples )
+        assert list( subset.index ) == genes and list( subset.columns ) == samples
+        np.testing.assert_array_equal( subset.to_numpy(), counts.loc[ genes, samples ].to_numpy() )
+
+        block = store.get( genes = slice( 10, 20 ), samples = slice( 3, 6 ) )
+        np.testing.assert_array_equal( block.to_numpy(), counts.iloc[ 10:20, 3:6 ].to_numpy() )
+        assert store.get( genes = [] ).shape == ( 0, counts.shape[1] )
+        with pytest.raises( KeyError ):
+            store.get( genes = [ "ENSG999999.1" ] )
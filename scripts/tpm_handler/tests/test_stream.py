@@ -0,0 +1,35 @@
+"""
+Tests for the two-pass streaming normalisation.
+"""
+
+import numpy as np
+import pytest
+
+import tpm_handler as tpm
+
+from .conftest import reference, read_output, assert_same
+
+
+@pytest.mark.parametrize( "method", [ "tpm", "cpm", "log1p-rpkm" ] )
+def test_stream( tmp_path, counts_file, lengths, method ):
+    expected = reference( counts_file, lengths, method )
+    outfile = str( tmp_path / "stream.tsv" )
+    tpm.normalise_stream( counts_file, tpm.read_lengths( lengths ), outfile, digits = 5, chunksize = 64, method = method )
+    assert_same( read_output( outfile ), expected )
+
+def test_stream_factors( counts_file, lengths ):
+    # the factors of the first pass are those of the whole table
+    table = tpm.Table( counts_file )
+    table.set_lengths( lengths )
+    expected = ( table.get().to_numpy() / table.lengths[ :,None ] ).sum( axis = 0 )
+    factors, rows = tpm.stream.tpm_factors( counts_file, tpm.read_lengths( lengths ), chunksize = 64 )
+    np.testing.assert_allclose( factors, expected )
+    assert rows == len( table.get() )
+
+def test_stream_without_lengths( tmp_path, counts_file ):
+    other = tmp_path / "other.lengths"
+    other.write_text( "gene_id\tmerged\nENSG999999.1\t1000\n" )
+    outfile = tmp_path / "stream.tsv"
+    with pytest.raises( ValueError, match = "corresponding length" ):
+        tpm.normalise_stream( counts_file, tpm.read_lengths( str( other ) ), str( outfile ) )
+    assert not outfile.exists()
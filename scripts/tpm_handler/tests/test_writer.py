@@ -0,0 +1,54 @@
+"""
+Tests for the fixed-precision writer.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import tpm_handler as tpm
+from tpm_handler.writer import format_rows, choose_precision
+
+
+def test_format_rows():
+    array = np.array( [ [ 1.234567, 0.0, np.nan ], [ 10.0, 2.5e-6, 3.0 ] ] )
+    assert format_rows( array, [ "a", "b" ], digits = 2 ) == "a\t1.23\t0\t\nb\t10.00\t0\t3.00\n"
+
+@pytest.mark.parametrize( "digits", [ 0, 2, 5 ] )
+def test_write_table( tmp_path, counts, digits ):
+    array = counts.to_numpy( dtype = float ) / 7
+    outfile = str( tmp_path / "table.tsv" )
+    tpm.write_table( outfile, array, counts.index, counts.columns, index_name = "gene_id", digits = digits, chunksize = 64 )
+    result = pd.read_csv( outfile, sep = "\t", index_col = 0 )
+    assert result.index.name == "gene_id"
+    assert list( result.index ) == list( counts.index ) and list( result.columns ) == list( counts.columns )
+    np.testing.assert_allclose( result.to_numpy(), np.round( array, digits ), rtol = 0, atol = 10.0**-( digits + 6 ) )
+
+def test_choose_precision( tmp_path, counts ):
+    array = counts.to_numpy( dtype = float ) / 7
+    sizes = {}
+    for digits in range( 6 ):
+        outfile = str( tmp_path / f"table{digits}.tsv" )
+        tpm.write_table( outfile, array, counts.index, counts.columns, digits = digits )
+        sizes[ digits ] = os.path.getsize( outfile )
+
+    # all rows are sampled, so the estimate is (nearly) exact
+    limit = ( sizes[3] + sizes[4] ) // 2
+    assert choose_precision( array, counts.index, limit, columns = counts.columns ) == 3
+    assert choose_precision( array, counts.index, sizes[5] + 100, columns = counts.columns ) == 5
+    assert choose_precision( array, counts.index, 10, columns = counts.columns ) == 0
+
+def test_save_max_bytes( tmp_path, counts_file, lengths ):
+    table = tpm.Table( counts_file )
+    table.set_lengths( lengths )
+    table.normalise( digits = None )
+    full = str( tmp_path / "full.tsv" )
+    table.save( full, digits = 5 )
+
+    limited = str( tmp_path / "limited.tsv" )
+    table.save( limited, digits = 5, max_bytes = os.path.getsize( full ) * 3 // 4 )
+    assert os.path.getsize( limited ) <= os.path.getsize( full ) * 3 // 4
+    result = pd.read_csv( limited, sep = "\t", index_col = 0 )
+    np.testing.assert_allclose( result.to_numpy(), table.get().to_numpy(), atol = 0.5 )
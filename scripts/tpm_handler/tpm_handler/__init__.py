@@ -1,2 +1,19 @@
 from .main import main
-from .core import *
\ No newline at end of file
+from .core import *
+from .stream import normalise_stream
+from .parallel import parallel_array_to_tpm
+from .cache import CountCache
+from .gtf import compute_lengths, read_gtf
+from .writer import write_table
+from .batch import normalise_batch
+from .engines import get_engine, register_engine, Engine
+from .append import append_samples
+from .columnar import read_columnar, write_columnar
+from .store import MatrixStore, build_store, write_store
+from .geneindex import GeneIndex, strip_versions
+from .registry import LengthsRegistry
+from .sidecar import Sidecar, reexport
+from .planner import Plan
+from .merge import merge_counts, read_counts
+from .filters import Filters
+from .compression import open_file
\ No newline at end of file
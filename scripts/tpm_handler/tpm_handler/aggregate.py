@@ -0,0 +1,179 @@
+"""
+Defines functions for aggregating the rows of features that share the same (gene) name.
+
+Gene names are not unique (e.g. for genes on the PAR regions or for genes with multiple Ensembl IDs), so
+indexing a table by gene names leaves duplicate rows. These are aggregated (summed by default, as done by
+`aggregate(. ~ gene_name, ..., sum)` in the R reference pipeline). Only the rows of duplicated names are
+touched: sums and means are computed as a single product with a sparse indicator matrix, maxima as a
+grouped reduction over the sorted rows. The aggregated rows keep the position of the first occurrence of their name.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+aggregations = [ "sum", "max", "mean" ]
+"""
+The supported aggregations of duplicate rows.
+"""
+
+
+def aggregate_rows( array, names, how : str = "sum" ) -> tuple:
+    """
+    Aggregates the rows of a matrix that share the same name.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The matrix. As a 2D ndarray (or a sparse matrix).
+    names : list or pd.Index
+        The name of each row.
+    how : str, optional
+        The aggregation (`sum`, `max` or `mean`). The default is "sum".
+
+    Returns
+    -------
+    array : np.ndarray
+        The aggregated matrix (sparse if `array` is sparse).
+    names : pd.Index
+        The (unique) name of each row, in order of their first occurrence.
+    """
+    if how not in aggregations:
+        raise ValueError( f"Unknown aggregation '{how}'. Supported aggregations are: {aggregations}" )
+    names = pd.Index( names )
+    if names.is_unique:
+        return array, names
+
+    codes, uniques = pd.factorize( names )
+    if ( codes < 0 ).any():
+        raise ValueError( "Some rows do not have a name." )
+    sizes = np.bincount( codes, minlength = len( uniques ) )
+
+    # only the rows of duplicated names need to be aggregated
+    # the other rows are simply moved to their (new) positions
+    dup_rows = np.flatnonzero( sizes[ codes ] > 1 )
+    single_rows = np.flatnonzero( sizes[ codes ] == 1 )
+    dup_groups, dup_codes = np.unique( codes[ dup_rows ], return_inverse = True )
+
+    is_sparse = sparse.issparse( array )
+    array = array.tocsr() if is_sparse else np.asarray( array )
+    dup = array[ dup_rows ]
+
+    if how == "max":
+        order = np.argsort( dup_codes, kind = "stable" )
+        starts = np.flatnonzero( np.r_[ True, np.diff( dup_codes[ order ] ) != 0 ] )
+        dup = dup.toarray() if is_sparse else dup
+        values = np.maximum.reduceat( dup[ order ], starts, axis = 0 )
+    else:
+        indicator = sparse.csr_matrix( ( np.ones( len( dup_rows ) ), ( dup_codes, np.arange( len( dup_rows ) ) ) ), shape = ( len( dup_groups ), len( dup_rows ) ) )
+        values = indicator @ dup
+        values = values.toarray() if sparse.issparse( values ) else np.asarray( values )
+        if how == "mean":
+            values = values / sizes[ dup_groups ][ :, None ]
+
+    if is_sparse:
+        # assemble both parts and permute the rows into their positions
+        stacked = sparse.vstack( [ array[ single_rows ], sparse.csr_matrix( values ) ], format = "csr" )
+        positions = np.concatenate( [ codes[ single_rows ], dup_groups ] )
+        out = stacked[ np.argsort( positions ) ]
+    else:
+        out = np.empty( ( len( uniques ), array.shape[1] ), dtype = np.result_type( array.dtype, values.dtype ), order = "F" )
+        out[ codes[ single_rows ] ] = array[ single_rows ]
+        out[ dup_groups ] = values
+    return out, pd.Index( uniques, name = names.name )
+
+def aggregate_frame( df, how : str = "sum" ):
+    """
+    Aggregates the rows of a table that share the same index value.
+
+    Parameters
+    ----------
+    df : pd.DataFrame or SparseFrame
+        The table (with the names as index).
+    how : str, optional
+        The aggregation (`sum`, `max` or `mean`). The default is "sum".
+
+    Returns
+    -------
+    pd.DataFrame or SparseFrame
+        The aggregated table.
+    """
+    if df.index.is_unique:
+        return df
+    values, index = aggregate_rows( df.to_numpy(), df.index, how )
+    if sparse.issparse( values ):
+        from .sparse import SparseFrame
+        return SparseFrame( values, index, df.columns )
+    return pd.DataFrame( values, index = index, columns = df.columns, copy = False )
+
+
+class RowAccumulator:
+    """
+    Aggregates the rows of duplicated names across chunks of a (streamed) table.
+
+    Rows of names that occur only once are passed through directly, whereas the rows of
+    duplicated names are aggregated in a small buffer (one row per duplicated name).
+
+    Parameters
+    ----------
+    names : list or pd.Index
+        All names that may occur (e.g. the names of the lengths), to find the duplicated names.
+    n_columns : int
+        The number of columns.
+    how : str, optional
+        The aggregation (`sum`, `max` or `mean`). The default is "sum".
+    """
+    def __init__( self, names, n_columns : int, how : str = "sum" ):
+        if how not in aggregations:
+            raise ValueError( f"Unknown aggregation '{how}'. Supported aggregations are: {aggregations}" )
+        names = pd.Index( names )
+        self.how = how
+        self.duplicates = pd.Index( names[ names.duplicated( keep = False ) ].unique() )
+        self.values = np.full( ( len( self.duplicates ), n_columns ), -np.inf if how == "max" else 0.0 )
+        self.sizes = np.zeros( len( self.duplicates ), dtype = int )
+
+    def add( self, values : np.ndarray, index ) -> tuple:
+        """
+        Adds a chunk of rows.
+
+        Parameters
+        ----------
+        values : np.ndarray
+            The values of the chunk.
+        index : list or pd.Index
+            The names of the rows.
+
+        Returns
+        -------
+        values : np.ndarray
+            The rows of names that are not duplicated.
+        index : pd.Index
+            The names of these rows.
+        """
+        index = pd.Index( index )
+        codes = self.duplicates.get_indexer( index )
+        dup = codes >= 0
+        if not dup.any():
+            return values, index
+
+        reduce = np.maximum if self.how == "max" else np.add
+        reduce.at( self.values, codes[ dup ], values[ dup ] )
+        np.add.at( self.sizes, codes[ dup ], 1 )
+        return values[ ~dup ], index[ ~dup ]
+
+    def result( self ) -> tuple:
+        """
+        Gets the aggregated rows of the duplicated names (that occurred at least once).
+
+        Returns
+        -------
+        values : np.ndarray
+            The aggregated rows.
+        index : pd.Index
+            The names of the rows.
+        """
+        seen = self.sizes > 0
+        values = self.values[ seen ]
+        if self.how == "mean":
+            values = values / self.sizes[ seen ][ :, None ]
+        return values, self.duplicates[ seen ]
@@ -0,0 +1,144 @@
+"""
+Defines functions for appending new samples to an existing (normalised) expression matrix.
+
+Since TPM (and the other normalisations) are computed independently for each sample, new samples can be
+normalised on their own and then added to an existing matrix as new columns. Instead of reloading the
+existing matrix, its rows are streamed chunk by chunk and the (formatted) values of the new samples are
+appended to each row. The genes of the new samples must be in the same order as those of the existing matrix
+(which is the case if both were normalised using the same lengths). Otherwise, they can be matched by their IDs
+instead (`reorder`), in which case the existing matrix is never reordered. Any mismatch in the genes, as well as
+duplicate genes in the existing matrix (which could not be matched unambiguously), is reported as an error.
+"""
+
+import os
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from .core import logger
+from .writer import format_rows
+from .compression import open_file, compression_format
+
+
+def append_samples( existing : str, values : np.ndarray, index, columns, outfile : str = None, digits : int = 5, chunksize : int = 10000, sep : str = "\t", reorder : bool = False ):
+    """
+    Appends new samples (columns) to an existing expression matrix using a streaming row-wise merge.
+
+    Parameters
+    ----------
+    existing : str
+        The existing matrix file (e.g. a TPM table).
+    values : np.ndarray
+        The (normalised) values of the new samples. As a 2D ndarray (or a sparse matrix).
+    index : list
+        The gene IDs (or names) of the rows of `values`. These must match the
+        first column of the existing matrix (in the same order, unless `reorder`).
+    columns : list
+        The names of the new samples.
+    outfile : str, optional
+        The output file. By default the existing matrix is replaced (once the merge succeeded).
+    digits : int, optional
+        The number of digits to round the new values to. The default is 5.
+    chunksize : int, optional
+        The number of rows to merge at once. The default is 10000.
+    sep : str, optional
+        The separator of the matrix. The default is "\t".
+    reorder : bool, optional
+        Match the genes of the new samples to those of the existing matrix by their IDs if they are
+        in a different order. By default a different order is an error.
+    """
+    index = pd.Index( index )
+    if len( index ) != values.shape[0]:
+        raise IndexError( "The length of the index does not match the number of rows of the values." )
+    if not index.is_unique:
+        raise ValueError( "The genes of the new samples are not unique." )
+    if hasattr( values, "tocsr" ):
+        values = values.tocsr()
+
+    outfile = outfile if outfile is not None else existing
+    # the temporary file keeps the suffix of the output (and thereby its compression)
+    root, suffix = os.path.splitext( outfile ) if compression_format( outfile ) else ( outfile, "" )
+    tmpfile = f"{root}.{os.getpid()}.tmp{suffix}"
+
+    logger.info( f"Appending {len( columns )} samples to {existing}..." )
+    rows = 0
+    seen = set()
+    try:
+        with open_file( existing, "r" ) as src, open_file( tmpfile, "w" ) as out:
+            header = src.readline().rstrip( "\n" ).split( sep )
+            duplicates = set( header[1:] ).intersection( str( i ) for i in columns )
+            if duplicates:
+                raise ValueError( f"The samples {sorted( duplicates )} are already part of {existing}." )
+            out.write( sep.join( header + [ str( i ) for i in columns ] ) + "\n" )
+
+            while True:
+                lines = list( itertools.islice( src, chunksize ) )
+                if not lines:
+                    break
+                out.write( _merge_rows( lines, values, index, digits, sep, start = rows, seen = seen, reorder = reorder, existing = existing ) )
+                rows += len( lines )
+
+        if rows != len( index ):
+            raise ValueError( f"{existing} has {rows} genes but the new samples have {len( index )} genes. Were they normalised using the same lengths?" )
+        os.replace( tmpfile, outfile )
+    finally:
+        if os.path.exists( tmpfile ):
+            os.remove( tmpfile )
+
+    logger.info( f"Saved to file: {outfile}" )
+
+def _merge_rows( lines : list, values : np.ndarray, index : pd.Index, digits : int = 5, sep : str = "\t", start : int = 0, seen : set = None, reorder : bool = False, existing : str = "the existing matrix" ) -> str:
+    """
+    Appends the matching rows of the new samples to a chunk of lines of the existing matrix.
+
+    Parameters
+    ----------
+    lines : list
+        The lines of the existing matrix.
+    values : np.ndarray
+        The values of the new samples.
+    index : pd.Index
+        The gene IDs (or names) of the rows of `values`.
+    digits : int, optional
+        The number of digits to round the new values to. The default is 5.
+    sep : str, optional
+        The separator of the matrix. The default is "\t".
+    start : int, optional
+        The position of the first line in the existing matrix (to check the order of the genes). The default is 0.
+    seen : set, optional
+        The genes of the previous lines (to detect duplicate genes). It is updated with the genes of these lines.
+    reorder : bool, optional
+        Match the genes by their IDs if they are in a different order. By default a different order is an error.
+    existing : str, optional
+        The name of the existing matrix (for the error messages).
+
+    Returns
+    -------
+    str
+        The merged lines.
+    """
+    lines = [ line.rstrip( "\n" ) for line in lines ]
+    ids = [ line.split( sep, 1 )[0] for line in lines ]
+
+    seen = seen if seen is not None else set()
+    for i in ids:
+        if i in seen:
+            raise ValueError( f"The gene '{i}' occurs multiple times in {existing}, so the new samples can not be matched to its rows." )
+        seen.add( i )
+
+    positions = index.get_indexer( ids )
+    missing = positions < 0
+    if missing.any():
+        first = ids[ np.flatnonzero( missing )[0] ]
+        raise ValueError( f"{missing.sum()} genes of the existing matrix (e.g. '{first}') are not part of the new samples. Were they normalised using the same lengths?" )
+    if not reorder:
+        moved = positions != np.arange( start, start + len( ids ) )
+        if moved.any():
+            row = np.flatnonzero( moved )[0]
+            raise ValueError( f"The genes of the new samples are not in the same order as those of {existing} (e.g. '{ids[ row ]}' in row {start + row + 1}). Use `reorder` (--reorder) to match them by their IDs." )
+
+    # format the new rows with an empty name so that each formatted
+    # row starts with the separator and can simply be appended
+    new = format_rows( values[ positions ], [ "" ] * len( ids ), digits = digits, sep = sep ).splitlines()
+    return "".join( line + row + "\n" for line, row in zip( lines, new ) )
@@ -0,0 +1,139 @@
+"""
+Defines functions for normalising many countTables at once.
+
+The lengths are only read once and their (hashed) gene index is shared by all countTables,
+which are processed concurrently by a bounded pool of worker processes.
+"""
+
+import os
+import glob
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from .core import logger, Table
+
+
+def expand_files( patterns : list ) -> list:
+    """
+    Expands a list of files and/or glob patterns.
+
+    Parameters
+    ----------
+    patterns : list
+        The files or glob patterns.
+
+    Returns
+    -------
+    list
+        The matching files (in the given order, without duplicates).
+    """
+    files = []
+    for pattern in patterns:
+        matches = sorted( glob.glob( pattern ) ) if glob.has_magic( pattern ) else [ pattern ]
+        if not matches:
+            logger.warning( f"No files match the pattern '{pattern}'" )
+        files.extend( matches )
+    return list( dict.fromkeys( files ) )
+
+def normalise_batch( files : list, lengths : pd.DataFrame, outdir : str = None, suffix : str = ".tpm", digits : int = 5, workers : int = 1, **kwargs ) -> list:
+    """
+    Normalises many countTables to TPM using the same lengths.
+
+    Parameters
+    ----------
+    files : list
+        The input count tables (or glob patterns).
+    lengths : pd.DataFrame
+        The lengths of the features. As returned by `read_lengths`.
+    outdir : str, optional
+        The output directory. By default each output is written next to its input file.
+    suffix : str, optional
+        The suffix to append to the input filename for the output file. The default is ".tpm".
+    digits : int, optional
+        The number of digits to round to. The default is 5.
+    workers : int, optional
+        The number of files to process concurrently. The default is 1.
+    **kwargs
+        Any additional keyword arguments are passed to `Table.save` (e.g. `use_names`), 
+        except `lean` which is passed to the `Table`.
+
+    Returns
+    -------
+    list
+        A report for each file (dictionaries with the file, output, rows, samples, size in MB, time in seconds and throughput in MB/s).
+    """
+    files = expand_files( files )
+    if outdir is not None:
+        os.makedirs( outdir, exist_ok = True )
+    jobs = [ ( f, _outfile( f, outdir, suffix ) ) for f in files ]
+
+    logger.info( f"Normalising {len(jobs)} files using {max( workers, 1 )} workers..." )
+    start = time.time()
+    reports = []
+    if workers <= 1:
+        _init_worker( lengths )
+        for infile, outfile in jobs:
+            reports.append( _report( _normalise_file( infile, outfile, digits, **kwargs ) ) )
+    else:
+        # the lengths are sent to each worker only once (not for each file)
+        with ProcessPoolExecutor( max_workers = workers, initializer = _init_worker, initargs = ( lengths, ) ) as pool:
+            futures = [ pool.submit( _normalise_file, infile, outfile, digits, **kwargs ) for infile, outfile in jobs ]
+            for future in as_completed( futures ):
+                reports.append( _report( future.result() ) )
+
+    total = sum( i[ "size" ] for i in reports )
+    elapsed = time.time() - start
+    logger.info( f"Normalised {len(reports)} files ({total:.1f} MB) in {elapsed:.1f} s ({total / max( elapsed, 1e-9 ):.1f} MB/s)" )
+    return reports
+
+def _outfile( filename : str, outdir : str, suffix : str ) -> str:
+    """
+    Gets the output file of an input file.
+    """
+    if outdir is None:
+        return f"{filename}{suffix}"
+    return os.path.join( outdir, os.path.basename( filename ) + suffix )
+
+def _report( report : dict ) -> dict:
+    """
+    Logs the report of a single file.
+    """
+    logger.info( f"{report['file']}: {report['rows']} genes x {report['samples']} samples, {report['size']:.1f} MB in {report['time']:.1f} s ({report['throughput']:.1f} MB/s) -> {report['output']}" )
+    return report
+
+
+_lengths = None
+"""
+The lengths shared by all files processed in the current (worker) process.
+"""
+
+def _init_worker( lengths : pd.DataFrame ):
+    """
+    Sets the lengths for the current (worker) process.
+    """
+    global _lengths
+    _lengths = lengths
+
+def _normalise_file( infile : str, outfile : str, digits : int = 5, lean : bool = False, **kwargs ) -> dict:
+    """
+    Normalises a single countTable using the lengths of the current (worker) process.
+    """
+    start = time.time()
+    table = Table( infile, lean = lean )
+    table.set_lengths( _lengths )
+    table.normalise( None )
+    table.save( outfile, digits = digits, **kwargs )
+
+    elapsed = time.time() - start
+    size = os.path.getsize( infile ) / 1024**2
+    return { 
+                "file" : infile, 
+                "output" : outfile, 
+                "rows" : len( table ), 
+                "samples" : len( table.get().columns ), 
+                "size" : size, 
+                "time" : elapsed, 
+                "throughput" : size / max( elapsed, 1e-9 ),
+            }
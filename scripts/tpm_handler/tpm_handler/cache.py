@@ -0,0 +1,234 @@
+"""
+Defines a cache for parsed countTables.
+
+Parsing a multi-GB countTable is by far the slowest step of normalisation. Hence, parsed countTables
+can be stored in a cache directory as a binary (memory-mappable) array alongside the gene IDs and sample names.
+Entries are keyed by the source file's path, size and modification time, so a changed source file is
+automatically re-parsed. Loading from the cache memory-maps the array (copy-on-write) and is therefore
+nearly instant. The least recently used entries are evicted once the cache exceeds its size limit.
+The files of an entry are written under temporary names and only moved into place once all of them are
+complete (the index, i.e. the `.json` file, last), so an interrupted store never leaves a partial entry. Any
+files left behind by an interrupted store are treated as entries of their own and evicted like any other.
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger( "tpm_handler" )
+
+default_cache_dir = os.path.join( os.path.expanduser( "~" ), ".cache", "tpm_handler" )
+"""
+The default directory to store cached countTables in.
+"""
+
+default_max_bytes = 20 * 1024**3
+"""
+The default size limit of the cache (20 GB).
+"""
+
+_suffixes = ( ".npy", ".genes", ".samples", ".json" )
+
+
+class CountCache:
+    """
+    A cache for parsed countTables.
+
+    Parameters
+    ----------
+    directory : str, optional
+        The cache directory. By default `~/.cache/tpm_handler` is used.
+    max_bytes : int, optional
+        The maximum total size of the cache in bytes. The default is 20 GB.
+        The least recently used entries are evicted once this is exceeded.
+    """
+    suffixes = _suffixes
+    """
+    The suffixes of the files that make up an entry (the `.json` file marks when the entry was last used).
+    """
+
+    def __init__( self, directory : str = None, max_bytes : int = default_max_bytes ):
+        self.directory = directory if directory is not None else default_cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs( self.directory, exist_ok = True )
+
+    def key( self, filename : str, **kwargs ) -> str:
+        """
+        Gets the cache key of a source file.
+
+        Parameters
+        ----------
+        filename : str
+            The source file.
+        **kwargs
+            Any parsing options that affect the parsed table.
+
+        Returns
+        -------
+        str
+            The cache key.
+        """
+        stat = os.stat( filename )
+        options = sorted( ( k, repr(v) ) for k, v in kwargs.items() )
+        key = f"{os.path.abspath( filename )}|{stat.st_size}|{stat.st_mtime_ns}|{options}"
+        return hashlib.sha1( key.encode() ).hexdigest()
+
+    def load( self, filename : str, **kwargs ) -> pd.DataFrame:
+        """
+        Loads a parsed countTable from the cache.
+
+        Parameters
+        ----------
+        filename : str
+            The source file.
+        **kwargs
+            Any parsing options that affect the parsed table.
+
+        Returns
+        -------
+        pd.DataFrame or None
+            The countTable (backed by a copy-on-write memory-map) or None if the file is not cached.
+        """
+        path = self._path( self.key( filename, **kwargs ) )
+        if not all( os.path.exists( path + suffix ) for suffix in self.suffixes ):
+            return None
+
+        logger.info( f"Loading cached countTable for {filename}..." )
+        with open( path + ".json", "r" ) as f:
+            meta = json.load( f )
+        array = np.load( path + ".npy", mmap_mode = "c" )
+        index = pd.Index( _read_lines( path + ".genes" ), name = meta[ "index_name" ] )
+        columns = pd.Index( _read_lines( path + ".samples" ) )
+
+        # mark as recently used
+        os.utime( path + ".json" )
+        return pd.DataFrame( array, index = index, columns = columns, copy = False )
+
+    def store( self, filename : str, df : pd.DataFrame, **kwargs ):
+        """
+        Stores a parsed countTable in the cache.
+
+        Parameters
+        ----------
+        filename : str
+            The source file.
+        df : pd.DataFrame
+            The parsed countTable.
+        **kwargs
+            Any parsing options that affect the parsed table.
+        """
+        key = self.key( filename, **kwargs )
+        path = self._path( key )
+
+        staged = self._staged( path )
+        try:
+            np.save( staged + ".npy", np.asfortranarray( df.to_numpy() ) )
+            _write_lines( staged + ".genes", df.index )
+            _write_lines( staged + ".samples", df.columns )
+            meta = { "source" : os.path.abspath( filename ), "index_name" : df.index.name }
+            with open( staged + ".json", "w" ) as f:
+                json.dump( meta, f )
+            self._publish( staged, path )
+        finally:
+            self._discard( staged )
+
+        logger.debug( f"Cached countTable for {filename} as {key}" )
+        self.evict( keep = key )
+
+    def evict( self, keep : str = None ):
+        """
+        Removes the least recently used entries until the cache is within its size limit.
+
+        Parameters
+        ----------
+        keep : str, optional
+            The key of an entry that should never be evicted (e.g. the one just stored).
+        """
+        entries = self.entries()
+        total = sum( size for _, _, size in entries )
+        for key, _, size in sorted( entries, key = lambda x : x[1] ):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove( key )
+            total -= size
+            logger.debug( f"Evicted {key} from the cache." )
+
+    def remove( self, key : str ):
+        """
+        Removes an entry from the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry.
+        """
+        for file in self._files().get( key, [] ):
+            if os.path.exists( file ):
+                os.remove( file )
+
+    def entries( self ) -> list:
+        """
+        Gets all entries in the cache.
+
+        Returns
+        -------
+        list
+            A list of (key, last used time, size in bytes) tuples. Files without an index (left behind by
+            an interrupted store) are included as entries that were last used when they were written.
+        """
+        entries = []
+        for key, files in self._files().items():
+            index = self._path( key ) + ".json"
+            used = os.path.getmtime( index ) if index in files else max( os.path.getmtime( i ) for i in files )
+            entries.append( ( key, used, sum( os.path.getsize( i ) for i in files ) ) )
+        return entries
+
+    def _files( self ) -> dict:
+        """
+        Groups the files in the cache directory by their key (including temporary and orphaned files).
+        """
+        files = {}
+        for file in os.listdir( self.directory ):
+            path = os.path.join( self.directory, file )
+            if os.path.isfile( path ):
+                files.setdefault( file.split( "." )[0], [] ).append( path )
+        return files
+
+    def _staged( self, path : str ) -> str:
+        """
+        Gets the temporary name under which the files of an entry are written before they are published.
+        """
+        return f"{path}.{os.getpid()}.tmp"
+
+    def _publish( self, staged : str, path : str ):
+        """
+        Moves the (complete) files of an entry into place, the index (`.json`) last.
+        """
+        for suffix in sorted( self.suffixes, key = lambda x : x == ".json" ):
+            os.replace( staged + suffix, path + suffix )
+
+    def _discard( self, staged : str ):
+        """
+        Removes any temporary files of an entry that were not published (e.g. after an error).
+        """
+        for suffix in self.suffixes:
+            if os.path.exists( staged + suffix ):
+                os.remove( staged + suffix )
+
+    def _path( self, key : str ) -> str:
+        return os.path.join( self.directory, key )
+
+
+def _read_lines( filename : str ) -> list:
+    with open( filename, "r" ) as f:
+        return f.read().splitlines()
+
+def _write_lines( filename : str, values ):
+    with open( filename, "w" ) as f:
+        f.write( "\n".join( str( i ) for i in values ) )
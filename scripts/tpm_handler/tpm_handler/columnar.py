@@ -0,0 +1,151 @@
+"""
+Defines functions for reading and writing expression matrices in columnar formats (Parquet and Feather).
+
+Columnar files store each sample (column) as a separate, compressed binary column. Hence, they are much smaller
+and faster to read than text tables and single samples can be read without decoding the rest of the file.
+The gene IDs are stored as the first column. Values are stored as float32 by default which is plenty for
+normalised values (and exact for counts below ~16 million).
+
+Note
+----
+This requires the optional dependency `pyarrow`.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+columnar_suffixes = {
+                        ".parquet" : "parquet",
+                        ".pq" : "parquet",
+                        ".feather" : "feather",
+                        ".arrow" : "feather",
+                    }
+"""
+The file suffixes of the supported columnar formats.
+"""
+
+
+def columnar_format( filename : str ) -> str:
+    """
+    Gets the columnar format of a file from its suffix.
+
+    Parameters
+    ----------
+    filename : str
+        The file.
+
+    Returns
+    -------
+    str or None
+        Either `parquet` or `feather`, or None if the file is not in a columnar format.
+    """
+    return columnar_suffixes.get( os.path.splitext( str( filename ) )[1].lower() )
+
+def read_columnar( filename : str, samples : list = None, dtype = None ) -> pd.DataFrame:
+    """
+    Reads an expression matrix from a Parquet or Feather file.
+
+    Parameters
+    ----------
+    filename : str
+        The input file.
+    samples : list, optional
+        The samples (columns) to read. By default all samples are read.
+        Other samples are not decoded at all.
+    dtype : type, optional
+        The dtype of the values. By default the stored dtype is kept.
+
+    Returns
+    -------
+    pd.DataFrame
+        The matrix (gene IDs as index). The values are stored in column-major order.
+    """
+    fmt = _check_format( filename )
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        names = pq.read_schema( filename ).names
+    else:
+        import pyarrow.feather as feather
+        import pyarrow.ipc as ipc
+        with ipc.open_file( filename ) as reader:
+            names = reader.schema.names
+
+    index_name = names[0]
+    if samples is not None:
+        missing = set( samples ).difference( names[1:] )
+        if missing:
+            raise KeyError( f"The samples {sorted( missing )} are not part of {filename}." )
+        names = [ index_name ] + list( samples )
+
+    table = pq.read_table( filename, columns = names ) if fmt == "parquet" else feather.read_table( filename, columns = names )
+
+    # fill a single column-major array so that each sample is contiguous
+    # and no intermediate (block-wise) dataframe is created
+    columns = table.column_names[1:]
+    first = table.column( 1 ).to_numpy() if columns else np.empty( 0 )
+    array = np.empty( ( table.num_rows, len( columns ) ), dtype = dtype or first.dtype, order = "F" )
+    for i, name in enumerate( columns ):
+        array[ :,i ] = table.column( name ).to_numpy()
+
+    index = pd.Index( table.column( 0 ).to_numpy( zero_copy_only = False ), name = index_name )
+    return pd.DataFrame( array, index = index, columns = columns, copy = False )
+
+def write_columnar( filename : str, array, index, columns, index_name : str = None, digits : int = None, dtype = np.float32, compression : str = "zstd" ):
+    """
+    Writes an expression matrix to a Parquet or Feather file.
+
+    Parameters
+    ----------
+    filename : str
+        The output file. The format is inferred from the suffix (`.parquet` or `.feather`).
+    array : np.ndarray
+        The matrix. As a 2D ndarray (or a sparse matrix).
+    index : list
+        The row names (gene IDs).
+    columns : list
+        The column names (samples).
+    index_name : str, optional
+        The name of the index column. The default is "gene_id".
+    digits : int, optional
+        The number of digits to round to. By default the values are stored as they are.
+    dtype : type, optional
+        The dtype to store the values as. The default is float32.
+    compression : str, optional
+        The compression to use (e.g. `zstd`, `lz4`, or None). The default is `zstd`.
+    """
+    fmt = _check_format( filename )
+    import pyarrow as pa
+
+    if hasattr( array, "tocsc" ):
+        array = array.tocsc()
+
+    fields = { index_name or "gene_id" : pa.array( np.asarray( index ).astype( str ) ) }
+    for i, name in enumerate( columns ):
+        column = array[ :,i ]
+        column = column.toarray().ravel() if hasattr( column, "toarray" ) else column
+        if digits is not None:
+            column = np.round( column, digits )
+        fields[ str( name ) ] = pa.array( np.asarray( column, dtype = dtype ) )
+    table = pa.table( fields )
+
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        pq.write_table( table, filename, compression = compression or "none" )
+    else:
+        import pyarrow.feather as feather
+        feather.write_feather( table, filename, compression = compression or "uncompressed" )
+
+def _check_format( filename : str ) -> str:
+    """
+    Gets the columnar format of a file and checks that pyarrow is available.
+    """
+    fmt = columnar_format( filename )
+    if fmt is None:
+        raise ValueError( f"Unknown columnar format of {filename}. Supported suffixes are: {list( columnar_suffixes.keys() )}" )
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError( f"Reading and writing {fmt} files requires pyarrow. Install it using `pip install pyarrow`." )
+    return fmt
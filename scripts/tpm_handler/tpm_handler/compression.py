@@ -0,0 +1,209 @@
+"""
+Defines transparent reading and writing of compressed (gzip or zstd) tables.
+
+Files ending in `.gz` or `.zst` are (de)compressed on the fly, both for inputs (countTables, lengths) and for
+outputs (normalised tables). Inputs are decompressed as a stream, so only a block of the decompressed file is
+held in memory at a time (the parsers of pandas and pyarrow decompress them natively). Outputs are compressed
+in blocks by a pool of threads (zlib and zstd release the GIL while compressing), so that compressing adds
+little to the time spent formatting the values while the number of bytes written is reduced about 5 to 10 fold.
+For gzip, each block is written as its own gzip member (a gzip file of concatenated members is decompressed as
+a whole by any gzip reader), zstd uses its own multithreaded compressor. Reading or writing zstd files requires
+the `zstandard` package.
+"""
+
+import io
+import os
+import gzip
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger( "tpm_handler" )
+
+compression_suffixes = { ".gz" : "gzip", ".zst" : "zstd" }
+"""
+The suffixes of compressed files and their compression formats.
+"""
+
+default_levels = { "gzip" : 1, "zstd" : 1 }
+"""
+The default compression level of each format. Formatted values compress only marginally better at higher
+levels (e.g. gzip level 6 makes TPM tables about 10% smaller than level 1, but is about 6 times slower).
+"""
+
+default_blocksize = 2**22
+"""
+The number of (uncompressed) bytes that are compressed at once by a thread (4 MB).
+"""
+
+
+def compression_format( filename : str ) -> str:
+    """
+    Gets the compression format of a file from its suffix.
+
+    Parameters
+    ----------
+    filename : str
+        The file.
+
+    Returns
+    -------
+    str
+        The compression format (`gzip` or `zstd`) or None if the file is not compressed.
+    """
+    if not isinstance( filename, str ):
+        return None
+    for suffix, fmt in compression_suffixes.items():
+        if filename.endswith( suffix ):
+            return fmt
+    return None
+
+def open_file( filename : str, mode : str = "r", workers : int = None, level : int = None ):
+    """
+    Opens a file, which is (de)compressed on the fly if it ends in `.gz` or `.zst`.
+
+    Parameters
+    ----------
+    filename : str
+        The file.
+    mode : str, optional
+        The mode to open the file in (`r`, `rb`, `w` or `wb`). The default is "r".
+    workers : int, optional
+        The number of threads that compress blocks when writing. By default the number of CPUs (up to 8).
+    level : int, optional
+        The compression level when writing. By default 1 (see `default_levels`).
+
+    Returns
+    -------
+    file
+        The opened file.
+    """
+    fmt = compression_format( filename )
+    if fmt is None:
+        return open( filename, mode )
+
+    binary = "b" in mode
+    if mode.startswith( "r" ):
+        if fmt == "gzip":
+            stream = gzip.open( filename, "rb" )
+        else:
+            stream = io.BufferedReader( _zstandard().ZstdDecompressor().stream_reader( open( filename, "rb" ), read_across_frames = True, closefd = True ) )
+    elif mode.startswith( "w" ):
+        stream = CompressedWriter( filename, fmt, workers, level )
+    else:
+        raise ValueError( f"Unsupported mode '{mode}' for compressed files." )
+    return stream if binary else io.TextIOWrapper( stream )
+
+def decompress_stream( fileobj, fmt : str ):
+    """
+    Wraps an open binary file in a stream that decompresses it (the file is not closed with the stream).
+
+    Parameters
+    ----------
+    fileobj : file
+        The compressed file (opened in binary mode).
+    fmt : str
+        The compression format (`gzip` or `zstd`).
+
+    Returns
+    -------
+    file
+        The decompressed (binary) stream.
+    """
+    if fmt == "gzip":
+        return gzip.GzipFile( fileobj = fileobj, mode = "rb" )
+    return io.BufferedReader( _zstandard().ZstdDecompressor().stream_reader( fileobj, read_across_frames = True, closefd = False ) )
+
+def _zstandard():
+    """
+    Imports the optional `zstandard` package.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError( "Reading or writing zstd (.zst) files requires the `zstandard` package (`pip install zstandard`)." )
+    return zstandard
+
+
+class CompressedWriter( io.BufferedIOBase ):
+    """
+    A binary file that compresses its content on a pool of threads.
+
+    Parameters
+    ----------
+    filename : str
+        The output file.
+    fmt : str, optional
+        The compression format (`gzip` or `zstd`). The default is "gzip".
+    workers : int, optional
+        The number of compression threads. By default the number of CPUs (up to 8).
+    level : int, optional
+        The compression level. By default 1 (see `default_levels`).
+    blocksize : int, optional
+        The number of (uncompressed) bytes that are compressed at once. The default is 4 MB.
+    """
+    def __init__( self, filename : str, fmt : str = "gzip", workers : int = None, level : int = None, blocksize : int = default_blocksize ):
+        super().__init__()
+        if fmt not in default_levels:
+            raise ValueError( f"Unknown compression format '{fmt}'. Supported formats are: {list( default_levels )}" )
+        self.fmt = fmt
+        self.workers = max( workers if workers is not None else min( os.cpu_count() or 1, 8 ), 1 )
+        self.level = level if level is not None else default_levels[ fmt ]
+        self.blocksize = blocksize
+
+        self._file = open( filename, "wb" )
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._members = 0
+        if fmt == "zstd":
+            # zstd splits the input into jobs that are compressed by its own threads
+            compressor = _zstandard().ZstdCompressor( level = self.level, threads = self.workers if self.workers > 1 else 0 )
+            self._stream = compressor.stream_writer( self._file, closefd = False )
+            self._pool = None
+        else:
+            self._stream = None
+            self._pool = ThreadPoolExecutor( max_workers = self.workers )
+
+    def writable( self ) -> bool:
+        return True
+
+    def write( self, data ) -> int:
+        if self.closed:
+            raise ValueError( "write to closed file" )
+        if self._stream is not None:
+            self._stream.write( data )
+            return len( data )
+        self._buffer += data
+        if len( self._buffer ) >= self.blocksize:
+            self._submit()
+        return len( data )
+
+    def _submit( self ):
+        """
+        Compresses the buffered bytes as a gzip member (in a thread) and writes
+        the members that are done, keeping at most two blocks per thread in flight.
+        """
+        block = bytes( self._buffer )
+        self._buffer.clear()
+        self._pending.append( self._pool.submit( gzip.compress, block, self.level, mtime = 0 ) )
+        self._members += 1
+        while len( self._pending ) > 2 * self.workers:
+            self._file.write( self._pending.popleft().result() )
+
+    def close( self ):
+        if self.closed:
+            return
+        try:
+            if self._stream is not None:
+                self._stream.close()
+            else:
+                # an empty file still gets one (empty) member to be a valid gzip file
+                if self._buffer or not self._members:
+                    self._submit()
+                while self._pending:
+                    self._file.write( self._pending.popleft().result() )
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._file.close()
+            super().close()
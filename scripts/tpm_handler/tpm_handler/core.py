@@ -2,13 +2,26 @@
 Defines core functions for converting raw counts to TPM.
 """
 
+import shutil
 import subprocess
 import pandas as pd
 import numpy as np
-import re
-from alive_progress import alive_bar
+from scipy import sparse
 import logging
 
+from .sparse import SparseFrame, read_mtx, round_sparse
+from .gtf import read_gtf, is_gtf
+from .registry import gtf_lengths
+from .writer import write_table, choose_precision
+from .columnar import columnar_format, read_columnar, write_columnar
+from .store import is_store, MatrixStore, write_store
+from .engines import get_engine, scale_columns
+from .geneindex import GeneIndex, gene_index
+from .aggregate import aggregate_frame, aggregate_rows
+from .reader import read_array, probe_table
+from .sidecar import Sidecar, lengths_fingerprint
+from .compression import open_file
+
 # make a logger
 logger = logging.getLogger( name = "tpm_handler" )
 logger.setLevel( logging.INFO )
@@ -28,7 +41,14 @@ def call_gtftools( filename : str, output : str,  mode : str = "l" ):
     mode : str, optional
         The mode of the computation. The default is "l".
         Any valid gtftools mode is allowed.
+
+    Note
+    ----
+    gtftools is an optional dependency (`pip install tpm_handler[gtftools]`). 
+    The built-in engine (`compute_lengths`) does not require it.
     """
+    if shutil.which( "gtftools" ) is None:
+        raise RuntimeError( "gtftools is not installed. Install it using `pip install gtftools` (or use the built-in engine, i.e. `compute-length --engine native`)." )
     cmd = f"gtftools -{mode} {output} {filename}"
     subprocess.call( cmd, shell = True )
 
@@ -40,7 +60,7 @@ def add_gtf_gene_names( filename : str, outfile : str, swap_ids_and_names : bool
     Parameters
     ----------
     filename : str
-        The input GTF file.
+        The input GTF file (may be gzipped).
     outfile : str
         The output file.
     swap_ids_and_names : bool, optional
@@ -48,22 +68,22 @@ def add_gtf_gene_names( filename : str, outfile : str, swap_ids_and_names : bool
         If True then the Ids (1st column) and names (2nd column by default)
         will be swapped so that names are the 1st column and IDs are the 2nd column.
     """
-    orig = pd.read_csv( filename, sep = "\t", header = None, comment = "#", names = ["chr", "source", "type", "start", "end", "score", "strand", "phase", "attributes"] )
     sep = kwargs.get( "sep", "\t" )
     dest = pd.read_csv( outfile, sep = sep )
 
-    # now extract the gene names using regex and add as a data column...
-    pattern = re.compile( 'gene_name "([A-Za-z0-9-.]+)"' )
-    orig["gene_name"] = _match_regex_pattern( pattern, orig )
-    
-    # and do the same for the gene_ids
-    pattern = re.compile( 'gene_id "([A-Za-z0-9-.]+)"' )
-    orig["gene_id"] = _match_regex_pattern( pattern, orig )
+    # extract the gene names and ids of all genes in one go
+    # (GTFs without gene entries, e.g. from StringTie or UCSC, carry them on their transcripts or exons)
+    for feature in ( "gene", "transcript", "exon" ):
+        orig = read_gtf( filename, feature = feature, attributes = [ "gene_id", "gene_name" ] )
+        if len( orig ):
+            break
+        logger.info( f"No {feature} entries in {filename}, looking for the gene names of other entries..." )
 
     # and now merge the two dataframes
-    orig = orig[ ["gene_id", "gene_name"] ]
-    orig = orig.drop_duplicates()
+    orig = orig.drop_duplicates( "gene_id" )
     dest = dest.merge( orig, left_on = dest.columns[0], right_on = "gene_id" )
+    if dest.empty:
+        raise ValueError( f"None of the genes in {outfile} could be found in {filename}." )
     dest = dest.drop( columns = ["gene_id"] )
 
     # now reorder to place gene_names at second position because normalisation 
@@ -76,101 +96,47 @@ def add_gtf_gene_names( filename : str, outfile : str, swap_ids_and_names : bool
     dest = dest[ cols ]
 
     dest.to_csv( outfile, sep = sep, index = False )
-    
-
-def _match_regex_pattern( pattern : str, df : pd.DataFrame ):
-    """
-    Matches a regex pattern to a dataframe using it's "attributes" column.
-
-    Parameters
-    ----------
-    pattern : str
-        The regex pattern.
-    df : pd.DataFrame
-        The dataframe.
 
-    Returns
-    -------
-    list
-        The matched values.
-    """
-    matches = map( lambda x : re.search( pattern, x ), df["attributes"] )
-    matches = [ i.group(1) if i is not None else i for i in matches ]
-    return matches 
-
-def array_to_tpm( array : np.ndarray, lengths : np.ndarray ):
+def array_to_tpm( array : np.ndarray, lengths : np.ndarray, factors : np.ndarray = None, out : np.ndarray = None ):
     """
     Convert raw counts to TPM.
 
+    This is computed for the entire matrix at once by broadcasting the lengths 
+    over all columns (samples), without iterating over the columns and without 
+    a detour via log-space. It is the same as using the `tpm` engine.
+
     Parameters
     ----------
     array : np.ndarray
         The raw counts. As a 2D ndarray.
     lengths : np.ndarray
         The lengths of the features. As a 1D ndarray.
+    factors : np.ndarray, optional
+        The column sums of the length-normalised counts to scale each column by. 
+        By default these are computed from `array` itself. Providing them allows
+        to convert only a subset of rows (e.g. a chunk of a larger file). 
+    out : np.ndarray, optional
+        An array of the same shape as `array` to store the TPM values in.
+        This may also be `array` itself to convert the counts in place.
+        By default a new array is created.
 
     Returns
     -------
     np.ndarray
         The TPM values.
     """
-    
-    # first convert to log-scale
-    log_length = np.log( lengths )
-    tpm = np.log( array )
-
-    # now iterate over each column and convert to TPM
-    # and store the converted data
-    factor = np.log(10**6) 
-    iterations = np.arange( tpm.shape[1] )
-    with alive_bar( tpm.shape[1], title = "Converting to TPM" ) as bar:
-        for i in iterations:
-            col = tpm[:,i]
-            col = col - log_length
-
-            colsum = np.exp( col )
-            colsum = np.sum( colsum ) 
-            colsum = np.log( colsum )
-
-            tpm[:,i] = np.exp( col - colsum + factor )
-            bar()
-
-
-    # alternative without a for-loop:
-    # NOTE: Has some dimensionality broadcasting issues!!!
-    #       Would need fixing...
-    # # make the lengths array of the same shape as the raw counts.
-    # if len(lengths) != len(array):
-    #     raise IndexError( "The length of the lengths array does not match the length of the raw counts array." )
-    # lengths = np.column_stack( [lengths] * array.shape[1] )
-    
-    # # subtract the lengths from the raw counts.
-    # tpm = tpm - lengths
-
-    # # now get the column-sums of the counts
-    # colsums = np.exp( tpm )
-    # colsums = np.sum( colsums, axis = 1 ) 
-    # colsums = np.log( colsums )
-
-    # #and adjust the shape again to match
-    # colsums = np.row_stack( [colsums] * tpm.shape[1] )
-    # colsums = colsums.transpose()
-
-    # # and now normalise by the column sums and adjust per-million
-    # factor = np.log( 1e6 ) 
-    # tpm = np.exp( tpm - colsums + factor )
-    
+    tpm = scale_columns( array, lengths, factors, scale = 10**6, length_before = True, out = out )
     logger.debug( f"At the end of array_to_tpm {tpm.shape=}" )
     return tpm
 
 def round_tpm( tpm : np.ndarray, digits : int = 5 ):
     """
-    Rounds the TPM values to a certain number of digits.
+    Rounds the TPM values to a certain number of digits (in place).
 
     Parameters
     ----------
     tpm : np.ndarray
-        The TPM values.
+        The TPM values. As a 2D ndarray (or a sparse matrix).
     digits : int, optional
         The number of digits to round to. The default is 5.
 
@@ -179,16 +145,131 @@ def round_tpm( tpm : np.ndarray, digits : int = 5 ):
     np.ndarray
         The rounded TPM values.
     """
-    iterations = np.arange( tpm.shape[1] )
-    with alive_bar( tpm.shape[1], title = f"Rounding to {digits} digits" ) as bar:
-        for i in iterations:
-            col = tpm[:,i]
-            col = np.round( col, digits )
-            tpm[:,i] = col
-            bar()
-    logger.debug( f"At the end of round_tpm {tpm.shape=}" )
-    return tpm
+    if sparse.issparse( tpm ):
+        return round_sparse( tpm, digits )
+    return np.round( tpm, digits, out = tpm )
+
+def read_lengths( filename : str, which : str = None, id_col : str = None, name_col : str = None, sep : str = "\t", **kwargs ) -> pd.DataFrame:
+    """
+    Reads the lengths of features from a file.
+
+    Parameters
+    ----------
+    filename : str
+        The file containing the lengths of the features. 
+        Alternatively, a GTF file (`.gtf` or `.gtf.gz`) in which case the lengths are computed 
+        (or taken from the lengths registry if they were computed before).
+    which : str, optional
+        The column name of the lengths. The default is None (in which case the last column is used).
+        For GTF files this is the length mode (by default `merged`).
+    id_col : str, optional
+        The column name of the IDs. The default is None (in which case the first column is used).
+    name_col : str, optional
+        The column name of the (gene) names. The default is None (in which case the second column is used).
+    sep : str, optional
+        The separator of the file. The default is "\t".
+
+    Returns
+    -------
+    lengths : pandas.DataFrame
+        A dataframe with the IDs as index and two columns, the names and the lengths of the features.
+    """
+    if is_gtf( filename ):
+        return gtf_lengths( filename, which )
+
+    if id_col is None:
+        id_col = 0
+    kwargs[ "index_col" ] = kwargs.get( "index_col", id_col )
+    lengths = pd.read_csv( filename, sep = sep, comment = "#", **kwargs )
+
+    # get which names to extract from the lengths dataframe
+    if name_col is None:
+        name_col = 0 if id_col == 0 else 1            
+        name_col = lengths.columns[name_col]
+
+    # now only get a single length column from the lengths dataframe
+    if which is None:
+        which = lengths.columns[-1]
+    elif which not in lengths.columns:
+        raise ValueError( f"The column name '{which}' is not in the file {filename}" )
+
+    return lengths.loc[ :,[name_col, which] ]
+
+def index_name( counts : pd.DataFrame, lengths : pd.DataFrame ) -> str:
+    """
+    Gets the name to use for the index column. This will first check for an index 
+    name in the counts data and then for a name in the lengths data. 
+
+    Parameters
+    ----------
+    counts : pd.DataFrame
+        The counts data.
+    lengths : pd.DataFrame
+        The lengths data.
+
+    Returns
+    -------
+    str
+        The index name.
+    """
+    name = counts.index.name
+    if not name:
+        name = lengths.index.name
+        if not name:
+            logger.warning( "No index name could be identified! Will use `gene_id` as index name." )
+            name = "gene_id"
+    return name
+
+def parse_size( size : str ) -> int:
+    """
+    Parses a human-readable size such as `500M` or `50G` to bytes.
+
+    Parameters
+    ----------
+    size : str
+        The size. Supported units are K, M, G and T (powers of 1024). 
+        Without a unit the size is interpreted as bytes.
+
+    Returns
+    -------
+    int
+        The size in bytes.
+    """
+    size = str( size ).strip().upper().rstrip( "B" )
+    units = { "K" : 1024, "M" : 1024**2, "G" : 1024**3, "T" : 1024**4 }
+    if size and size[-1] in units:
+        return int( float( size[:-1] ) * units[ size[-1] ] )
+    return int( float( size ) )
 
+def _is_mtx( filename : str ) -> bool:
+    """
+    Checks if a file is in MatrixMarket format (based on its suffix).
+    """
+    return isinstance( filename, str ) and filename.endswith( ( ".mtx", ".mtx.gz" ) )
+
+def _compact_rows( array : np.ndarray, mask : np.ndarray ) -> np.ndarray:
+    """
+    Restricts a column-major array to a subset of rows in place (column by column).
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The array (column-major).
+    mask : np.ndarray
+        A boolean mask of the rows to keep.
+
+    Returns
+    -------
+    np.ndarray
+        A view of the first rows of the array that now hold the kept rows.
+    """
+    n = int( np.sum( mask ) )
+    if n == len( mask ):
+        return array
+    for i in range( array.shape[1] ):
+        col = array[ :,i ]
+        col[ :n ] = col[ mask ]
+    return array[ :n ]
 
 class Table(object):
     """
@@ -197,17 +278,173 @@ class Table(object):
     Parameters
     ----------
     filename : str
-        The input count table in TSV format.
+        The input count table in TSV format (or a sparse count matrix in MatrixMarket format,
+        or a columnar Parquet / Feather file, or a chunked HDF5 matrix store).
+    cache : bool or str, optional
+        Cache the parsed countTable (or load it from the cache if it was cached before). 
+        This can be a cache directory or True to use the default cache directory.
+        The default is None (no caching).
+    cache_size : int, optional
+        The maximum size of the cache in bytes. The default is 20 GB.
+    lean : bool, optional
+        Low-memory mode. The table owns a single contiguous float array which is filtered 
+        and normalised in place, and the original (pre-filtered) and raw (unnormalised) counts 
+        are not copied but re-read from the source file when accessed. The default is False.
+    samples : list, optional
+        Only read these samples (columns). By default all samples are read.
+        For columnar files the other samples are not decoded at all.
+    filters : Filters, optional
+        Filters for genes and samples (e.g. a minimum total count per gene) that are applied while
+        the table is read, so that the excluded genes and samples are never held in memory.
     """
-    def __init__( self, filename : str, **kwargs ):
-        self._src = filename
+    def __init__( self, filename : str, cache = None, cache_size : int = None, lean : bool = False, samples : list = None, filters = None, **kwargs ):
         kwargs[ "index_col" ] = kwargs.get( "index_col", 0 )
-        self._counts = self.read( filename, **kwargs )
+        if samples is not None:
+            kwargs[ "samples" ] = list( samples )
+        if filters is not None and filters.active:
+            kwargs[ "filters" ] = filters
+
+        counts = None
+        if cache and not _is_mtx( filename ) and not columnar_format( filename ) and not is_store( filename ):
+            from .cache import CountCache, default_max_bytes
+            cache = CountCache( 
+                                cache if isinstance( cache, str ) else None, 
+                                max_bytes = cache_size if cache_size is not None else default_max_bytes 
+                            )
+            counts = cache.load( filename, **kwargs )
+        else:
+            cache = None
+
+        array = None
+        if counts is None:
+            counts, array = self._read_owned( filename, **kwargs )
+            if cache is not None:
+                cache.store( filename, counts, **kwargs )
+
+        self._setup( counts, src = filename, lean = lean, array = array if lean else None )
+        self._read_kwargs = kwargs
+
+    @classmethod
+    def from_sparse( cls, matrix, ids, samples ) -> "Table":
+        """
+        Creates a Table from a sparse count matrix (features x samples).
+        The counts will remain sparse during normalisation.
+
+        Parameters
+        ----------
+        matrix : scipy.sparse.spmatrix
+            The raw counts. Preferably as a CSC matrix.
+        ids : list or pd.Index
+            The feature IDs.
+        samples : list or pd.Index
+            The sample names.
+
+        Returns
+        -------
+        Table
+            The new table.
+        """
+        table = cls.__new__( cls )
+        table._setup( SparseFrame( matrix, ids, samples ) )
+        return table
+
+    @classmethod
+    def from_array( cls, counts, gene_ids, sample_names, lean : bool = False ) -> "Table":
+        """
+        Creates a Table from an in-memory count matrix (features x samples) without copying it.
+
+        Parameters
+        ----------
+        counts : np.ndarray or scipy.sparse.spmatrix
+            The raw counts. Sparse matrices are passed on to `from_sparse`.
+        gene_ids : list or pd.Index
+            The feature IDs (a named pd.Index keeps its name as the index name).
+        sample_names : list or pd.Index
+            The sample names.
+        lean : bool, optional
+            Low-memory mode. If `counts` is a writeable, column-major float64 array it is normalised
+            in place (i.e. the array passed is overwritten), otherwise a column-major copy is made once.
+            The default is False.
+
+        Returns
+        -------
+        Table
+            The new table.
+        """
+        if sparse.issparse( counts ):
+            return cls.from_sparse( counts, gene_ids, sample_names )
+
+        array = np.asarray( counts )
+        if array.ndim != 2 or array.shape != ( len( gene_ids ), len( sample_names ) ):
+            raise ValueError( f"The shape of the counts {array.shape} does not match the gene IDs and sample names ({len( gene_ids )}, {len( sample_names )})." )
+        index = gene_ids if isinstance( gene_ids, pd.Index ) else pd.Index( gene_ids )
+        columns = sample_names if isinstance( sample_names, pd.Index ) else pd.Index( sample_names )
+
+        table = cls.__new__( cls )
+        table._setup( pd.DataFrame( array, index = index, columns = columns, copy = False ), lean = lean, array = array if lean else None )
+        return table
+
+    @classmethod
+    def from_frame( cls, df, lean : bool = False ) -> "Table":
+        """
+        Creates a Table from an in-memory countTable without copying it.
+
+        Parameters
+        ----------
+        df : pd.DataFrame or SparseFrame
+            The raw counts with the feature IDs as index and one column per sample. 
+            If the dataframe has a default (range) index, its first column is used as IDs
+            (i.e. the layout of a countTable file).
+        lean : bool, optional
+            Low-memory mode (see `from_array`). The default is False.
+
+        Returns
+        -------
+        Table
+            The new table.
+        """
+        if isinstance( df, SparseFrame ):
+            return cls.from_sparse( df.matrix, df.index, df.columns )
+        if isinstance( df.index, pd.RangeIndex ) and len( df.columns ) and not pd.api.types.is_numeric_dtype( df.iloc[ :,0 ] ):
+            df = df.set_index( df.columns[0] )
+        return cls.from_array( df.to_numpy(), df.index, df.columns, lean = lean )
+
+    def _setup( self, counts, src : str = None, lean : bool = False, array : np.ndarray = None ):
+        """
+        Sets up the table from already loaded counts.
+
+        Parameters
+        ----------
+        counts : pd.DataFrame or SparseFrame
+            The counts.
+        src : str, optional
+            The file from which the counts were loaded.
+        lean : bool, optional
+            Use the low-memory mode. The default is False.
+        array : np.ndarray, optional
+            The array that holds the counts (if available), which is adopted in 
+            low-memory mode if it is a writeable, column-major float array.
+        """
+        self._src = src
+        self._read_kwargs = {}
+        self._lean = lean and not isinstance( counts, SparseFrame )
+        self._array = None
+        if self._lean:
+            # convert to a single contiguous float array (column-major so each sample is contiguous)
+            array = array if array is not None and array.dtype == float else counts.to_numpy( dtype = float )
+            if not array.flags.f_contiguous or not array.flags.writeable:
+                array = np.array( array, order = "F" )
+            counts = self._wrap( array, counts.index, counts.columns )
+        self._counts = counts
+        self._row_mask = None
         self.tpm = None
         self._lengths = None
         self._raw_counts = None
         self._full_counts = None
         self._memorize = False
+        self._factors = {}
+        self._method = None
+        self._fingerprint = None
 
     def memorize( self ):
         """
@@ -215,39 +452,46 @@ class Table(object):
         """
         self._memorize = True
 
-    def normalise( self, digits : int = 5 ):
+    def normalise( self, digits : int = 5, workers : int = 1, method : str = "tpm" ):
         """
-        Normalise the raw counts to TPM.
+        Normalise the raw counts to TPM (or using another normalisation method).
 
         Parameters
         ----------
         digits : int, optional
             The number of digits to round to. The default is 5.
+            If None, the values are not rounded (e.g. if they are rounded while saving).
+        workers : int, optional
+            The number of processes to use for the conversion. The default is 1.
+            If more than one, the samples are split across a pool of processes 
+            that share the counts through shared memory.
+        method : str, optional
+            The normalisation method (engine) to use. The default is "tpm".
+            Available methods are `tpm`, `cpm`, `rpkm` and `fpkm`, optionally
+            prefixed by a transformation, such as `log1p-cpm` (see `tpm_handler.engines`).
         """
-        if not self._has_lengths:
+        engine = get_engine( method )
+        if engine.uses_lengths and not self._has_lengths:
             raise ValueError( "The table does not have lengths." )
 
-        # store the raw counts
-        if self._memorize:
+        # store the raw counts (in lean mode they are re-read when needed)
+        if self._memorize and not self._lean:
             self._raw_counts = self._counts.copy()
         
-        # convert to TPM
-        self.tpm = array_to_tpm( self.counts, self.lengths )
-        
-        # now round to the given number of digits
-        logger.info( "Rounding values..." )
-        self.tpm = self.round( digits )
+        # convert to TPM and round to the given number of digits
+        out = self._array if self._lean else None
+        self.tpm = self._apply( engine, self.counts, digits, workers, out = out )
+        self._method = engine.name
         
         # and now replace the raw counts in all 
         # columns that contain counts (i.e. all but the first)
         logger.debug( "Current values ")
         logger.debug( str( self._counts.head() ) )
         logger.info( "Replacing raw counts with TPM values..." )
-        new_df = pd.DataFrame( 
-                                    self.tpm, 
-                                    columns = self._counts.columns, 
-                                    index = self._counts.index 
-                            )
+        if self.is_sparse:
+            new_df = SparseFrame( self.tpm, columns = self._counts.columns, index = self._counts.index )
+        else:
+            new_df = self._wrap( self.tpm, self._counts.index, self._counts.columns )
 
         logger.debug( "New values")
         logger.debug( str( new_df.head() )  ) 
@@ -256,6 +500,62 @@ class Table(object):
         return self
 
     
+    def compute( self, method : str = "tpm", digits : int = None, workers : int = 1 ) -> np.ndarray:
+        """
+        Computes normalised values without replacing the counts of the table.
+        This allows to compute multiple normalisations from the same table.
+
+        Parameters
+        ----------
+        method : str, optional
+            The normalisation method (engine) to use. The default is "tpm".
+        digits : int, optional
+            The number of digits to round to. The default is None (no rounding).
+        workers : int, optional
+            The number of processes to use for the conversion. The default is 1.
+
+        Returns
+        -------
+        np.ndarray or scipy.sparse.csc_matrix
+            The normalised values.
+        """
+        engine = get_engine( method )
+        if engine.uses_lengths and not self._has_lengths:
+            raise ValueError( "The table does not have lengths." )
+
+        counts = self.counts
+        if self.tpm is not None:
+            if not self._memorize:
+                raise ValueError( "The table was already normalised. Use memorize() before normalising to compute other methods afterwards." )
+            counts = self.raw_counts
+        return self._apply( engine, counts, digits, workers )
+
+    def _apply( self, engine, counts, digits : int = None, workers : int = 1, out : np.ndarray = None ):
+        """
+        Applies a normalisation engine to counts and rounds the values.
+        """
+        lengths = self.lengths if self._has_lengths else None
+
+        # the scaling factors are kept (e.g. for the sidecar)
+        if workers > 1 and not self.is_sparse:
+            from .parallel import parallel_normalise
+            values, factors = parallel_normalise( counts, lengths, workers = workers, digits = digits, method = engine, out = out, return_factors = True )
+            self._factors[ engine.name ] = factors
+            return values
+
+        factors = engine.factors( counts, lengths )
+        self._factors[ engine.name ] = factors
+        if self.is_sparse:
+            values = engine.apply( counts, lengths, factors = factors )
+            if digits is not None:
+                values = round_sparse( values, digits )
+        else:
+            values = engine.apply( counts, lengths, factors = factors, out = out )
+            if digits is not None:
+                logger.info( "Rounding values..." )
+                np.round( values, digits, out = values )
+        return values
+
     def round(self, digits):
         """
         Round tpm values to a given number of digits.
@@ -265,16 +565,19 @@ class Table(object):
         digits : int
             The number of digits to round to.
         """
-        return round_tpm( self.tpm, digits )
+        self.tpm = round_tpm( self.tpm, digits )
+        return self.tpm
 
-    def set_lengths( self, filename : str, which : str = None, id_col : str = None, name_col : str = None, **kwargs ):
+    def set_lengths( self, filename : str, which : str = None, id_col : str = None, name_col : str = None, strip_versions : bool = True, **kwargs ):
         """
         Sets the lengths of the features.
 
         Parameters
         ----------
-        filename : str
-            The file containing the lengths of the features.
+        filename : str or pd.DataFrame
+            The file containing the lengths of the features. 
+            Alternatively, lengths that were already read using `read_lengths` 
+            (in which case the other arguments are ignored).
         which : str, optional
             The column name of the lengths. The default is None (in which case the last column is used).
         id_col : str, optional
@@ -283,64 +586,56 @@ class Table(object):
             The column name of the (gene) names. The default is None (in which case the second column is used).
             Note, even if your datafile does not specify gene names a "name column" will still be extracted. 
             However, you can adjust not to include the column later for saving the TPM-converted file.
+        strip_versions : bool, optional
+            Match the IDs of the counts and lengths irrespective of their Ensembl versions 
+            (e.g. `ENSG00000000003.15` and `ENSG00000000003`). The default is True.
         """
         
-        # store the original data
-        if self._memorize:
+        # store the original data (in lean mode it is re-read when needed)
+        if self._memorize and not self._lean:
             self._full_counts = self._counts.copy()
 
-        # get only the relevant subset of lengths for the actually present features
-        if id_col is None:
-            id_col = 0
-        kwargs[ "index_col" ] = kwargs.get( "index_col", id_col )
-
-        lengths = self.read( filename, **kwargs )
+        if isinstance( filename, pd.DataFrame ):
+            lengths = filename
+        else:
+            lengths = read_lengths( filename, which = which, id_col = id_col, name_col = name_col, **kwargs )
+        source = lengths
 
         # check if we have a specified name for the index column
-        # this will first check for an index name in the counts data
-        # and then for a name in the lengths data. It will overwrite the 
-        # current index name in both dataframes with the specified name.
-        index_name = self._counts.index.name
-        if not index_name:
-            index_name = lengths.index.name
-            if not index_name:
-                logger.warning( "No index name could be identified! Will use `gene_id` as index name." )
-                index_name = "gene_id"
+        # It will overwrite the current index name in both dataframes 
+        # with the specified name.
+        name = index_name( self._counts, lengths )
 
         # get all the currently held ids in the countTable
         # and mask the data to only those gene to which reference 
         # lengths are available, and therefore TPMs can be calculated.
         logger.debug( "Before masking:", len( lengths ) )
 
-        mask_lengths = lengths.index.isin( self._counts.index )
-        mask_counts = self._counts.index.isin( lengths.index )
-
-        lengths = lengths.iloc[ mask_lengths,: ]
-        self._counts = self._counts.iloc[ mask_counts,: ]
+        # the gene index of the lengths is built only once (and re-used 
+        # if the same lengths are set for multiple tables) 
+        idx = gene_index( lengths, strip_versions ).join( self._counts.index )
+        mask_counts = idx >= 0
+        if not mask_counts.any():
+            raise ValueError( f"No features in {self._src or 'the table'} have a corresponding length!" )
+
+        # this also sorts to ensure the same order is preserved
+        # (the IDs of the counts are kept, including their versions)
+        lengths = lengths.iloc[ idx[ mask_counts ],: ]
+        self._row_mask = mask_counts
+        if self._lean:
+            array = _compact_rows( self._array, mask_counts )
+            self._counts = self._wrap( array, self._counts.index[ mask_counts ], self._counts.columns )
+        else:
+            self._counts = self._counts.iloc[ mask_counts,: ]
 
         logger.debug( "After masking:", len( lengths ) )
 
-        # and now sort to ensure the same order is preserved
-        lengths = lengths.reindex( index = self._counts.index )
-
-        lengths.index.name = index_name
-        self._counts.index.name = index_name
+        lengths.index = self._counts.index.copy()
+        lengths.index.name = name
+        self._counts.index.name = name
 
-
-        # get which names to extract from the lengths dataframe
-        if name_col is None:
-            name_col = 0 if id_col == 0 else 1            
-            name_col = lengths.columns[name_col]
-
-        # now only get a single length column from the lengths dataframe
-        if which is None:
-            which = lengths.columns[-1]
-        elif which not in lengths.columns:
-            raise ValueError( f"The column name '{which}' is not in the file {filename}" )
-        
-        # and finally restrict our length data to only the name and lengths column
-        # as well as the index which holds the ids...
-        self._lengths = lengths.loc[ :,[name_col, which] ]
+        self._lengths = lengths
+        self._fingerprint = lengths_fingerprint( source )
         return self
     
     def get_lengths( self ): 
@@ -365,65 +660,252 @@ class Table(object):
         """
         return self._counts
 
-    def read( self, filename : str, sep : str = "\t", **kwargs ) -> pd.DataFrame: 
+    def read( self, filename : str, sep : str = "\t", samples : list = None, dtype = np.float64, engine : str = None, filters = None, **kwargs ) -> pd.DataFrame: 
         """
         Reads a table from a file.
 
         Parameters
         ----------
         filename : str
-            The input file.
+            The input file. MatrixMarket files (`.mtx`) are read as sparse tables.
+            Parquet (`.parquet`) and Feather (`.feather`) files are read using pyarrow.
+            The counts of matrix stores (`.h5`) are read using h5py.
         sep : str, optional
             The separator of the table. The default is "\t".
+        samples : list, optional
+            Only read these samples (columns). By default all samples are read.
+        dtype : type, optional
+            The dtype of the counts of TSV files (e.g. float32 or int32 to halve the memory). The default is float64.
+        engine : str, optional
+            The parser for TSV files, either `pyarrow` (multithreaded) or `c` (pandas).
+            By default pyarrow is used if it is available.
+        filters : Filters, optional
+            Filters for genes and samples. For TSV files read by pyarrow they are applied before
+            the counts are copied, for other files after reading.
 
         Returns
         -------
-        df : pandas.DataFrame
+        df : pandas.DataFrame or SparseFrame
             The table.
         """
+        return self._read_owned( filename, sep, samples, dtype, engine, filters, **kwargs )[0]
+
+    def _read_owned( self, filename : str, sep : str = "\t", samples : list = None, dtype = np.float64, engine : str = None, filters = None, **kwargs ) -> tuple:
+        """
+        Reads a table from a file (see `read`), together with the array that holds its counts 
+        if the array is owned by the table (i.e. not a view of data held by pandas) and None otherwise.
+        """
+        # the typed reader covers the default layout (IDs in the first column)
+        if not _is_mtx( filename ) and not columnar_format( filename ) and not is_store( filename ):
+            if kwargs.get( "index_col", 0 ) == 0 and not set( kwargs ).difference( [ "index_col" ] ):
+                logger.info( f"Reading input file... (this may take a while)" )
+                array, index, columns = read_array( filename, sep = sep, samples = samples, dtype = dtype, engine = engine, filters = filters )
+                return pd.DataFrame( array, index = index, columns = columns, copy = False ), array
+
+        counts = self._read( filename, sep = sep, samples = samples, **kwargs )
+        if filters is not None and filters.active:
+            counts = filters.apply( counts )
+        return counts, None
+
+    def _read( self, filename : str, sep : str = "\t", samples : list = None, **kwargs ) -> pd.DataFrame:
+        """
+        Reads a table from a file (without the typed reader, see `read`).
+        """
         logger.info( f"Reading input file... (this may take a while)" )
+        if _is_mtx( filename ):
+            counts = read_mtx( filename )
+            if samples is not None:
+                idx = counts.columns.get_indexer( samples )
+                counts = SparseFrame( counts.matrix[ :, idx ], counts.index, counts.columns[ idx ] )
+            return counts
+        if columnar_format( filename ):
+            return read_columnar( filename, samples = samples )
+        if is_store( filename ):
+            with MatrixStore( filename ) as store:
+                return store.get( samples = samples )
+
+        probe = probe_table( filename, sep, count_rows = False )
+        if samples is not None:
+            kwargs[ "usecols" ] = [ probe[ "index_name" ] ] + list( samples )
         df = pd.read_csv( 
                             filename, 
                             sep = sep, 
-                            comment = "#", 
+                            skiprows = probe[ "skiprows" ], 
                             **kwargs
                         ) 
         return df
 
-    def save( self, filename : str, use_names : bool = False ): 
+    def save( self, filename : str, use_names : bool = False, digits : int = None, workers : int = 1, max_bytes : int = None, values = None, columnar_compression : str = "zstd", aggregate : str = None, sidecar : bool = False, method : str = None ): 
         """
         Saves the table to a file.
 
         Parameters
         ----------
         filename : str
-            The output file.
+            The output file. Files ending in `.parquet` or `.feather` are written in
+            the respective columnar format (as float32) instead of TSV, and files ending 
+            in `.h5` are written as a chunked matrix store.
         use_names : bool
             Save the file with gene_names instead of gene_ids in the first column.
-        
+        digits : int, optional
+            Write the values at a fixed precision of this many digits (this rounds the values
+            while writing, so the table does not need to be rounded before). By default the values
+            are written as they are.
+        workers : int, optional
+            The number of processes used to format the values when writing at a fixed precision. The default is 1.
+        max_bytes : int, optional
+            A size limit for the output file. If provided, the highest precision (up to `digits`, by default 5) 
+            at which the file is estimated to stay within the limit is used.
+        values : np.ndarray, optional
+            Other values to save instead of the table's counts (e.g. as returned by `compute`). 
+            These must match the table's features and samples. 
+        columnar_compression : str, optional
+            The internal compression of columnar (parquet or feather) files (e.g. `zstd`, `lz4` or None). The default is `zstd`.
+            Text files are compressed according to their suffix (`.gz` or `.zst`) instead.
+        aggregate : str, optional
+            If `use_names`, aggregate the rows of features that share the same name (`sum`, `max` or `mean`)
+            in the saved file. By default duplicate names are kept as separate rows.
+        sidecar : bool, optional
+            Also save the scaling factors, gene order and lengths fingerprint in a sidecar file
+            (`<filename>.factors.npz`), which allows to re-export the file without recomputing it (see `sidecar`).
+        method : str, optional
+            The normalisation method of `values` (for the sidecar). By default the method of the last normalisation.
         """
         logger.info( "Saving to file... (this may take a while)" )
         if use_names:
             self.adopt_name_index()
-        self._counts.to_csv( filename, sep = "\t", index = True )
+
+        counts = self._counts
+        if values is not None:
+            counts = SparseFrame( values, counts.index, counts.columns ) if self.is_sparse else pd.DataFrame( values, index = counts.index, columns = counts.columns, copy = False )
+        if use_names and aggregate is not None:
+            counts = aggregate_frame( counts, aggregate )
+
+        if columnar_format( filename ):
+            array = counts.to_numpy()
+            write_columnar( filename, array, counts.index, counts.columns, index_name = counts.index.name, digits = digits, compression = columnar_compression )
+        elif is_store( filename ):
+            array = counts.to_numpy()
+            write_store( filename, np.round( array, digits ) if digits is not None and not self.is_sparse else array, counts.index, counts.columns, index_name = counts.index.name )
+        elif digits is None and max_bytes is None:
+            with open_file( filename, "w", workers = workers ) as f:
+                counts.to_csv( f, sep = "\t", index = True )
+        else:
+            array = counts.to_numpy()
+            array = array.tocsr() if self.is_sparse else array
+            index = counts.index
+            if max_bytes is not None:
+                digits = choose_precision( array, index, max_bytes, columns = counts.columns, max_digits = digits if digits is not None else 5 )
+            write_table( filename, array, index, counts.columns, index_name = index.name, digits = digits, workers = workers )
+        if sidecar:
+            self._save_sidecar( filename, counts, method, digits, aggregated = use_names and aggregate is not None )
         logger.info( f"Saved to file: {filename}" )
         return self
 
-    def adopt_name_index( self ):
+    def _save_sidecar( self, filename : str, counts, method : str, digits : int, aggregated : bool = False ):
+        """
+        Saves the sidecar of a saved table.
+        """
+        method = method if method is not None else self._method
+        if method is None or method not in self._factors:
+            raise ValueError( "The table was not normalised, so there are no scaling factors to save." )
+        lengths = self.lengths if self._has_lengths and not aggregated else None
+        Sidecar( method, self._factors[ method ], counts.columns, counts.index, lengths, self._fingerprint, digits ).write( filename )
+
+    def adopt_name_index( self, aggregate : str = None ):
         """
         Adopts the extracted name column of the lengths dataframe as the new 
         dataframe index for both the lengths and counts data.
+        Features without a name keep their ID.
+
+        Parameters
+        ----------
+        aggregate : str, optional
+            Aggregate the rows of features that share the same name (`sum`, `max` or `mean`).
+            By default duplicate names are kept as separate rows.
 
         Note
         ----
         This will only affect the raw and final counts (in TPM if normalise has been called),
         but it will not affect the original counts!
         """
-        index = self._lengths.iloc[:,0]
+        index = self._name_index()
         self._counts.index = index
         self._lengths.index = index
-        self._raw_counts.index = index
+        if self._raw_counts is not None:
+            self._raw_counts.index = index
+
+        if aggregate is not None:
+            counts = aggregate_frame( self._counts, aggregate )
+            if self._lean and not self.is_sparse:
+                counts = self._wrap( counts.to_numpy(), counts.index, counts.columns )
+            self._counts = counts
+            self._lengths = self._lengths[ ~self._lengths.index.duplicated() ]
+            if self.tpm is not None:
+                self.tpm = counts.to_numpy()
+            if self._raw_counts is not None:
+                self._raw_counts = aggregate_frame( self._raw_counts, aggregate )
+
+
+    def _name_index( self ) -> pd.Index:
+        """
+        Gets the names of the features as an index (features without a name keep their ID).
+        """
+        if not self._has_lengths:
+            raise ValueError( "The table does not have lengths (and therefore no names)." )
+        names = self._lengths.iloc[:,0]
+        return pd.Index( names.where( names.notna(), self._counts.index.to_numpy() ), name = self._counts.index.name )
+
+    def to_array( self, use_names : bool = False, aggregate : str = None ) -> tuple:
+        """
+        Hands on the (normalised) counts as an array together with their index, without copying them.
+        This allows to pass the values on to other tools without writing and re-reading a file.
+
+        Parameters
+        ----------
+        use_names : bool, optional
+            Index the features by their names instead of their IDs. The table itself is not changed.
+        aggregate : str, optional
+            If `use_names`, aggregate the rows of features that share the same name (`sum`, `max` or `mean`).
+            Note, this creates a new array.
+
+        Returns
+        -------
+        array : np.ndarray or scipy.sparse.csc_matrix
+            The values (features x samples). This is a view of the table's values 
+            (read-only unless the table is in low-memory mode).
+        index : pd.Index
+            The IDs (or names) of the features.
+        columns : pd.Index
+            The sample names.
+        """
+        index = self._name_index() if use_names else self._counts.index
+        array = self.counts
+        if use_names and aggregate is not None:
+            array, index = aggregate_rows( array, index, aggregate )
+        return array, index, self._counts.columns
 
+    def to_frame( self, use_names : bool = False, aggregate : str = None ) -> pd.DataFrame:
+        """
+        Hands on the (normalised) counts as a dataframe, without copying them.
+
+        Parameters
+        ----------
+        use_names : bool, optional
+            Index the features by their names instead of their IDs. The table itself is not changed.
+        aggregate : str, optional
+            If `use_names`, aggregate the rows of features that share the same name (`sum`, `max` or `mean`).
+            Note, this creates a new array.
+
+        Returns
+        -------
+        pd.DataFrame or SparseFrame
+            The values with the feature IDs (or names) as index and one column per sample.
+        """
+        array, index, columns = self.to_array( use_names, aggregate )
+        if self.is_sparse:
+            return SparseFrame( array, index, columns )
+        return pd.DataFrame( array, index = index, columns = columns, copy = False )
 
     @property
     def raw_data( self ):
@@ -440,6 +922,8 @@ class Table(object):
         raw_data : pandas.DataFrame
             The originally provided counts data.
         """
+        if self._full_counts is None and self._lean and self._memorize:
+            return self._reread()
         return self._full_counts
 
     @property
@@ -460,6 +944,10 @@ class Table(object):
             The raw counts.
         """
         if self._raw_counts is None:
+            if self._lean and self._memorize and self.tpm is not None:
+                raw = self._reread()
+                raw = raw.iloc[ self._row_mask,: ] if self._row_mask is not None else raw
+                return raw.to_numpy()
             return self.counts
         return self._raw_counts.to_numpy()
     
@@ -477,9 +965,11 @@ class Table(object):
 
         Returns
         -------
-        counts : np.ndarray
+        counts : np.ndarray or scipy.sparse.csc_matrix
             The raw or TPM counts.
         """
+        if self._lean:
+            return self._array
         return self._counts.to_numpy()
 
 
@@ -519,6 +1009,36 @@ class Table(object):
         """
         return self._lengths.iloc[ :,-1 ].to_numpy()
 
+    def _wrap( self, array : np.ndarray, index, columns ) -> pd.DataFrame:
+        """
+        Wraps an array in a dataframe without copying it. 
+        In lean mode the array becomes the table's array.
+        """
+        if self._lean:
+            self._array = array
+        return pd.DataFrame( array, index = index, columns = columns, copy = False )
+
+    def _reread( self ) -> pd.DataFrame:
+        """
+        Re-reads the original counts from the source file.
+        """
+        if self._src is None:
+            raise ValueError( "The table was not read from a file, so the original counts cannot be re-read." )
+        logger.info( f"Re-reading original counts from {self._src}..." )
+        return self.read( self._src, **self._read_kwargs )
+
+    @property
+    def is_sparse( self ) -> bool:
+        """
+        Checks if the table holds sparse counts.
+
+        Returns
+        -------
+        is_sparse : bool
+            True if the counts are stored as a sparse matrix.
+        """
+        return isinstance( self._counts, SparseFrame )
+
     @property
     def _has_lengths(self): 
         """
@@ -544,6 +1064,8 @@ class Table(object):
         return df.columns[1:]
 
     def __repr__(self) -> str:
+        if self._src is None:
+            return f"Table({len( self._counts )} features x {len( self._counts.columns )} samples)"
         return f"Table(file='{self._src}')"
     
     def __str__(self) -> str:
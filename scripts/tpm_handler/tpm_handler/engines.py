@@ -0,0 +1,312 @@
+"""
+Defines the normalisation engines (methods) that can be used to normalise countTables.
+
+All engines share the same column-scaling kernel: the counts of each sample (column) are optionally
+divided by the feature lengths, scaled by the column sums (the "scaling factors") and a constant, and
+are then optionally divided by the feature lengths and/or transformed. The following engines are available:
+
+- `tpm` | transcripts per million (length-normalised counts scaled to a sum of one million per sample)
+- `cpm` | counts per million (counts scaled to a sum of one million per sample)
+- `rpkm` / `fpkm` | reads (fragments) per kilobase per million
+
+Each engine can be combined with a transformation by prefixing it, e.g. `log1p-cpm` or `log2p1-tpm`.
+"""
+
+import numpy as np
+
+from .sparse import sparse_scale_columns
+
+block_size = 2**22
+"""
+The number of values per block when computing the scaling factors of length-normalised counts (4M values, 32 MB).
+"""
+
+
+def column_sums( array : np.ndarray ):
+    """
+    Computes the sums of each column (sample) of a 2D array.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The 2D array.
+
+    Returns
+    -------
+    np.ndarray
+        The column sums. As a 1D ndarray.
+    """
+    return np.sum( array, axis = 0, dtype = float )
+
+def scale_columns( array : np.ndarray, lengths : np.ndarray = None, factors : np.ndarray = None, scale : float = 10**6, length_before : bool = True, length_after : bool = False, out : np.ndarray = None ):
+    """
+    The column-scaling kernel shared by all engines.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The raw counts. As a 2D ndarray.
+    lengths : np.ndarray, optional
+        The lengths of the features. As a 1D ndarray. Only required if `length_before` or `length_after`.
+    factors : np.ndarray, optional
+        The column sums to scale each column by. By default these are computed from `array` itself
+        (after dividing by the lengths if `length_before`).
+    scale : float, optional
+        The value each column is scaled to sum up to. The default is one million.
+    length_before : bool, optional
+        Divide the counts by the lengths before scaling. The default is True.
+    length_after : bool, optional
+        Divide the scaled values by the lengths. The default is False.
+    out : np.ndarray, optional
+        An array to store the values in (may be `array` itself). By default a new array is created.
+
+    Returns
+    -------
+    np.ndarray
+        The scaled values.
+    """
+    if length_before or length_after:
+        lengths = np.asarray( lengths, dtype = float )
+        if len(lengths) != len(array):
+            raise IndexError( "The length of the lengths array does not match the length of the raw counts array." )
+
+    if length_before:
+        values = np.divide( array, lengths[ :, None ], out = out )
+    elif out is not None:
+        values = np.multiply( array, 1.0, out = out )
+    else:
+        values = np.array( array, dtype = float )
+
+    # columns without any counts will end up as NaNs
+    if factors is None:
+        factors = column_sums( values )
+    with np.errstate( divide = "ignore", invalid = "ignore" ):
+        np.divide( values, factors / scale, out = values )
+
+    if length_after:
+        np.divide( values, lengths[ :, None ], out = values )
+    return values
+
+
+class Engine:
+    """
+    A normalisation engine (method).
+
+    Parameters
+    ----------
+    name : str
+        The name of the engine.
+    scale : float, optional
+        The value each column is scaled to sum up to. The default is one million.
+    length_before : bool, optional
+        Divide the counts by the lengths before scaling. The default is False.
+    length_after : bool, optional
+        Divide the scaled values by the lengths. The default is False.
+    transform : callable, optional
+        A function to (elementwise and in place) transform the values after scaling,
+        taking the values and an `out` argument (such as `np.log1p`).
+    inverse : callable, optional
+        The inverse of `transform` (such as `np.expm1`), to restore the counts from normalised values.
+    """
+    def __init__( self, name : str, scale : float = 10**6, length_before : bool = False, length_after : bool = False, transform = None, inverse = None ):
+        self.name = name
+        self.scale = scale
+        self.length_before = length_before
+        self.length_after = length_after
+        self.transform = transform
+        self.inverse = inverse
+
+    @property
+    def factor_kind( self ) -> str:
+        """
+        The kind of scaling factors this engine requires. Engines with the same kind share their factors.
+        Either `rates` (column sums of length-normalised counts) or `counts` (column sums of the counts).
+        """
+        return "rates" if self.length_before else "counts"
+
+    @property
+    def uses_lengths( self ) -> bool:
+        """
+        Whether the engine requires the lengths of the features.
+        """
+        return self.length_before or self.length_after
+
+    def factors( self, array : np.ndarray, lengths : np.ndarray = None ) -> np.ndarray:
+        """
+        Computes the scaling factors of each column.
+
+        Parameters
+        ----------
+        array : np.ndarray
+            The raw counts. As a 2D ndarray (or a subset of rows, to accumulate the factors).
+        lengths : np.ndarray, optional
+            The lengths of the features.
+
+        Returns
+        -------
+        np.ndarray
+            The scaling factors.
+        """
+        if hasattr( array, "tocsc" ):
+            array = array.tocsc()
+            if self.length_before:
+                array = array.multiply( 1 / np.asarray( lengths, dtype = float )[ :, None ] )
+            return np.asarray( array.sum( axis = 0 ), dtype = float ).ravel()
+        if self.length_before:
+            # divide a block of columns at a time so only a block-sized temporary array is needed
+            lengths = np.asarray( lengths, dtype = float )[ :, None ]
+            step = max( 1, block_size // max( len( array ), 1 ) )
+            sums = [ column_sums( array[ :,i:i + step ] / lengths ) for i in range( 0, array.shape[1], step ) ]
+            return np.concatenate( sums ) if sums else np.zeros( 0 )
+        return column_sums( array )
+
+    def apply( self, array : np.ndarray, lengths : np.ndarray = None, factors : np.ndarray = None, out : np.ndarray = None ) -> np.ndarray:
+        """
+        Normalises raw counts.
+
+        Parameters
+        ----------
+        array : np.ndarray
+            The raw counts. As a 2D ndarray (or a scipy.sparse matrix).
+        lengths : np.ndarray, optional
+            The lengths of the features.
+        factors : np.ndarray, optional
+            The scaling factors. By default these are computed from `array` itself.
+        out : np.ndarray, optional
+            An array to store the values in (may be `array` itself). By default a new array is created.
+
+        Returns
+        -------
+        np.ndarray
+            The normalised values (sparse if `array` is sparse).
+        """
+        if hasattr( array, "tocsc" ):
+            values = sparse_scale_columns( array, lengths, factors, self.scale, self.length_before, self.length_after )
+            if self.transform is not None:
+                self.transform( values.data, out = values.data )
+            return values
+
+        values = scale_columns( array, lengths, factors, self.scale, self.length_before, self.length_after, out = out )
+        if self.transform is not None:
+            self.transform( values, out = values )
+        return values
+
+    def invert( self, values : np.ndarray, lengths : np.ndarray = None, factors : np.ndarray = None, out : np.ndarray = None ) -> np.ndarray:
+        """
+        Restores the raw counts from normalised values (the inverse of `apply`).
+
+        Parameters
+        ----------
+        values : np.ndarray
+            The normalised values. As a 2D ndarray (or a subset of rows).
+        lengths : np.ndarray, optional
+            The lengths of the features. Only required if the engine uses lengths.
+        factors : np.ndarray
+            The scaling factors the values were normalised with.
+        out : np.ndarray, optional
+            An array to store the counts in (may be `values` itself). By default a new array is created.
+
+        Returns
+        -------
+        np.ndarray
+            The raw counts.
+        """
+        if factors is None:
+            raise ValueError( "The scaling factors are required to restore the counts." )
+        if self.transform is not None and self.inverse is None:
+            raise ValueError( f"The transformation of the '{self.name}' engine can not be inverted." )
+        if self.uses_lengths:
+            lengths = np.asarray( lengths, dtype = float )[ :, None ]
+
+        if self.inverse is not None:
+            counts = self.inverse( values, out = out )
+        else:
+            counts = np.multiply( values, 1.0, out = out )
+        if self.length_after:
+            np.multiply( counts, lengths, out = counts )
+        np.multiply( counts, np.asarray( factors, dtype = float ) / self.scale, out = counts )
+        if self.length_before:
+            np.multiply( counts, lengths, out = counts )
+        return counts
+
+    def __repr__( self ) -> str:
+        return f"Engine(name='{self.name}')"
+
+
+def _log2p( values, out = None ):
+    """
+    Computes log2( x + 1 ).
+    """
+    values = np.add( values, 1, out = out )
+    return np.log2( values, out = values )
+
+def _exp2m1( values, out = None ):
+    """
+    Computes 2^x - 1 (the inverse of `_log2p`).
+    """
+    values = np.exp2( values, out = out )
+    return np.subtract( values, 1, out = values )
+
+transforms = {
+                "log1p" : np.log1p,
+                "log2p1" : _log2p,
+            }
+"""
+The transformations that can be combined with an engine (as a prefix, e.g. `log1p-cpm`).
+`log1p` is the natural log( x + 1 ) and `log2p1` is log2( x + 1 ).
+"""
+
+inverse_transforms = {
+                        "log1p" : np.expm1,
+                        "log2p1" : _exp2m1,
+                    }
+"""
+The inverses of the transformations.
+"""
+
+engines = {}
+"""
+The registered normalisation engines.
+"""
+
+def register_engine( engine : Engine ):
+    """
+    Registers a normalisation engine so it can be used by its name.
+
+    Parameters
+    ----------
+    engine : Engine
+        The engine.
+    """
+    engines[ engine.name ] = engine
+
+def get_engine( method : str ) -> Engine:
+    """
+    Gets a normalisation engine by its name (optionally prefixed by a transformation, e.g. `log1p-cpm`).
+
+    Parameters
+    ----------
+    method : str
+        The name of the engine.
+
+    Returns
+    -------
+    Engine
+        The engine.
+    """
+    if isinstance( method, Engine ):
+        return method
+    if method in engines:
+        return engines[ method ]
+
+    transform, _, name = method.partition( "-" )
+    if transform not in transforms or name not in engines:
+        raise ValueError( f"Unknown normalisation method '{method}'. Available methods are: {list( engines.keys() )} (optionally prefixed by one of {list( transforms.keys() )}, e.g. 'log1p-cpm')." )
+    base = engines[ name ]
+    return Engine( method, base.scale, base.length_before, base.length_after, transforms[ transform ], inverse_transforms[ transform ] )
+
+
+register_engine( Engine( "tpm", scale = 10**6, length_before = True ) )
+register_engine( Engine( "cpm", scale = 10**6 ) )
+register_engine( Engine( "rpkm", scale = 10**9, length_after = True ) )
+register_engine( Engine( "fpkm", scale = 10**9, length_after = True ) )
@@ -0,0 +1,216 @@
+"""
+Defines pre-normalisation filters for genes and samples.
+
+Low-expressed genes and low-depth samples are frequently removed before any downstream analysis. Instead of
+loading and normalising the full matrix first, the filters are applied while the countTable is read: the
+rows and columns of the parsed table are checked before they are copied into the counts array, so excluded
+genes and samples are never materialised (and they do not contribute to the scaling factors). The filters are
+applied in the following order:
+
+1. `allowlist` | only the genes in an allowlist are kept (matched irrespective of their Ensembl versions)
+2. `min_detected` | only samples with at least this many detected genes (non-zero counts among the allowed genes) are kept
+3. `min_gene_total` | only genes with a total count (across the kept samples) of at least this value are kept
+"""
+
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .geneindex import GeneIndex
+from .sparse import SparseFrame
+
+logger = logging.getLogger( "tpm_handler" )
+
+
+def read_allowlist( filename : str ) -> list:
+    """
+    Reads a gene allowlist (one gene ID per line, in the first column; lines starting with `#` are skipped).
+
+    Parameters
+    ----------
+    filename : str
+        The allowlist file.
+
+    Returns
+    -------
+    list
+        The gene IDs.
+    """
+    genes = []
+    with open( filename, "r" ) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith( "#" ):
+                genes.append( line.split()[0] )
+    return genes
+
+
+class Filters:
+    """
+    Filters for genes and samples that are applied while reading a countTable.
+
+    Parameters
+    ----------
+    min_gene_total : float, optional
+        Only keep genes with at least this total count across the (kept) samples.
+    min_detected : int, optional
+        Only keep samples with at least this many detected genes (genes with non-zero counts).
+    allowlist : list or str, optional
+        Only keep these genes. Either a list of gene IDs or a file with one gene ID per line.
+    strip_versions : bool, optional
+        Match the allowlist irrespective of Ensembl versions. The default is True.
+    """
+    def __init__( self, min_gene_total : float = None, min_detected : int = None, allowlist = None, strip_versions : bool = True ):
+        self.min_gene_total = min_gene_total
+        self.min_detected = min_detected
+        if isinstance( allowlist, str ):
+            allowlist = read_allowlist( allowlist )
+        self.allowlist = GeneIndex( allowlist, strip_versions ) if allowlist is not None else None
+
+    @property
+    def active( self ) -> bool:
+        """
+        Whether any filter is set.
+        """
+        return self.min_gene_total is not None or self.min_detected is not None or self.allowlist is not None
+
+    def allowed( self, ids ) -> np.ndarray:
+        """
+        Checks which genes are part of the allowlist.
+
+        Parameters
+        ----------
+        ids : list or pd.Index
+            The gene IDs.
+
+        Returns
+        -------
+        np.ndarray
+            A boolean mask of the allowed genes (all True without an allowlist).
+        """
+        if self.allowlist is None:
+            return np.ones( len( ids ), dtype = bool )
+        return self.allowlist.join( ids, report = False ) >= 0
+
+    def select( self, ids, n_columns : int, column ) -> tuple:
+        """
+        Selects the genes and samples to keep, reading one column at a time.
+
+        Parameters
+        ----------
+        ids : list or pd.Index
+            The gene IDs (rows).
+        n_columns : int
+            The number of samples (columns).
+        column : callable
+            A function that returns the counts of the i-th sample (as a 1D array).
+
+        Returns
+        -------
+        rows : np.ndarray
+            A boolean mask of the genes to keep.
+        columns : np.ndarray
+            A boolean mask of the samples to keep.
+        """
+        rows = self.allowed( ids )
+        columns = np.ones( n_columns, dtype = bool )
+        totals = np.zeros( len( rows ) ) if self.min_gene_total is not None else None
+        for i in range( n_columns ):
+            if self.min_detected is None and totals is None:
+                break
+            values = column( i )
+            if self.min_detected is not None:
+                columns[i] = np.count_nonzero( values[ rows ] ) >= self.min_detected
+            if totals is not None and columns[i]:
+                totals += values
+        if totals is not None:
+            rows &= totals >= self.min_gene_total
+
+        self._report( rows, columns )
+        return rows, columns
+
+    def apply( self, counts ):
+        """
+        Applies the filters to a table that was already read.
+
+        Parameters
+        ----------
+        counts : pd.DataFrame or SparseFrame
+            The counts.
+
+        Returns
+        -------
+        pd.DataFrame or SparseFrame
+            The filtered counts.
+        """
+        sparse = isinstance( counts, SparseFrame )
+        array = counts.matrix if sparse else counts.to_numpy()
+        column = ( lambda i : array[ :,i ].toarray().ravel() ) if sparse else ( lambda i : array[ :,i ] )
+        rows, columns = self.select( counts.index, array.shape[1], column )
+        if rows.all() and columns.all():
+            return counts
+        if sparse:
+            return SparseFrame( array[ :,np.flatnonzero( columns ) ][ np.flatnonzero( rows ),: ], counts.index[ rows ], counts.columns[ columns ] )
+        return counts.iloc[ rows, columns ]
+
+    def samples( self, chunks ) -> pd.Index:
+        """
+        Selects the samples to keep from a table that is read in chunks (a separate pass).
+
+        Parameters
+        ----------
+        chunks : iterable
+            The chunks of the table (dataframes).
+
+        Returns
+        -------
+        pd.Index
+            The samples to keep.
+        """
+        detected = None
+        columns = None
+        for chunk in chunks:
+            columns = chunk.columns
+            values = chunk.to_numpy()[ self.allowed( chunk.index ) ]
+            counts = np.count_nonzero( values, axis = 0 )
+            detected = counts if detected is None else detected + counts
+        if columns is None:
+            return pd.Index( [] )
+        keep = detected >= self.min_detected if self.min_detected is not None else np.ones( len( columns ), dtype = bool )
+        logger.info( f"Keeping {int( keep.sum() )} of {len( keep )} samples." )
+        return columns[ keep ]
+
+    def filter_chunk( self, chunk : pd.DataFrame ) -> pd.DataFrame:
+        """
+        Applies the gene filters to a chunk of rows (the samples are selected when the chunks are read).
+
+        Parameters
+        ----------
+        chunk : pd.DataFrame
+            The chunk.
+
+        Returns
+        -------
+        pd.DataFrame
+            The filtered chunk.
+        """
+        rows = self.allowed( chunk.index )
+        if self.min_gene_total is not None:
+            rows &= chunk.to_numpy().sum( axis = 1 ) >= self.min_gene_total
+        return chunk if rows.all() else chunk.iloc[ rows,: ]
+
+    def _report( self, rows : np.ndarray, columns : np.ndarray ):
+        """
+        Logs how many genes and samples are kept.
+        """
+        logger.info( f"Keeping {int( rows.sum() )} of {len( rows )} genes and {int( columns.sum() )} of {len( columns )} samples." )
+
+    def __repr__( self ) -> str:
+        # this is used as part of the cache key, so it identifies the allowlist by its content
+        allowlist = None
+        if self.allowlist is not None:
+            allowlist = hashlib.sha1( "\n".join( str( i ) for i in self.allowlist.ids ).encode() ).hexdigest()
+            allowlist = f"{allowlist}:{self.allowlist.strip}"
+        return f"Filters(min_gene_total={self.min_gene_total}, min_detected={self.min_detected}, allowlist={allowlist})"
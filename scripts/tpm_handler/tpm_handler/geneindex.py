@@ -0,0 +1,157 @@
+"""
+Defines a gene index for joining countTables and lengths by their gene IDs.
+
+Count tables and lengths files frequently disagree on Ensembl version suffixes (e.g. `ENSG00000000003.15` vs
+`ENSG00000000003`), in which case no gene matches and all values end up as NaN. The `GeneIndex` therefore
+matches IDs without their version suffixes (Ensembl IDs only, so that gene names such as `AC000061.1` are
+left untouched and the `_PAR_Y` suffix of pseudo-autosomal genes is kept). The index is hashed once and can
+be re-used for any number of joins (e.g. when the same lengths are set for many tables), and each join
+reports its match rate.
+"""
+
+import logging
+import weakref
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger( "tpm_handler" )
+
+version_pattern = r"^(ENS[A-Z]*\d+)\.\d+(?=(?:_PAR_Y)?$)"
+"""
+The pattern of versioned Ensembl IDs (the version is removed, any `_PAR_Y` suffix is kept).
+"""
+
+
+def strip_versions( ids ) -> pd.Index:
+    """
+    Removes the version suffixes of Ensembl IDs (vectorised).
+
+    Parameters
+    ----------
+    ids : list or pd.Index
+        The IDs. Any IDs that are not versioned Ensembl IDs are kept as they are.
+
+    Returns
+    -------
+    pd.Index
+        The IDs without versions.
+    """
+    ids = pd.Index( ids )
+    if not len( ids ) or ids.inferred_type != "string":
+        return ids
+    if not ids.str.contains( ".", regex = False ).any():
+        return ids
+    return pd.Index( ids.str.replace( version_pattern, r"\1", regex = True ), name = ids.name )
+
+
+class GeneIndex:
+    """
+    A hashed index of gene IDs that matches IDs irrespective of their Ensembl versions.
+
+    Parameters
+    ----------
+    ids : list or pd.Index
+        The gene IDs (e.g. the index of the lengths).
+    strip : bool, optional
+        Match IDs without their Ensembl versions. The default is True.
+    """
+    def __init__( self, ids, strip : bool = True ):
+        self.ids = ids if isinstance( ids, pd.Index ) else pd.Index( ids )
+        self.strip = strip
+        keys = strip_versions( self.ids ) if strip else self.ids
+
+        # IDs that only differ in their versions can not be told apart
+        # so only the first of them is matched
+        if keys.is_unique:
+            self._keys, self._positions = keys, None
+        else:
+            first = ~keys.duplicated()
+            logger.warning( f"{np.sum( ~first )} gene IDs are duplicates (after removing versions), only their first occurrence is used." )
+            self._keys, self._positions = keys[ first ], np.flatnonzero( first )
+
+    def join( self, ids, report : bool = True ) -> np.ndarray:
+        """
+        Matches IDs to the index.
+
+        Parameters
+        ----------
+        ids : list or pd.Index
+            The IDs to match (e.g. the index of a countTable).
+        report : bool, optional
+            Log the match rate. The default is True.
+
+        Returns
+        -------
+        np.ndarray
+            The position of each ID in the index (-1 if it is not part of the index).
+        """
+        keys = strip_versions( ids ) if self.strip else pd.Index( ids )
+        idx = self._keys.get_indexer( keys )
+        if self._positions is not None:
+            idx = np.where( idx >= 0, self._positions[ idx ], -1 )
+
+        if report:
+            self._report( idx )
+        return idx
+
+    def match_rate( self, ids ) -> float:
+        """
+        Computes the fraction of IDs that are part of the index.
+
+        Parameters
+        ----------
+        ids : list or pd.Index
+            The IDs to match.
+
+        Returns
+        -------
+        float
+            The match rate.
+        """
+        idx = self.join( ids, report = False )
+        return float( np.mean( idx >= 0 ) ) if len( idx ) else 0.0
+
+    def _report( self, idx : np.ndarray ):
+        """
+        Logs the match rate of a join.
+        """
+        matched = int( np.sum( idx >= 0 ) )
+        rate = matched / len( idx ) if len( idx ) else 0.0
+        logger.info( f"Matched {matched} of {len( idx )} genes ({rate:.1%}) to the lengths." )
+        if rate < 0.5:
+            logger.warning( f"Only {rate:.1%} of the genes have a length. Do the IDs of the countTable and the lengths use the same annotation?" )
+
+    def __len__( self ) -> int:
+        return len( self.ids )
+
+    def __repr__( self ) -> str:
+        return f"GeneIndex({len( self )} genes, strip={self.strip})"
+
+
+_indices = {}
+
+def gene_index( lengths : pd.DataFrame, strip : bool = True ) -> GeneIndex:
+    """
+    Gets the (cached) gene index of a lengths dataframe.
+    The index is only built once for each lengths dataframe (as long as it exists).
+
+    Parameters
+    ----------
+    lengths : pd.DataFrame
+        The lengths (with the IDs as index).
+    strip : bool, optional
+        Match IDs without their Ensembl versions. The default is True.
+
+    Returns
+    -------
+    GeneIndex
+        The gene index.
+    """
+    key = ( id( lengths ), strip )
+    index = _indices.get( key )
+    if index is None or index.ids is not lengths.index:
+        index = GeneIndex( lengths.index, strip )
+        _indices[ key ] = index
+        weakref.finalize( lengths, _indices.pop, key, None )
+    return index
@@ -0,0 +1,263 @@
+"""
+Defines functions for computing the lengths of gene features from a GTF file.
+
+This is a native replacement for `gtftools -l`. The GTF file is streamed once and only the exons are kept.
+From these the following lengths are computed for each gene (matching the output of gtftools):
+
+- `mean` | the mean length of the gene's isoforms (transcripts)
+- `median` | the median length of the gene's isoforms
+- `longest_isoform` | the length of the gene's longest isoform
+- `merged` | the total length of the union of all of the gene's exons (i.e. non-overlapping exons)
+"""
+
+import re
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger( "tpm_handler" )
+
+
+gtf_columns = [ "chr", "source", "type", "start", "end", "score", "strand", "phase", "attributes" ]
+"""
+The columns of a GTF file.
+"""
+
+length_modes = [ "mean", "median", "longest_isoform", "merged" ]
+"""
+The supported modes to compute gene lengths.
+"""
+
+gtf_suffixes = ( ".gtf", ".gtf.gz" )
+"""
+The suffixes of GTF files.
+"""
+
+
+def is_gtf( filename ) -> bool:
+    """
+    Checks if a file is a GTF file (based on its suffix).
+    """
+    return isinstance( filename, str ) and filename.endswith( gtf_suffixes )
+
+def compute_lengths( filename : str, outfile : str = None, modes : list = None, add_names : bool = False, swap_ids_and_names : bool = False, chunksize : int = 500000 ) -> pd.DataFrame:
+    """
+    Computes the lengths of gene features from a GTF file.
+
+    Parameters
+    ----------
+    filename : str
+        The input GTF file.
+    outfile : str, optional
+        The output file. If provided, the lengths are written to this file.
+    modes : list, optional
+        The length modes to compute (in order). By default all modes are computed.
+        Note, `tpm_handler normalise` will by default use the last column of the lengths file.
+    add_names : bool, optional
+        Also add a column with gene names (will be 2nd column). The default is False.
+    swap_ids_and_names : bool, optional
+        Whether to swap the IDs and names. The default is False.
+        If True then the names are the 1st column and IDs are the 2nd column.
+    chunksize : int, optional
+        The number of lines to read at once. The default is 500000.
+
+    Returns
+    -------
+    lengths : pd.DataFrame
+        The lengths of the genes.
+    """
+    modes = modes if modes is not None else length_modes
+    for mode in modes:
+        if mode not in length_modes:
+            raise ValueError( f"Unknown length mode '{mode}'. Supported modes are: {length_modes}" )
+
+    logger.info( "Reading exons from GTF file..." )
+    exons = _read_exons( filename, chunksize )
+
+    logger.info( "Computing gene lengths..." )
+    genes, gene_codes = np.unique( exons["gene_id"].to_numpy(), return_inverse = True )
+    lengths = pd.DataFrame( index = pd.Index( genes, name = "gene" ) )
+
+    isoforms = _isoform_lengths( exons )
+    for mode in modes:
+        if mode == "merged":
+            lengths[ mode ] = _merged_lengths( exons, gene_codes, len(genes) )
+        elif mode == "longest_isoform":
+            lengths[ mode ] = isoforms.max()
+        else:
+            lengths[ mode ] = getattr( isoforms, mode )().round().astype( int )
+
+    # and restore the order in which the genes appear in the GTF file
+    lengths = lengths.reindex( pd.unique( exons["gene_id"] ) )
+
+    if add_names:
+        names = exons.drop_duplicates( "gene_id" ).set_index( "gene_id" )["gene_name"]
+        idx = 0 if swap_ids_and_names else 1
+        lengths = lengths.reset_index()
+        lengths.insert( idx, "gene_name", names.reindex( lengths["gene"] ).to_numpy() )
+        lengths = lengths.set_index( lengths.columns[0] )
+
+    if outfile is not None:
+        lengths.to_csv( outfile, sep = "\t", index = True )
+        logger.info( f"Saved to file: {outfile}" )
+    return lengths
+
+def read_gtf( filename : str, feature : str = "gene", attributes : list = None, columns : list = None, chunksize : int = 500000 ) -> pd.DataFrame:
+    """
+    Streams a GTF file and extracts the entries of one feature type together with some of their attributes.
+    Gzipped GTF files (`.gtf.gz`) are decompressed on the fly.
+
+    Parameters
+    ----------
+    filename : str
+        The input GTF file.
+    feature : str, optional
+        The feature type to extract (3rd column of the GTF file). The default is "gene".
+        Any other entries are discarded while reading.
+    attributes : list, optional
+        The attributes to extract (e.g. `gene_id`). The default is `gene_id` and `gene_name`.
+        Missing attributes are set to NaN.
+    columns : list, optional
+        Any GTF columns to keep besides the attributes (e.g. `start` and `end`). The default is none.
+    chunksize : int, optional
+        The number of lines to read at once. The default is 500000.
+
+    Returns
+    -------
+    pd.DataFrame
+        The extracted entries with the requested columns and attributes.
+    """
+    attributes = attributes if attributes is not None else [ "gene_id", "gene_name" ]
+    columns = columns if columns is not None else []
+    pattern = attribute_pattern( attributes )
+
+    reader = pd.read_csv(
+                            filename,
+                            sep = "\t",
+                            header = None,
+                            comment = "#",
+                            names = gtf_columns,
+                            usecols = list( dict.fromkeys( columns + [ "type", "attributes" ] ) ),
+                            dtype = { "chr" : str, "source" : str, "type" : str, "start" : np.int64, "end" : np.int64, "strand" : str, "attributes" : str },
+                            chunksize = chunksize,
+                        )
+    entries = []
+    with reader:
+        for chunk in reader:
+            chunk = chunk[ chunk["type"] == feature ]
+            values = chunk[ "attributes" ].str.extract( pattern, expand = True )
+            values.columns = attributes
+            entries.append( pd.concat( [ chunk[ columns ], values ], axis = 1 ) )
+
+    if not entries:
+        return pd.DataFrame( columns = columns + attributes )
+    return pd.concat( entries, ignore_index = True )
+
+def attribute_pattern( attributes : list ) -> re.Pattern:
+    """
+    Makes a regex pattern that extracts the values of several GTF attributes in a single pass,
+    irrespective of the order in which they occur.
+
+    Parameters
+    ----------
+    attributes : list
+        The attributes to extract.
+
+    Returns
+    -------
+    re.Pattern
+        The pattern with one capturing group per attribute.
+    """
+    # each attribute gets an optional lookahead so that the order of
+    # attributes does not matter and missing attributes do not fail the match
+    lookaheads = [ f'(?=(?:.*?\\b{re.escape( attr )} "([^"]*)")?)' for attr in attributes ]
+    return re.compile( "^" + "".join( lookaheads ) )
+
+def _read_exons( filename : str, chunksize : int = 500000 ) -> pd.DataFrame:
+    """
+    Streams a GTF file and extracts the exons.
+
+    Parameters
+    ----------
+    filename : str
+        The input GTF file.
+    chunksize : int, optional
+        The number of lines to read at once. The default is 500000.
+
+    Returns
+    -------
+    pd.DataFrame
+        The exons with their chromosome, start, end, gene_id, transcript_id and gene_name.
+    """
+    exons = read_gtf( 
+                        filename, 
+                        feature = "exon", 
+                        attributes = [ "gene_id", "transcript_id", "gene_name" ], 
+                        columns = [ "chr", "start", "end" ], 
+                        chunksize = chunksize 
+                    )
+    if not len( exons ):
+        raise ValueError( f"No exons found in {filename}" )
+    return exons
+
+def _isoform_lengths( exons : pd.DataFrame ):
+    """
+    Computes the lengths of each isoform (transcript), grouped by gene.
+
+    Parameters
+    ----------
+    exons : pd.DataFrame
+        The exons.
+
+    Returns
+    -------
+    pandas.core.groupby.SeriesGroupBy
+        The isoform lengths grouped by gene.
+    """
+    sizes = exons["end"] - exons["start"] + 1
+    isoforms = sizes.groupby( [ exons["gene_id"], exons["transcript_id"] ], sort = True ).sum()
+    return isoforms.groupby( level = 0, sort = True )
+
+def _merged_lengths( exons : pd.DataFrame, gene_codes : np.ndarray, n_genes : int ) -> np.ndarray:
+    """
+    Computes the total length of the union of all exons of each gene.
+
+    Parameters
+    ----------
+    exons : pd.DataFrame
+        The exons.
+    gene_codes : np.ndarray
+        The (sorted) integer code of each exon's gene.
+    n_genes : int
+        The total number of genes.
+
+    Returns
+    -------
+    np.ndarray
+        The merged lengths of the genes (in order of the gene codes).
+    """
+    # group exons by gene and chromosome so that intervals are
+    # only merged if they are part of the same gene and chromosome
+    chr_codes, chrs = pd.factorize( exons["chr"] )
+    groups = gene_codes * len(chrs) + chr_codes
+
+    # shift each group by a large offset so that a single running
+    # maximum over all intervals restarts within each group
+    offset = groups * ( int( exons["end"].max() ) + 2 )
+    starts = exons["start"].to_numpy() + offset
+    ends = exons["end"].to_numpy() + offset
+
+    order = np.argsort( starts, kind = "stable" )
+    starts, ends, gene_codes = starts[order], ends[order], gene_codes[order]
+
+    # a new block of overlapping exons starts whenever an exon
+    # starts after the furthest end of all previous exons
+    reach = np.maximum.accumulate( ends )
+    new_block = np.ones( len(starts), dtype = bool )
+    new_block[1:] = starts[1:] > reach[:-1]
+
+    first = np.flatnonzero( new_block )
+    block_lengths = np.maximum.reduceat( ends, first ) - starts[first] + 1
+
+    return np.bincount( gene_codes[first], weights = block_lengths, minlength = n_genes ).astype( int )
@@ -4,31 +4,104 @@ This script allows normalisation of raw counts from an expression matrix (countT
 
 import argparse
 import tpm_handler.core as core
+import tpm_handler.stream as stream
+import tpm_handler.gtf as gtf
+import tpm_handler.batch as batch
+import tpm_handler.append as append
+import tpm_handler.store as store
+import tpm_handler.registry as registry
+import tpm_handler.sidecar as sidecar
+import tpm_handler.planner as planner
+import tpm_handler.merge as merger
+import tpm_handler.filters as filters
 
 def setup_cli():
     """
-    Sets up the command line interface consisting of two commands:
+    Sets up the command line interface consisting of the commands:
 
     - compute-length | computes the lengths of the features from a GTF file
     - normalise | normalises the counts in a countTable to TPM using the lengths from a GTF file computed before.
+    - normalise-batch | normalises many countTables to TPM using the same lengths.
     """
     descr = "Normalise counts of an expression matrix (countTable) column-wise to TPM."
     parser = argparse.ArgumentParser( description = descr )
     cmd_parser = parser.add_subparsers( dest = "command" )
 
-    length_measure = cmd_parser.add_parser( "compute-length", help = "Compute the length of gene features based on a GTF file using gtftools." )
+    length_measure = cmd_parser.add_parser( "compute-length", help = "Compute the length of gene features based on a GTF file." )
     length_measure.add_argument( "file", help = "The GTF file containing all gene features." )
     length_measure.add_argument( "-o", "--output", help = "The output file.", default = None )
-    length_measure.add_argument( "-m", "--mode", help = "The mode of the computation. The default is 'l'.", default = "l" )
+    length_measure.add_argument( "-e", "--engine", help = "The engine used to compute the lengths. Either 'native' (built-in) or 'gtftools' (an optional dependency, `pip install gtftools`). The default is 'native'.", choices = [ "native", "gtftools" ], default = "native" )
+    length_measure.add_argument( "--modes", help = f"The length modes to compute with the native engine (the last one is used for normalisation by default). The default is all of: {' '.join( gtf.length_modes )}.", nargs = "+", choices = gtf.length_modes, default = gtf.length_modes )
+    length_measure.add_argument( "-m", "--mode", help = "The mode of the computation when using gtftools. The default is 'l'.", default = "l" )
     length_measure.add_argument( "-n", "--add_names", help = "Also add a column with gene names (will be 2nd column)", action = "store_true" )
     length_measure.add_argument( "-s", "--swap_names", help = "Swap the gene names with gene ids. This will move the gene names to the 1st column and gene ids to the 2nd column.", action = "store_true", default = False )
+    length_measure.add_argument( "--no-registry", help = "Do not use the lengths registry. By default the lengths computed by the native engine are registered (keyed by the checksum of the GTF file and the mode) in ~/.cache/tpm_handler/lengths and re-used for the same GTF file.", action = "store_true" )
+    length_measure.add_argument( "--registry-size", type = float, help = "The maximum size of the lengths registry in GB. The least recently used entries are removed if this is exceeded. The default is 1.", default = 1 )
 
-    convert_tpm = cmd_parser.add_parser( "normalise", help = "Convert counts to TPM." )
-    convert_tpm.add_argument( "file", help = "The input count table in TSV format." )
-    convert_tpm.add_argument( "-o", "--output", help = "The output file.", default = None )
-    convert_tpm.add_argument( "-l", "--lengths", help = "The file containing the lengths of the features." )
+    convert_tpm = cmd_parser.add_parser( "normalise", help = "Convert counts to TPM (or another normalisation)." )
+    convert_tpm.add_argument( "file", help = "The input count table in TSV format (may be compressed as '.gz' or '.zst')." )
+    convert_tpm.add_argument( "-o", "--output", help = "The output file. Outputs ending in '.gz' or '.zst' are compressed (by multiple threads).", default = None )
+    convert_tpm.add_argument( "-l", "--lengths", help = "The file containing the lengths of the features. Alternatively, a GTF file (.gtf or .gtf.gz) from which the lengths are computed (or taken from the lengths registry if they were computed before)." )
+    convert_tpm.add_argument( "--length-mode", help = "The column of the lengths file to use (for a GTF file the length mode: mean, median, longest_isoform or merged). By default the last column (or merged for a GTF file) is used.", default = None )
     convert_tpm.add_argument( "-r", "--round", type = int, help = "The number of decimals to round the TPM values to.", default = 5 )
     convert_tpm.add_argument( "-n", "--use_names", help = "Store the gene_names instead of gene_ids in the first column (only works if gene_names are in the lengths file). Note: this does not affect the name of the first column, only its contents!", action = "store_true" )
+    convert_tpm.add_argument( "-m", "--method", help = "The normalisation method(s) to use: tpm, cpm, rpkm or fpkm, optionally prefixed by a transformation (log1p for ln(x+1) or log2p1 for log2(x+1), e.g. log1p-cpm). If multiple methods are given, they are all computed from the same read of the countTable and each is saved to '<output>.<method>'. The default is tpm.", nargs = "+", default = [ "tpm" ] )
+    convert_tpm.add_argument( "--aggregate", help = "Together with -n, aggregate the rows of genes that share the same name using the sum, max or mean (the R reference pipeline uses the sum). By default duplicate names are kept. Not supported with --append-to or matrix stores.", choices = [ "sum", "max", "mean" ], default = None )
+    convert_tpm.add_argument( "--append-to", help = "An existing normalised table (normalised using the same lengths and method) to which the samples of the input file are appended as new columns. Only the new samples are normalised and the existing table is extended in place (or written to --output if given).", default = None )
+    convert_tpm.add_argument( "--max-bytes", help = "A size limit for the output file (e.g. 500M). The highest precision (up to --round digits) at which the output is estimated to stay within this limit is used. Not supported with --append-to or matrix stores.", default = None )
+    convert_tpm.add_argument( "-w", "--workers", type = int, help = "The number of processes to use for the conversion. The default is 1.", default = 1 )
+    convert_tpm.add_argument( "--dtype", help = "The dtype to parse the counts as. float32 halves the memory of the parsed counts (exact for integer counts below ~16 million). The default is float64.", choices = [ "float64", "float32" ], default = "float64" )
+    convert_tpm.add_argument( "--lean", help = "Low-memory mode. The counts are held in a single array which is filtered and normalised in place (peak memory of about the size of the countTable).", action = "store_true" )
+    convert_tpm.add_argument( "--cache", help = "Cache the parsed countTable (or load it from the cache if available) to speed up repeated normalisations of the same file. Optionally, a cache directory can be specified (by default ~/.cache/tpm_handler).", nargs = "?", const = True, default = None )
+    convert_tpm.add_argument( "--cache-size", type = float, help = "The maximum size of the cache in GB. The least recently used entries are removed if this is exceeded. The default is 20.", default = 20 )
+    convert_tpm.add_argument( "--stream", help = "Normalise the countTable chunk-wise in two passes without loading it into memory entirely. This is useful for countTables that are larger than the available memory.", action = "store_true" )
+    convert_tpm.add_argument( "--chunksize", type = int, help = "The number of rows to read at once when using --stream. The default is 10000.", default = 10000 )
+    convert_tpm.add_argument( "--plan", help = "Only predict the peak memory of the in-memory, lean, streaming and (with -w) multi-process (parallel) modes for the countTable (estimating its number of rows from the file size, without parsing it) and print the mode that would be selected. Nothing is normalised.", action = "store_true" )
+    convert_tpm.add_argument( "--mem-budget", help = "A memory budget (e.g. 8G). The fastest mode (parallel, in-memory, lean or streaming) that is predicted to fit into this budget is selected automatically (overriding --lean, --stream and --chunksize) and printed. The parallel mode is only considered if more than one worker is given with -w, which is then the number of processes.", default = None )
+    convert_tpm.add_argument( "--reorder", help = "With --append-to, match the genes of the new samples to those of the existing table by their IDs if they are in a different order (by default a different order is an error).", action = "store_true" )
+    convert_tpm.add_argument( "--sidecar", help = "Also save the scaling factor of each sample, the gene order and a fingerprint of the lengths in a sidecar file ('<output>.factors.npz'). The output can then be re-exported using `reexport` without recomputing it. Not supported with --append-to or matrix stores.", action = "store_true" )
+    convert_tpm.add_argument( "--min-gene-total", help = "Only keep genes with at least this total count across the (kept) samples. The filters are applied while the countTable is read, so the excluded genes and samples are never held in memory. Not supported with --append-to or matrix stores.", type = float, default = None )
+    convert_tpm.add_argument( "--min-detected", help = "Only keep samples with at least this many detected genes (genes with non-zero counts). When streaming this requires an additional pass over the countTable.", type = int, default = None )
+    convert_tpm.add_argument( "--genes", help = "A gene allowlist (one gene ID per line, matched irrespective of Ensembl versions). Only these genes are kept.", default = None )
+    probe = cmd_parser.add_parser( "probe", help = "Show the number of genes and samples of a countTable (without parsing its values)." )
+    probe.add_argument( "file", help = "The input count table in TSV format." )
+    probe.add_argument( "-s", "--samples", help = "Also list the sample names.", action = "store_true" )
+    to_store = cmd_parser.add_parser( "store", help = "Convert a countTable to a chunked HDF5 matrix store (chunk-wise, without loading it into memory). Stores can be passed to `normalise` which then normalises them block by block and stores the values in the store itself." )
+    to_store.add_argument( "file", help = "The input count table in TSV format." )
+    to_store.add_argument( "-o", "--output", help = "The output store. By default the input filename with an added '.h5' suffix.", default = None )
+    to_store.add_argument( "--chunksize", type = int, help = "The number of rows to read at once. The default is 10000.", default = 10000 )
+    to_store.add_argument( "--block-rows", type = int, help = "The number of genes per chunk of the store. The default is 4096.", default = 4096 )
+    to_store.add_argument( "--block-cols", type = int, help = "The number of samples per chunk of the store. The default is 64.", default = 64 )
+    re_export = cmd_parser.add_parser( "reexport", help = "Re-export a normalised table that has a sidecar (see `normalise --sidecar`) at another precision, or convert it back to counts (or to another method that uses the same scaling factors, e.g. cpm to rpkm), in a single pass over the table." )
+    re_export.add_argument( "file", help = "The normalised table (with a sidecar)." )
+    re_export.add_argument( "-o", "--output", help = "The output file. Outputs ending in '.gz' or '.zst' are compressed.", required = True )
+    re_export.add_argument( "-r", "--round", type = int, help = "The number of decimals to round the values to. The default is 5.", default = 5 )
+    re_export.add_argument( "--to", help = "Convert the values to 'counts' (the raw counts), 'length-scaled' (the counts divided by the feature lengths) or another method that uses the same scaling factors (e.g. rpkm for cpm values). By default the values are not converted.", default = None )
+    re_export.add_argument( "-l", "--lengths", help = "Check that the table was normalised using these lengths.", default = None )
+    re_export.add_argument( "--length-mode", help = "The column of the lengths file to use (see `normalise --length-mode`).", default = None )
+    re_export.add_argument( "--chunksize", type = int, help = "The number of rows to read at once. The default is 10000.", default = 10000 )
+    merge = cmd_parser.add_parser( "merge", help = "Merge many per-sample count files (featureCounts, HTSeq-count or countTables) into a single countTable by their gene IDs. With -l the merged counts are normalised directly (without writing an intermediate file)." )
+    merge.add_argument( "files", help = "The count files (or glob patterns such as 'counts/*.txt').", nargs = "+" )
+    merge.add_argument( "-o", "--output", help = "The output file (the merged countTable, or the normalised table if -l is given).", required = True )
+    merge.add_argument( "-l", "--lengths", help = "The file containing the lengths of the features (or a GTF file). If given, the merged counts are normalised and the normalised table is written to --output.", default = None )
+    merge.add_argument( "--length-mode", help = "The column of the lengths file to use (see `normalise --length-mode`).", default = None )
+    merge.add_argument( "-m", "--method", help = "The normalisation method to use together with -l (see `normalise --method`). The default is tpm.", default = "tpm" )
+    merge.add_argument( "-r", "--round", type = int, help = "The number of decimals to round the normalised values to.", default = 5 )
+    merge.add_argument( "-n", "--use_names", help = "Together with -l, store the gene_names instead of gene_ids in the first column.", action = "store_true" )
+    merge.add_argument( "--aggregate", help = "Together with -n, aggregate the rows of genes that share the same name (see `normalise --aggregate`).", choices = [ "sum", "max", "mean" ], default = None )
+    merge.add_argument( "--counts", help = "Together with -l, also save the merged countTable to this file.", default = None )
+    merge.add_argument( "-w", "--workers", type = int, help = "The number of files that are read concurrently (this is also the maximum number of open files). The default is 8.", default = 8 )
+    merge.add_argument( "--dtype", help = "The dtype of the merged counts. By default integer counts are stored as int32 (or int64) and fractional counts (e.g. the expected counts of RSEM) as float64. An integer dtype is rejected for fractional counts.", choices = [ "int32", "int64", "float32", "float64" ], default = None )
+    batch_tpm = cmd_parser.add_parser( "normalise-batch", help = "Convert many countTables to TPM using the same lengths." )
+    batch_tpm.add_argument( "files", help = "The input count tables in TSV format (or glob patterns such as 'data/*.countTable').", nargs = "+" )
+    batch_tpm.add_argument( "-l", "--lengths", help = "The file containing the lengths of the features." )
+    batch_tpm.add_argument( "-o", "--outdir", help = "The output directory. By default each output is written next to its input file.", default = None )
+    batch_tpm.add_argument( "-s", "--suffix", help = "The suffix to append to each input filename for its output file. The default is '.tpm'.", default = ".tpm" )
+    batch_tpm.add_argument( "-r", "--round", type = int, help = "The number of decimals to round the TPM values to.", default = 5 )
+    batch_tpm.add_argument( "-n", "--use_names", help = "Store the gene_names instead of gene_ids in the first column (only works if gene_names are in the lengths file).", action = "store_true" )
+    batch_tpm.add_argument( "--aggregate", help = "Together with -n, aggregate the rows of genes that share the same name (see `normalise --aggregate`).", choices = [ "sum", "max", "mean" ], default = None )
+    batch_tpm.add_argument( "-w", "--workers", type = int, help = "The number of files to process concurrently. The default is 1.", default = 1 )
+    batch_tpm.add_argument( "--lean", help = "Low-memory mode (see `normalise --lean`).", action = "store_true" )
     return parser
 
 def main():
@@ -43,16 +116,102 @@ def main():
             outfile = args.file.replace( ".gtf", ".lengths" )
         else:
             outfile = args.output
-        core.call_gtftools( args.file, outfile, mode = args.mode )
-        if args.add_names:
-            core.add_gtf_gene_names( args.file, outfile, args.swap_names )
+        if args.engine == "native" and args.no_registry:
+            gtf.compute_lengths( args.file, outfile, modes = args.modes, add_names = args.add_names, swap_ids_and_names = args.swap_names )
+        elif args.engine == "native":
+            lengths_registry = registry.LengthsRegistry( max_bytes = int( args.registry_size * 1024**3 ) )
+            lengths_registry.compute( args.file, outfile, modes = args.modes, add_names = args.add_names, swap_ids_and_names = args.swap_names )
+        else:
+            core.call_gtftools( args.file, outfile, mode = args.mode )
+            if args.add_names:
+                core.add_gtf_gene_names( args.file, outfile, args.swap_names )
 
     elif args.command == "normalise":
-        table = core.Table( args.file )
-        table.set_lengths( args.lengths )
-        table.normalise( args.round )
-        outfile = args.output if args.output is not None else f"{args.file}.tpm"
-        table.save( outfile, use_names = args.use_names ) 
+        if len( args.method ) == 1:
+            outfiles = [ args.output if args.output is not None else f"{args.file}.{args.method[0]}" ]
+        else:
+            outfiles = [ f"{args.output or args.file}.{method}" for method in args.method ]
+        max_bytes = core.parse_size( args.max_bytes ) if args.max_bytes is not None else None
+        gene_filters = filters.Filters( args.min_gene_total, args.min_detected, args.genes )
+        if gene_filters.active and ( args.append_to is not None or store.is_store( args.file ) ):
+            parser.error( "--min-gene-total, --min-detected and --genes are not supported for matrix stores or with --append-to." )
+        if store.is_store( args.file ):
+            ignored = [ flag for flag, used in ( ( "--max-bytes", args.max_bytes is not None ), ( "--workers", args.workers > 1 ), ( "--use_names", args.use_names ), ( "--aggregate", args.aggregate is not None ), ( "--sidecar", args.sidecar ) ) if used ]
+            if ignored:
+                parser.error( f"{', '.join( ignored )} {'is' if len( ignored ) == 1 else 'are'} not supported for matrix stores." )
+        if args.append_to is not None:
+            ignored = [ flag for flag, used in ( ( "--max-bytes", args.max_bytes is not None ), ( "--aggregate", args.aggregate is not None ), ( "--sidecar", args.sidecar ) ) if used ]
+            if ignored:
+                parser.error( f"{', '.join( ignored )} {'is' if len( ignored ) == 1 else 'are'} not supported with --append-to." )
+        if args.plan or args.mem_budget is not None:
+            if args.append_to is not None or store.is_store( args.file ) or core._is_mtx( args.file ):
+                parser.error( "--plan and --mem-budget are only supported for dense countTables (not for matrix stores, MatrixMarket files or --append-to)." )
+            budget = core.parse_size( args.mem_budget ) if args.mem_budget is not None else None
+            plan = planner.Plan( args.file, methods = len( args.method ), dtype = args.dtype, workers = args.workers, chunksize = args.chunksize, budget = budget )
+            print( plan )
+            if args.plan:
+                return
+            if plan.mode is None:
+                parser.error( f"The countTable does not fit into a memory budget of {args.mem_budget}." )
+            args.stream = plan.mode == "stream"
+            args.lean = plan.mode == "lean"
+            args.workers = plan.workers if plan.mode == "parallel" else 1
+            args.chunksize = plan.chunksize
+
+        if args.append_to is not None:
+            if len( args.method ) > 1:
+                parser.error( "Only one method can be used with --append-to." )
+            table = core.Table( args.file, cache = args.cache, cache_size = int( args.cache_size * 1024**3 ), lean = args.lean, dtype = args.dtype )
+            table.set_lengths( args.lengths, which = args.length_mode )
+            values = table.compute( args.method[0], workers = args.workers )
+            index = table.names if args.use_names else table.ids
+            append.append_samples( args.append_to, values, index, table.get().columns, outfile = args.output, digits = args.round, reorder = args.reorder )
+        elif store.is_store( args.file ):
+            lengths = core.read_lengths( args.lengths, which = args.length_mode ) if args.lengths is not None else None
+            with store.MatrixStore( args.file, "r+" ) as matrix:
+                for method, outfile in zip( args.method, outfiles ):
+                    matrix.normalise( lengths, method, digits = args.round )
+                    if args.output is not None:
+                        matrix.export( outfile, method, digits = args.round )
+        elif args.stream:
+            if core._is_mtx( args.file ):
+                parser.error( "--stream is not supported for MatrixMarket files (sparse tables are normalised in memory)." )
+            lengths = core.read_lengths( args.lengths, which = args.length_mode )
+            stream.normalise_stream( args.file, lengths, outfiles, digits = args.round, chunksize = args.chunksize, use_names = args.use_names, max_bytes = max_bytes, method = args.method, aggregate = args.aggregate, sidecar = args.sidecar, filters = gene_filters )
+        else:
+            table = core.Table( args.file, cache = args.cache, cache_size = int( args.cache_size * 1024**3 ), lean = args.lean, dtype = args.dtype, filters = gene_filters )
+            table.set_lengths( args.lengths, which = args.length_mode )
+            if len( args.method ) == 1:
+                table.normalise( None, workers = args.workers, method = args.method[0] )
+                table.save( outfiles[0], use_names = args.use_names, digits = args.round, workers = args.workers, max_bytes = max_bytes, aggregate = args.aggregate, sidecar = args.sidecar )
+            else:
+                for method, outfile in zip( args.method, outfiles ):
+                    values = table.compute( method, workers = args.workers )
+                    table.save( outfile, use_names = args.use_names, digits = args.round, workers = args.workers, max_bytes = max_bytes, values = values, aggregate = args.aggregate, sidecar = args.sidecar, method = method )
+    elif args.command == "probe":
+        info = core.probe_table( args.file )
+        print( f"{args.file}: {info['rows']} genes x {len( info['samples'] )} samples (index: {info['index_name']})" )
+        if args.samples:
+            print( "\n".join( info[ "samples" ] ) )
+    elif args.command == "store":
+        outfile = args.output if args.output is not None else f"{args.file}.h5"
+        store.build_store( args.file, outfile, chunksize = args.chunksize, block_rows = args.block_rows, block_cols = args.block_cols )
+    elif args.command == "reexport":
+        lengths = core.read_lengths( args.lengths, which = args.length_mode ) if args.lengths is not None else None
+        sidecar.reexport( args.file, args.output, digits = args.round, to = args.to, lengths = lengths, chunksize = args.chunksize )
+    elif args.command == "merge":
+        if args.lengths is None:
+            merger.merge_counts( args.files, args.output, workers = args.workers, dtype = args.dtype )
+        else:
+            counts = merger.merge_counts( args.files, args.counts, workers = args.workers, dtype = args.dtype )
+            table = core.Table.from_frame( counts )
+            table.set_lengths( args.lengths, which = args.length_mode )
+            table.normalise( None, method = args.method )
+            table.save( args.output, use_names = args.use_names, digits = args.round, aggregate = args.aggregate )
+    elif args.command == "normalise-batch":
+        lengths = core.read_lengths( args.lengths )
+        batch.normalise_batch( args.files, lengths, outdir = args.outdir, suffix = args.suffix, digits = args.round, workers = args.workers, use_names = args.use_names, aggregate = args.aggregate, lean = args.lean )
+
     else:
         parser.print_help()
         exit( 1 )
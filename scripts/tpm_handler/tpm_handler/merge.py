@@ -0,0 +1,238 @@
+"""
+Defines functions for merging many per-sample count files into a single countTable.
+
+The count files of each sample (e.g. the outputs of featureCounts or HTSeq-count) are read concurrently by a
+bounded pool of threads, each of which only opens one file at a time, so that thousands of files can be merged
+without running out of file handles. The counts of each file are matched to the merged table by their gene IDs
+(a hashed join, so the files do not need to list the genes in the same order) and copied into a single
+matrix that holds one column per sample. Each file is released as soon as its counts are copied. Genes
+that are missing from a file are counted as zero. The counts are kept as integers unless a file holds
+fractional counts (e.g. the expected counts of RSEM or Salmon), in which case they are kept as floats. The merged table can be written to a file or handed on
+directly to a `Table` for normalisation, without writing an intermediate file.
+
+The following formats are recognised (per file):
+
+- `featureCounts` | a `Geneid Chr Start End Strand Length <sample>...` table (after `#` comment lines)
+- `htseq` | two columns (gene ID and count) without a header, the `__` summary lines are skipped
+- `table` | a countTable with a header (gene IDs in the first column, one column per sample)
+"""
+
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .reader import probe_table
+from .writer import write_table
+from .compression import open_file
+
+logger = logging.getLogger( "tpm_handler" )
+
+featurecounts_columns = [ "Geneid", "Chr", "Start", "End", "Strand", "Length" ]
+"""
+The annotation columns of featureCounts outputs (followed by one column per sample).
+"""
+
+_name_suffixes = ( ".gz", ".zst", ".txt", ".tsv", ".counts", ".count", ".htseq", ".featureCounts", ".bam", ".sam" )
+
+
+def count_format( filename : str, sep : str = "\t" ) -> str:
+    """
+    Detects the format of a count file.
+
+    Parameters
+    ----------
+    filename : str
+        The count file.
+    sep : str, optional
+        The separator of the file. The default is "\t".
+
+    Returns
+    -------
+    str
+        The format (`featureCounts`, `htseq` or `table`).
+    """
+    return _count_format( probe_table( filename, sep, count_rows = False ) )
+
+def _count_format( probe : dict ) -> str:
+    """
+    Detects the format of a count file from its probed header.
+    """
+    header = [ probe[ "index_name" ] ] + probe[ "samples" ]
+    if header[ :len( featurecounts_columns ) ] == featurecounts_columns:
+        return "featureCounts"
+    if len( header ) == 2 and _is_number( header[1] ):
+        return "htseq"
+    return "table"
+
+def _is_number( text : str ) -> bool:
+    """
+    Checks whether a field is a (possibly fractional) count rather than a sample name.
+    """
+    try:
+        float( text )
+    except ValueError:
+        return False
+    return True
+
+def sample_name( name : str ) -> str:
+    """
+    Derives a sample name from a filename (or a BAM file listed by featureCounts)
+    by removing its directory and common suffixes (e.g. `.counts.txt`).
+    """
+    name = os.path.basename( name )
+    while name.endswith( _name_suffixes ):
+        name = name[ :name.rfind( "." ) ]
+    return name
+
+def read_counts( filename : str, sep : str = "\t", dtype = None ) -> pd.DataFrame:
+    """
+    Reads a per-sample count file (featureCounts, HTSeq-count or a countTable).
+
+    Parameters
+    ----------
+    filename : str
+        The count file.
+    sep : str, optional
+        The separator of the file. The default is "\t".
+    dtype : type, optional
+        The dtype of the counts. By default the counts are read as int32 (or int64 if they do not fit)
+        if all of them are whole numbers and as float64 otherwise. An integer dtype raises an error
+        for fractional counts (instead of truncating them).
+
+    Returns
+    -------
+    pd.DataFrame
+        The counts with the gene IDs as index and one column per sample.
+    """
+    probe = probe_table( filename, sep, count_rows = False )
+    fmt = _count_format( probe )
+    if fmt == "htseq":
+        df = pd.read_csv( filename, sep = sep, header = None, names = [ "gene_id", sample_name( filename ) ], index_col = 0, dtype = { "gene_id" : str } )
+        df = df[ ~df.index.str.startswith( "__" ) ]
+    elif fmt == "featureCounts":
+        samples = probe[ "samples" ][ len( featurecounts_columns ) - 1: ]
+        df = pd.read_csv( filename, sep = sep, skiprows = probe[ "skiprows" ], usecols = [ "Geneid" ] + samples, index_col = 0, dtype = { "Geneid" : str } )
+        df.columns = [ sample_name( i ) for i in samples ]
+    else:
+        df = pd.read_csv( filename, sep = sep, skiprows = probe[ "skiprows" ], index_col = 0, dtype = { probe[ "index_name" ] : str } )
+    if df.index.has_duplicates:
+        duplicates = df.index[ df.index.duplicated() ].unique()
+        raise ValueError( f"{filename} lists {len( duplicates )} gene IDs more than once (e.g. {list( duplicates[:5] )})." )
+    return df.astype( _counts_dtype( df.to_numpy(), dtype, filename ) )
+
+def _counts_dtype( values : np.ndarray, dtype, filename : str ):
+    """
+    Gets the dtype to store counts as (see `read_counts`).
+    """
+    whole = np.issubdtype( values.dtype, np.integer ) or bool( np.all( np.mod( values, 1 ) == 0 ) )
+    if dtype is None:
+        if not whole:
+            return np.float64
+        if values.size and values.max() > np.iinfo( np.int32 ).max:
+            return np.int64
+        return np.int32
+    if not whole and np.issubdtype( np.dtype( dtype ), np.integer ):
+        raise ValueError( f"{filename} holds fractional counts, which can not be stored as {np.dtype( dtype )} without truncating them." )
+    return dtype
+
+def merge_counts( files : list, outfile : str = None, workers : int = 8, sep : str = "\t", dtype = None, index_name : str = "gene_id" ) -> pd.DataFrame:
+    """
+    Merges many per-sample count files into a single countTable.
+
+    The files are joined by their gene IDs rather than merged as sorted streams, since count files
+    are not necessarily sorted by gene ID (nor in the same order). Hence, each file is read as a whole,
+    but it is only held until its counts are copied into the merged table.
+
+    Parameters
+    ----------
+    files : list
+        The count files (or glob patterns). Each may hold one or more samples.
+    outfile : str, optional
+        The output file. If provided, the merged countTable is written to this file.
+    workers : int, optional
+        The number of files that are read concurrently (and hence the maximum number of open files). The default is 8.
+    sep : str, optional
+        The separator of the files. The default is "\t".
+    dtype : type, optional
+        The dtype of the merged counts. By default integer counts are kept as int32 (or int64)
+        and fractional counts as float64 (see `read_counts`).
+    index_name : str, optional
+        The name of the index (gene ID) column. The default is "gene_id".
+
+    Returns
+    -------
+    pd.DataFrame
+        The merged countTable (with the gene IDs as index and one column per sample).
+        The genes are in the order in which they first occur in the files.
+    """
+    from .batch import expand_files
+
+    files = expand_files( files )
+    if not files:
+        raise ValueError( "No count files to merge." )
+    logger.info( f"Merging {len( files )} count files using {max( workers, 1 )} threads..." )
+
+    genes = None
+    columns = []
+    values = []
+    for filename, df in _read_all( files, workers, sep, dtype ):
+        if genes is None:
+            genes = df.index
+        idx = genes.get_indexer( df.index )
+        if ( idx < 0 ).any():
+            new = df.index[ idx < 0 ]
+            logger.warning( f"{len( new )} genes of {filename} are not part of the previous files (they are counted as zero in those)." )
+            genes = genes.append( new )
+            idx = genes.get_indexer( df.index )
+
+        # each sample is kept as a column aligned to the genes known so far
+        for name in df.columns:
+            column = np.zeros( len( genes ), dtype = df[ name ].dtype )
+            column[ idx ] = df[ name ].to_numpy()
+            values.append( column )
+        columns.extend( df.columns )
+
+    duplicates = pd.Index( columns )[ pd.Index( columns ).duplicated() ]
+    if len( duplicates ):
+        raise ValueError( f"The samples {list( duplicates.unique() )} occur in multiple files." )
+
+    # one (column-major) matrix holds all samples, genes that were added later are zero in earlier columns
+    merged_dtype = dtype if dtype is not None else np.result_type( *[ column.dtype for column in values ] )
+    counts = np.zeros( ( len( genes ), len( columns ) ), dtype = merged_dtype, order = "F" )
+    for i in range( len( columns ) ):
+        column = values[i]
+        counts[ :len( column ), i ] = column
+        values[i] = None
+
+    merged = pd.DataFrame( counts, index = pd.Index( genes, name = index_name ), columns = pd.Index( columns ), copy = False )
+    logger.info( f"Merged {len( columns )} samples with {len( genes )} genes." )
+    if outfile is not None:
+        if np.issubdtype( counts.dtype, np.integer ):
+            write_table( outfile, counts, merged.index, merged.columns, index_name = index_name, digits = 0 )
+        else:
+            # fractional counts are written as they are (rather than at a fixed precision)
+            with open_file( outfile, "w" ) as f:
+                f.write( merged.to_csv( None, sep = "\t" ) )
+        logger.info( f"Saved to file: {outfile}" )
+    return merged
+
+def _read_all( files : list, workers : int, sep : str, dtype ):
+    """
+    Reads count files concurrently (in order), with at most `workers` files open
+    and at most twice as many files read ahead of the consumer.
+    """
+    workers = max( workers, 1 )
+    with ThreadPoolExecutor( max_workers = workers ) as pool:
+        pending = deque()
+        for filename in files:
+            pending.append( ( filename, pool.submit( read_counts, filename, sep, dtype ) ) )
+            if len( pending ) >= 2 * workers:
+                filename, future = pending.popleft()
+                yield filename, future.result()
+        while pending:
+            filename, future = pending.popleft()
+            yield filename, future.result()
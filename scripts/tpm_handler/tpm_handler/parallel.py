@@ -0,0 +1,184 @@
+"""
+Defines functions for converting raw counts to TPM (or other normalisations) using multiple processes.
+
+Since TPM is computed independently for each sample, the samples (columns) are split into
+shards that are converted by a pool of worker processes. The counts are placed once into a
+shared memory block (in column-major order so that each shard is contiguous) which all workers
+access directly and in which the TPM values are computed in place. Hence, the matrix is never
+pickled and sent to the workers and the column order is preserved automatically. The normalised
+values are either copied into a given output array (e.g. the counts themselves in low-memory mode)
+or the shared memory block itself is handed on as the result, so that the matrix is held at most twice.
+"""
+
+import os
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .core import logger
+from .engines import get_engine
+
+
+def parallel_array_to_tpm( array : np.ndarray, lengths : np.ndarray, workers : int = 2, digits : int = None ):
+    """
+    Convert raw counts to TPM using multiple processes.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The raw counts. As a 2D ndarray.
+    lengths : np.ndarray
+        The lengths of the features. As a 1D ndarray.
+    workers : int, optional
+        The number of worker processes to use. The default is 2.
+    digits : int, optional
+        The number of digits to round to. The default is None (no rounding).
+
+    Returns
+    -------
+    np.ndarray
+        The TPM values.
+    """
+    return parallel_normalise( array, lengths, workers, digits, method = "tpm" )
+
+def parallel_normalise( array : np.ndarray, lengths : np.ndarray, workers : int = 2, digits : int = None, method : str = "tpm", out : np.ndarray = None, return_factors : bool = False ):
+    """
+    Normalise raw counts using multiple processes.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The raw counts. As a 2D ndarray.
+    lengths : np.ndarray
+        The lengths of the features. As a 1D ndarray.
+    workers : int, optional
+        The number of worker processes to use. The default is 2.
+    digits : int, optional
+        The number of digits to round to. The default is None (no rounding).
+    method : str, optional
+        The normalisation method (engine) to use. The default is "tpm".
+    out : np.ndarray, optional
+        An array to store the values in (may be `array` itself). By default the 
+        shared memory block that the values were computed in is returned.
+    return_factors : bool, optional
+        Also return the scaling factors (as computed by the workers). The default is False.
+
+    Returns
+    -------
+    np.ndarray
+        The normalised values.
+    factors : np.ndarray
+        The scaling factor of each sample (only if `return_factors`).
+    """
+    engine = get_engine( method )
+    if engine.uses_lengths:
+        lengths = np.asarray( lengths, dtype = float )
+        if len(lengths) != len(array):
+            raise IndexError( "The length of the lengths array does not match the length of the raw counts array." )
+
+    shards = _shards( array.shape[1], workers )
+    logger.info( f"Normalising ({engine.name}) using {len(shards)} workers..." )
+
+    shm = shared_memory.SharedMemory( create = True, size = max( array.size, 1 ) * np.dtype( float ).itemsize )
+    try:
+        shared = np.ndarray( array.shape, dtype = float, buffer = shm.buf, order = "F" )
+        shared[:] = array
+
+        with ProcessPoolExecutor( max_workers = len(shards) ) as pool:
+            futures = [
+                        pool.submit( _convert_shard, shm.name, array.shape, start, stop, lengths, digits, engine )
+                        for start, stop in shards
+                    ]
+            factors = np.concatenate( [ future.result() for future in futures ] ) if futures else np.zeros( 0 )
+
+        if out is not None:
+            out[:] = shared
+            tpm = out
+        else:
+            tpm = _adopt( shm, array.shape )
+            if tpm is None:
+                tpm = np.array( shared, order = "F" )
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+    logger.debug( f"At the end of parallel_normalise {tpm.shape=}" )
+    if return_factors:
+        return tpm, factors
+    return tpm
+
+def _adopt( shm : shared_memory.SharedMemory, shape : tuple ) -> np.ndarray:
+    """
+    Maps a shared memory block (once more) as an array that outlives the block's name, so that the
+    values do not need to be copied out of it. The memory is released once the array is no longer referenced.
+    Returns None if the block can not be mapped as a file (i.e. on systems without `/dev/shm`).
+    """
+    path = os.path.join( "/dev/shm", shm.name.lstrip( "/" ) )
+    if not os.path.exists( path ):
+        return None
+    with open( path, "r+b" ) as f:
+        buffer = mmap.mmap( f.fileno(), shm.size )
+    return np.ndarray( shape, dtype = float, buffer = buffer, order = "F" )
+
+def _shards( n : int, workers : int ):
+    """
+    Splits `n` columns into (at most) `workers` contiguous shards.
+
+    Parameters
+    ----------
+    n : int
+        The number of columns.
+    workers : int
+        The number of shards to make.
+
+    Returns
+    -------
+    list
+        A list of (start, stop) tuples.
+    """
+    bounds = np.linspace( 0, n, min( max( workers, 1 ), max( n, 1 ) ) + 1 ).astype( int )
+    return [ ( start, stop ) for start, stop in zip( bounds[:-1], bounds[1:] ) if stop > start ]
+
+def _convert_shard( name : str, shape : tuple, start : int, stop : int, lengths : np.ndarray, digits : int = None, engine = "tpm" ):
+    """
+    Normalises a shard of columns within a shared memory block in place.
+    This is the function run by each worker process.
+
+    Parameters
+    ----------
+    name : str
+        The name of the shared memory block.
+    shape : tuple
+        The shape of the (entire) counts matrix.
+    start : int
+        The first column of the shard.
+    stop : int
+        The column after the last column of the shard.
+    lengths : np.ndarray
+        The lengths of the features.
+    digits : int, optional
+        The number of digits to round to. The default is None (no rounding).
+    engine : Engine or str, optional
+        The normalisation engine to use. The default is "tpm".
+
+    Returns
+    -------
+    np.ndarray
+        The scaling factors of the samples of the shard.
+    """
+    engine = get_engine( engine )
+    shm = shared_memory.SharedMemory( name = name )
+    try:
+        shared = np.ndarray( shape, dtype = float, buffer = shm.buf, order = "F" )
+        shard = shared[ :, start:stop ]
+        factors = engine.factors( shard, lengths )
+        engine.apply( shard, lengths, factors = factors, out = shard )
+        if digits is not None:
+            np.round( shard, digits, out = shard )
+        del shard, shared
+    finally:
+        shm.close()
+    return factors
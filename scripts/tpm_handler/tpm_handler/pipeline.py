@@ -0,0 +1,172 @@
+"""
+Defines the building blocks of a pipelined (read / compute / write) chunk-wise normalisation.
+
+Reading a chunk, converting it and writing it out would otherwise run one after another. Instead, chunks are
+read by a reader thread and written by a writer thread, which are joined to the compute stage (the calling
+thread) by bounded queues. Hence, disk I/O and computations overlap and the slowest stage sets the throughput,
+while the bounded queues keep only a few chunks in memory at a time. The time spent in each stage is recorded
+so that the bottleneck can be identified.
+"""
+
+import time
+import queue
+import threading
+import logging
+
+logger = logging.getLogger( "tpm_handler" )
+
+_done = object()
+
+
+class Timings( dict ):
+    """
+    The time (in seconds) spent in each stage of a pipeline.
+    """
+    def add( self, stage : str, seconds : float ):
+        self[ stage ] = self.get( stage, 0.0 ) + seconds
+
+    def __str__( self ) -> str:
+        return " | ".join( f"{stage}: {seconds:.2f}s" for stage, seconds in self.items() )
+
+
+def background( iterable, maxsize : int = 4, timings : Timings = None, stage : str = "read" ):
+    """
+    Iterates over an iterable in a background thread.
+
+    Parameters
+    ----------
+    iterable : iterable
+        The iterable (e.g. a chunk reader).
+    maxsize : int, optional
+        The maximum number of items to hold ahead of the consumer. The default is 4.
+    timings : Timings, optional
+        Record the time spent producing the items.
+    stage : str, optional
+        The name of the stage in the timings. The default is "read".
+
+    Yields
+    ------
+    object
+        The items of the iterable (in order).
+    """
+    items = queue.Queue( maxsize = max( maxsize, 1 ) )
+    stop = threading.Event()
+
+    def produce():
+        try:
+            iterator = iter( iterable )
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next( iterator )
+                except StopIteration:
+                    break
+                finally:
+                    if timings is not None:
+                        timings.add( stage, time.perf_counter() - start )
+                _put( items, ( item, None ), stop )
+        except BaseException as e:
+            _put( items, ( _done, e ), stop )
+            return
+        _put( items, ( _done, None ), stop )
+
+    thread = threading.Thread( target = produce, name = f"tpm_handler-{stage}", daemon = True )
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class Writer:
+    """
+    Writes text to open files in a background thread.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of pending writes. The default is 4.
+    timings : Timings, optional
+        Record the time spent writing.
+    stage : str, optional
+        The name of the stage in the timings. The default is "write".
+    """
+    def __init__( self, maxsize : int = 4, timings : Timings = None, stage : str = "write" ):
+        self.timings = timings
+        self.stage = stage
+        self._queue = queue.Queue( maxsize = max( maxsize, 1 ) )
+        self._stop = threading.Event()
+        self._error = None
+        self._thread = threading.Thread( target = self._consume, name = f"tpm_handler-{stage}", daemon = True )
+        self._thread.start()
+
+    def write( self, f, text : str ):
+        """
+        Queues text to be written to an open file.
+
+        Parameters
+        ----------
+        f : file
+            The open file.
+        text : str
+            The text to write.
+        """
+        if self._error is not None:
+            raise self._error
+        _put( self._queue, ( f, text ), self._stop )
+
+    def close( self ):
+        """
+        Waits until all pending text is written.
+        """
+        self._queue.put( ( None, _done ) )
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _consume( self ):
+        while True:
+            f, text = self._queue.get()
+            if text is _done:
+                return
+            if self._stop.is_set():
+                continue
+            start = time.perf_counter()
+            try:
+                f.write( text )
+            except BaseException as e:
+                self._error = e
+                self._stop.set()
+            if self.timings is not None:
+                self.timings.add( self.stage, time.perf_counter() - start )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, *args ):
+        if exc_type is None:
+            self.close()
+        else:
+            # skip any pending writes if the pipeline failed
+            self._stop.set()
+            self._queue.put( ( None, _done ) )
+            self._thread.join()
+
+
+def _put( items : queue.Queue, item, stop : threading.Event ):
+    """
+    Puts an item into a bounded queue unless the pipeline was stopped.
+    """
+    while not stop.is_set():
+        try:
+            items.put( item, timeout = 0.1 )
+            return
+        except queue.Full:
+            continue
@@ -0,0 +1,262 @@
+"""
+Defines a memory planner for `normalise`.
+
+The planner probes the header of a countTable and estimates its number of rows from the file size (based on
+the average size of the first lines), without parsing the table. From this it predicts the peak memory of each
+execution mode and, given a memory budget, selects the fastest mode that fits. The modes (fastest first) are:
+
+- `parallel` | the table is held in memory and the samples are normalised by a pool of processes
+- `in-memory` | the table is held in memory and normalised in one process
+- `lean` | the table is held in a single array that is filtered and normalised in place
+- `stream` | the table is normalised chunk-wise in two passes (memory is bounded by the chunk size)
+
+The predictions are based on the arrays each mode allocates at its peak (e.g. the parsed table and its array
+while reading, or the counts, the shared memory and the result in parallel mode) plus a fixed overhead for
+the interpreter and libraries. They are meant to size memory allocations (e.g. `--mem` of slurm).
+"""
+
+import os
+
+import numpy as np
+
+from .reader import probe_table
+from .columnar import columnar_format
+from .compression import compression_format, decompress_stream
+
+modes = [ "parallel", "in-memory", "lean", "stream" ]
+"""
+The execution modes (fastest first).
+"""
+
+base_bytes = 150 * 1024**2
+"""
+The fixed memory overhead of the interpreter and the imported libraries (about 150 MB).
+"""
+
+row_bytes = 250
+"""
+The memory per row for the gene IDs and their (hashed) index.
+"""
+
+worker_bytes = 100 * 1024**2
+"""
+The memory overhead of each worker process in parallel mode.
+"""
+
+stream_chunks = 16
+"""
+The number of chunk-sized buffers held at the peak of streaming (the read-ahead and write queues of the
+pipeline, the parser buffers and the formatted text of a chunk).
+"""
+
+
+def estimate_rows( filename : str, sep : str = "\t", sample_bytes : int = 2**22 ) -> tuple:
+    """
+    Estimates the number of rows (genes) and samples of a countTable without parsing it.
+
+    Parameters
+    ----------
+    filename : str
+        The countTable. For Parquet and Feather files the number of rows is read from their metadata.
+    sep : str, optional
+        The separator of the table. The default is "\t".
+    sample_bytes : int, optional
+        The number of bytes at the start of the file from which the average size of a line is estimated.
+        The default is 4 MB. Files smaller than this are counted exactly.
+
+    Returns
+    -------
+    rows : int
+        The (estimated) number of rows.
+    samples : list
+        The sample names.
+    exact : bool
+        Whether the number of rows is exact.
+    """
+    fmt = columnar_format( filename )
+    if fmt is not None:
+        return _columnar_rows( filename, fmt ) + ( True, )
+
+    probe = probe_table( filename, sep, count_rows = False )
+    size = os.path.getsize( filename )
+    compression = compression_format( filename )
+    with open( filename, "rb" ) as f:
+        if compression is None:
+            block = f.read( sample_bytes )
+        else:
+            # the size of a compressed file is scaled by the compressed bytes the sample was decompressed from
+            with decompress_stream( f, compression ) as stream:
+                block = stream.read( sample_bytes )
+                complete = len( block ) < sample_bytes
+            block_size = f.tell()
+            size = len( block ) if complete else int( size * len( block ) / max( block_size, 1 ) )
+
+    # skip the comment lines and the header
+    offset = 0
+    for _ in range( probe[ "skiprows" ] + 1 ):
+        offset = block.find( b"\n", offset ) + 1
+        if not offset:
+            return 0, probe[ "samples" ], True
+
+    if len( block ) == size:
+        rows = block.count( b"\n", offset ) + ( not block.endswith( b"\n" ) )
+        return rows, probe[ "samples" ], True
+
+    # only complete lines are used to estimate their average size
+    end = block.rfind( b"\n" ) + 1
+    lines = block.count( b"\n", offset, end )
+    if not lines:
+        return 1, probe[ "samples" ], False
+    rows = int( round( ( size - offset ) / ( ( end - offset ) / lines ) ) )
+    return rows, probe[ "samples" ], False
+
+def _columnar_rows( filename : str, fmt : str ) -> tuple:
+    """
+    Gets the number of rows and the samples of a columnar file from its metadata.
+    """
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        meta = pq.ParquetFile( filename )
+        return meta.metadata.num_rows, meta.schema_arrow.names[1:]
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    with pa.memory_map( filename, "r" ) as source:
+        reader = ipc.open_file( source )
+        rows = sum( reader.get_batch( i ).num_rows for i in range( reader.num_record_batches ) )
+        return rows, reader.schema.names[1:]
+
+
+class Plan:
+    """
+    The predicted peak memory of each execution mode and the selected mode.
+
+    Parameters
+    ----------
+    filename : str
+        The countTable.
+    methods : int, optional
+        The number of normalisation methods computed from the table. The default is 1.
+    dtype : str, optional
+        The dtype the counts are parsed as (`float64` or `float32`). The default is "float64".
+    workers : int, optional
+        The number of processes in parallel mode. The default is 1, i.e. the parallel mode is only
+        considered if more than one worker is explicitly allowed.
+    chunksize : int, optional
+        The number of rows per chunk in streaming mode. The default is 10000.
+    budget : int, optional
+        The memory budget in bytes. By default the fastest mode is selected.
+    sep : str, optional
+        The separator of the table. The default is "\t".
+    """
+    def __init__( self, filename : str, methods : int = 1, dtype : str = "float64", workers : int = 1, chunksize : int = 10000, budget : int = None, sep : str = "\t" ):
+        self.filename = filename
+        self.rows, self.samples, self.exact = estimate_rows( filename, sep )
+        self.methods = max( methods, 1 )
+        self.dtype = dtype
+        self.workers = workers if workers is not None else 1
+        self.chunksize = chunksize
+        self.budget = budget
+
+        self.estimates = self.predict( self.chunksize )
+        self.mode = self.select()
+
+    def predict( self, chunksize : int ) -> dict:
+        """
+        Predicts the peak memory of each execution mode.
+
+        Parameters
+        ----------
+        chunksize : int
+            The number of rows per chunk in streaming mode.
+
+        Returns
+        -------
+        dict
+            The predicted peak memory (in bytes) of each mode (the parallel mode only with more than one worker).
+        """
+        values = self.rows * len( self.samples )
+        parsed = values * np.dtype( self.dtype ).itemsize
+        array = values * np.dtype( float ).itemsize
+        extra = ( self.methods - 1 ) * array
+        fixed = base_bytes + self.rows * row_bytes
+
+        estimates = {}
+        if self.workers > 1:
+            # the parsed counts, the shared memory and the result (while reading: the parsed table and its array)
+            estimates[ "parallel" ] = fixed + 2 * parsed + 2 * array + extra + self.workers * worker_bytes
+        # the counts, their filtered copy and the normalised values
+        estimates[ "in-memory" ] = fixed + 2 * parsed + array + extra
+        # the parsed table and its array while reading, or the counts converted to float
+        estimates[ "lean" ] = fixed + max( 2 * parsed, parsed + array ) + extra
+        chunk = min( chunksize, max( self.rows, 1 ) ) * len( self.samples ) * np.dtype( float ).itemsize
+        estimates[ "stream" ] = fixed + ( stream_chunks + 4 * ( self.methods - 1 ) ) * chunk
+        return estimates
+
+    def select( self ) -> str:
+        """
+        Selects the fastest mode that fits the budget. If no mode fits, the chunk size of
+        the streaming mode is reduced to fit the budget.
+
+        Returns
+        -------
+        str
+            The selected mode (None if the table does not fit even when streamed in small chunks).
+        """
+        for mode in modes:
+            if mode in self.estimates and ( self.budget is None or self.estimates[ mode ] <= self.budget ):
+                return mode
+
+        # streaming memory scales with the chunk size
+        fixed = self.predict( 0 )[ "stream" ]
+        per_row = ( self.estimates[ "stream" ] - fixed ) / min( self.chunksize, max( self.rows, 1 ) )
+        chunksize = int( ( self.budget - fixed ) / per_row ) if per_row > 0 else 0
+        if chunksize < 100:
+            return None
+        self.chunksize = chunksize
+        self.estimates[ "stream" ] = self.predict( chunksize )[ "stream" ]
+        return "stream"
+
+    @property
+    def peak( self ) -> int:
+        """
+        The predicted peak memory of the selected mode (in bytes).
+        """
+        return self.estimates[ self.mode ] if self.mode is not None else None
+
+    def __str__( self ) -> str:
+        rows = f"{self.rows}" if self.exact else f"~{self.rows}"
+        lines = [ f"{self.filename}: {rows} genes x {len( self.samples )} samples" + ( "" if self.exact else " (estimated from the file size)" ) ]
+        notes = { "parallel" : f"{self.workers} workers", "stream" : f"chunksize {self.chunksize}" }
+        for mode, peak in self.estimates.items():
+            note = f"  ({notes[ mode ]})" if mode in notes else ""
+            lines.append( f"  {mode:<10} {format_size( peak ):>8}{note}" )
+
+        budget = f" within a budget of {format_size( self.budget )}" if self.budget is not None else ""
+        if self.mode is None:
+            lines.append( f"No mode fits{budget}." )
+        else:
+            lines.append( f"Selected mode: {self.mode}{budget} (predicted peak memory {format_size( self.peak )})" )
+        return "\n".join( lines )
+
+    def __repr__( self ) -> str:
+        return f"Plan(file='{self.filename}', mode='{self.mode}')"
+
+
+def format_size( size : int ) -> str:
+    """
+    Formats a size in bytes as a human-readable size (the inverse of `parse_size`).
+
+    Parameters
+    ----------
+    size : int
+        The size in bytes.
+
+    Returns
+    -------
+    str
+        The size, e.g. `1.5G`.
+    """
+    for unit, factor in ( ( "T", 1024**4 ), ( "G", 1024**3 ), ( "M", 1024**2 ), ( "K", 1024 ) ):
+        if size >= factor:
+            return f"{size / factor:.1f}{unit}"
+    return f"{int( size )}B"
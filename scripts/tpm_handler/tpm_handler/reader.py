@@ -0,0 +1,200 @@
+"""
+Defines a fast, typed reader for countTables in TSV format.
+
+By default pandas infers the dtype of every column and scans every line for comments. Instead, the reader
+first probes the header of the table (skipping any leading `#` lines, such as those written by featureCounts)
+which yields the sample names without parsing any values. The table is then parsed with declared dtypes
+(string IDs and float64 counts by default) using the multithreaded CSV reader of pyarrow (if available),
+or the C engine of pandas otherwise. The counts are read into a single column-major array so that the
+`Table` can use them without any further copies.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .compression import open_file
+
+logger = logging.getLogger( "tpm_handler" )
+
+
+def probe_table( filename : str, sep : str = "\t", count_rows : bool = True ) -> dict:
+    """
+    Probes the header of a countTable without parsing any values.
+
+    Parameters
+    ----------
+    filename : str
+        The countTable.
+    sep : str, optional
+        The separator of the table. The default is "\t".
+    count_rows : bool, optional
+        Also count the number of rows (genes) of the table. This only counts the lines
+        of the file (without parsing them). The default is True.
+
+    Returns
+    -------
+    dict
+        The `index_name`, the `samples`, the number of leading comment lines to skip (`skiprows`),
+        and the number of `rows` (None if not counted).
+    """
+    skiprows = 0
+    with open_file( filename, "r" ) as f:
+        for line in f:
+            if not line.startswith( "#" ):
+                break
+            skiprows += 1
+        else:
+            line = ""
+    header = line.rstrip( "\r\n" ).split( sep )
+
+    rows = None
+    if count_rows:
+        rows = count_lines( filename ) - skiprows - 1
+    return { "index_name" : header[0], "samples" : header[1:], "skiprows" : skiprows, "rows" : rows }
+
+def count_lines( filename : str, blocksize : int = 2**24 ) -> int:
+    """
+    Counts the lines of a file (in binary blocks, without decoding them).
+    Compressed files are decompressed as a stream.
+
+    Parameters
+    ----------
+    filename : str
+        The file.
+    blocksize : int, optional
+        The number of bytes to read at once. The default is 16 MB.
+
+    Returns
+    -------
+    int
+        The number of lines (a last line without a trailing newline is counted as well).
+    """
+    lines = 0
+    last = b"\n"
+    with open_file( filename, "rb" ) as f:
+        while True:
+            block = f.read( blocksize )
+            if not block:
+                break
+            lines += block.count( b"\n" )
+            last = block[-1:]
+    return lines + ( last != b"\n" )
+
+def read_table( filename : str, sep : str = "\t", samples : list = None, dtype = np.float64, engine : str = None, filters = None ) -> pd.DataFrame:
+    """
+    Reads a countTable with declared dtypes.
+
+    Parameters
+    ----------
+    filename : str
+        The countTable (the gene IDs in the first column, one column per sample).
+    sep : str, optional
+        The separator of the table. The default is "\t".
+    samples : list, optional
+        Only read these samples (columns). By default all samples are read.
+    dtype : type, optional
+        The dtype of the counts (e.g. float32 or int32 to halve the memory). The default is float64.
+    engine : str, optional
+        The parser to use, either `pyarrow` (multithreaded) or `c` (pandas).
+        By default pyarrow is used if it is available.
+    filters : Filters, optional
+        Filters for genes and samples. With pyarrow, the excluded genes and samples are not copied into the counts.
+
+    Returns
+    -------
+    pd.DataFrame
+        The countTable (gene IDs as index), its values in column-major order.
+    """
+    array, index, columns = read_array( filename, sep, samples, dtype, engine, filters )
+    return pd.DataFrame( array, index = index, columns = columns, copy = False )
+
+def read_array( filename : str, sep : str = "\t", samples : list = None, dtype = np.float64, engine : str = None, filters = None ) -> tuple:
+    """
+    Reads a countTable with declared dtypes into an array that is owned by the caller (see `read_table`).
+
+    Returns
+    -------
+    array : np.ndarray
+        The counts (a writeable, column-major array that is not shared with pandas).
+    index : pd.Index
+        The gene IDs.
+    columns : pd.Index
+        The samples.
+    """
+    probe = probe_table( filename, sep, count_rows = False )
+    samples = list( samples ) if samples is not None else probe[ "samples" ]
+    missing = set( samples ).difference( probe[ "samples" ] )
+    if missing:
+        raise KeyError( f"The samples {sorted( missing )} are not part of {filename}." )
+
+    if engine is None:
+        try:
+            import pyarrow.csv
+            engine = "pyarrow"
+        except ImportError:
+            engine = "c"
+
+    if engine == "pyarrow":
+        index, array, samples = _read_pyarrow( filename, sep, probe, samples, dtype, filters )
+    elif engine == "c":
+        index, array, samples = _read_c( filename, sep, probe, samples, dtype, filters )
+    else:
+        raise ValueError( f"Unknown engine '{engine}'. Supported engines are 'pyarrow' and 'c'." )
+
+    return array, pd.Index( index, name = probe[ "index_name" ] ), pd.Index( samples )
+
+def _read_pyarrow( filename : str, sep : str, probe : dict, samples : list, dtype, filters = None ) -> tuple:
+    """
+    Reads a countTable using the (multithreaded) CSV reader of pyarrow.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as csv
+
+    index_name = probe[ "index_name" ]
+    types = { name : pa.from_numpy_dtype( np.dtype( dtype ) ) for name in samples }
+    types[ index_name ] = pa.string()
+    table = csv.read_csv(
+                            filename,
+                            read_options = csv.ReadOptions( skip_rows = probe[ "skiprows" ], use_threads = True ),
+                            parse_options = csv.ParseOptions( delimiter = sep ),
+                            convert_options = csv.ConvertOptions( column_types = types, include_columns = [ index_name ] + samples ),
+                        )
+
+    index = table.column( index_name ).to_numpy( zero_copy_only = False )
+
+    # the filters are checked on the parsed columns, so only the kept genes and samples are copied
+    rows = None
+    if filters is not None and filters.active:
+        rows, columns = filters.select( index, len( samples ), lambda i : table.column( samples[i] ).to_numpy() )
+        samples = [ name for name, keep in zip( samples, columns ) if keep ]
+        index = index[ rows ]
+
+    array = np.empty( ( len( index ), len( samples ) ), dtype = dtype, order = "F" )
+    for i, name in enumerate( samples ):
+        column = table.column( name ).to_numpy()
+        array[ :,i ] = column[ rows ] if rows is not None else column
+    return index, array, samples
+
+def _read_c( filename : str, sep : str, probe : dict, samples : list, dtype, filters = None ) -> tuple:
+    """
+    Reads a countTable using the C engine of pandas.
+    """
+    index_name = probe[ "index_name" ]
+    types = { name : dtype for name in samples }
+    types[ index_name ] = str
+    df = pd.read_csv(
+                        filename,
+                        sep = sep,
+                        skiprows = probe[ "skiprows" ],
+                        usecols = [ index_name ] + samples,
+                        dtype = types,
+                        index_col = 0,
+                        engine = "c",
+                    )
+    df = df[ samples ]
+    if filters is not None and filters.active:
+        df = filters.apply( df )
+    # pandas hands out (read-only) views of its own data, so the counts are copied into an array of their own
+    return df.index, np.array( df.to_numpy( dtype = dtype ), order = "F" ), list( df.columns )
@@ -0,0 +1,279 @@
+"""
+Defines a content-addressed registry of gene lengths computed from GTF files.
+
+Computing gene lengths requires parsing the entire GTF file, which takes far longer than normalising most
+countTables. Hence, computed lengths are stored in a registry directory as a compact binary index (the gene IDs
+and names as UTF-8 blocks and the lengths as int32) and re-used whenever lengths of the same GTF file are needed
+again (by `compute-length` or by `normalise -l file.gtf`). Entries are keyed by the checksum of the GTF file's
+content and the length mode, so that copies or moved GTF files are recognised while changed files are not.
+Each mode is stored as its own entry so that lengths computed with different modes can be combined.
+The registry re-uses the size limit and least recently used eviction of the `CountCache`.
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .cache import CountCache, default_cache_dir
+from .gtf import compute_lengths, length_modes
+
+logger = logging.getLogger( "tpm_handler" )
+
+default_registry_dir = os.path.join( default_cache_dir, "lengths" )
+"""
+The default directory to store the registered lengths in.
+"""
+
+default_max_bytes = 1024**3
+"""
+The default size limit of the registry (1 GB).
+"""
+
+default_mode = "merged"
+"""
+The default length mode (the last column of `compute-length` by default).
+"""
+
+
+class LengthsRegistry( CountCache ):
+    """
+    A registry of gene lengths computed from GTF files.
+
+    Parameters
+    ----------
+    directory : str, optional
+        The registry directory. By default `~/.cache/tpm_handler/lengths` is used.
+    max_bytes : int, optional
+        The maximum total size of the registry in bytes. The default is 1 GB.
+        The least recently used entries are evicted once this is exceeded.
+    """
+    suffixes = ( ".npz", ".json" )
+
+    def __init__( self, directory : str = None, max_bytes : int = default_max_bytes ):
+        super().__init__( directory if directory is not None else default_registry_dir, max_bytes )
+        self._checksums = {}
+
+    def checksum( self, filename : str, blocksize : int = 2**24 ) -> str:
+        """
+        Computes the checksum of a file's content.
+        The checksum is only computed once per file (as long as it is not modified).
+
+        Parameters
+        ----------
+        filename : str
+            The file.
+        blocksize : int, optional
+            The number of bytes to read at once. The default is 16 MB.
+
+        Returns
+        -------
+        str
+            The checksum (sha1).
+        """
+        stat = os.stat( filename )
+        stamp = ( os.path.abspath( filename ), stat.st_size, stat.st_mtime_ns )
+        checksum = self._checksums.get( stamp )
+        if checksum is None:
+            sha = hashlib.sha1()
+            with open( filename, "rb" ) as f:
+                for block in iter( lambda : f.read( blocksize ), b"" ):
+                    sha.update( block )
+            checksum = sha.hexdigest()
+            self._checksums[ stamp ] = checksum
+        return checksum
+
+    def key( self, filename : str, mode : str = default_mode ) -> str:
+        """
+        Gets the registry key of the lengths of a GTF file.
+
+        Parameters
+        ----------
+        filename : str
+            The GTF file.
+        mode : str, optional
+            The length mode. The default is "merged".
+
+        Returns
+        -------
+        str
+            The registry key.
+        """
+        return hashlib.sha1( f"{self.checksum( filename )}|{mode}".encode() ).hexdigest()
+
+    def load( self, filename : str, mode : str = default_mode ) -> pd.DataFrame:
+        """
+        Loads registered lengths of a GTF file.
+
+        Parameters
+        ----------
+        filename : str
+            The GTF file.
+        mode : str, optional
+            The length mode. The default is "merged".
+
+        Returns
+        -------
+        pd.DataFrame or None
+            The lengths (with the gene IDs as index and the `gene_name` and `<mode>` columns)
+            or None if the lengths are not registered.
+        """
+        path = self._path( self.key( filename, mode ) )
+        if not all( os.path.exists( path + suffix ) for suffix in self.suffixes ):
+            return None
+
+        with np.load( path + ".npz" ) as data:
+            ids = _decode( data[ "ids" ] )
+            names = _decode( data[ "names" ] )
+            values = data[ "lengths" ].astype( np.int64 )
+
+        # mark as recently used
+        os.utime( path + ".json" )
+        lengths = pd.DataFrame( { "gene_name" : names, mode : values }, index = pd.Index( ids, name = "gene" ) )
+        lengths[ "gene_name" ] = lengths[ "gene_name" ].replace( "", np.nan )
+        return lengths
+
+    def store( self, filename : str, lengths : pd.DataFrame, mode : str = default_mode ):
+        """
+        Registers the lengths of a GTF file.
+
+        Parameters
+        ----------
+        filename : str
+            The GTF file.
+        lengths : pd.DataFrame
+            The lengths (with the gene IDs as index, as computed by `compute_lengths` with `add_names = True`).
+        mode : str, optional
+            The length mode (the column of `lengths` to register). The default is "merged".
+        """
+        key = self.key( filename, mode )
+        path = self._path( key )
+
+        staged = self._staged( path )
+        try:
+            np.savez(
+                        staged + ".npz",
+                        ids = _encode( lengths.index ),
+                        names = _encode( lengths[ "gene_name" ].fillna( "" ) ),
+                        lengths = lengths[ mode ].to_numpy( dtype = np.int32 ),
+                    )
+            meta = { "source" : os.path.abspath( filename ), "checksum" : self.checksum( filename ), "mode" : mode }
+            with open( staged + ".json", "w" ) as f:
+                json.dump( meta, f )
+            self._publish( staged, path )
+        finally:
+            self._discard( staged )
+
+        logger.debug( f"Registered the {mode} lengths of {filename} as {key}" )
+        self.evict( keep = key )
+
+    def lengths( self, filename : str, modes : list = None ) -> pd.DataFrame:
+        """
+        Gets the lengths of a GTF file from the registry, computing (and registering) any modes that are not registered yet.
+
+        Parameters
+        ----------
+        filename : str
+            The GTF file.
+        modes : list, optional
+            The length modes (in order). By default all modes are used.
+
+        Returns
+        -------
+        pd.DataFrame
+            The lengths with the gene IDs as index, a `gene_name` column and one column per mode.
+        """
+        modes = list( modes ) if modes is not None else length_modes
+        for mode in modes:
+            if mode not in length_modes:
+                raise ValueError( f"Unknown length mode '{mode}'. Supported modes are: {length_modes}" )
+
+        found = { mode : self.load( filename, mode ) for mode in modes }
+        missing = [ mode for mode, lengths in found.items() if lengths is None ]
+        if missing:
+            computed = compute_lengths( filename, modes = missing, add_names = True )
+            for mode in missing:
+                self.store( filename, computed, mode )
+                found[ mode ] = computed.loc[ :,[ "gene_name", mode ] ]
+        else:
+            logger.info( f"Using registered lengths for {filename}..." )
+
+        lengths = found[ modes[0] ].loc[ :,[ "gene_name" ] ]
+        for mode in modes:
+            lengths[ mode ] = found[ mode ][ mode ].to_numpy()
+        return lengths
+
+    def compute( self, filename : str, outfile : str = None, modes : list = None, add_names : bool = False, swap_ids_and_names : bool = False ) -> pd.DataFrame:
+        """
+        Computes the lengths of gene features from a GTF file (like `compute_lengths`), re-using registered lengths if available.
+
+        Parameters
+        ----------
+        filename : str
+            The input GTF file.
+        outfile : str, optional
+            The output file. If provided, the lengths are written to this file.
+        modes : list, optional
+            The length modes to compute (in order). By default all modes are computed.
+        add_names : bool, optional
+            Also add a column with gene names (will be 2nd column). The default is False.
+        swap_ids_and_names : bool, optional
+            Whether to swap the IDs and names. The default is False.
+            If True then the names are the 1st column and IDs are the 2nd column.
+
+        Returns
+        -------
+        lengths : pd.DataFrame
+            The lengths of the genes.
+        """
+        lengths = self.lengths( filename, modes )
+        names = lengths.pop( "gene_name" )
+
+        if add_names:
+            idx = 0 if swap_ids_and_names else 1
+            lengths = lengths.reset_index()
+            lengths.insert( idx, "gene_name", names.to_numpy() )
+            lengths = lengths.set_index( lengths.columns[0] )
+
+        if outfile is not None:
+            lengths.to_csv( outfile, sep = "\t", index = True )
+            logger.info( f"Saved to file: {outfile}" )
+        return lengths
+
+
+def gtf_lengths( filename : str, mode : str = None, registry : LengthsRegistry = None ) -> pd.DataFrame:
+    """
+    Gets the lengths of a GTF file in the format of `read_lengths` (using the registry).
+
+    Parameters
+    ----------
+    filename : str
+        The GTF file.
+    mode : str, optional
+        The length mode. The default is "merged".
+    registry : LengthsRegistry, optional
+        The registry to use. By default the registry in `~/.cache/tpm_handler/lengths` is used.
+
+    Returns
+    -------
+    pd.DataFrame
+        A dataframe with the IDs as index and two columns, the names and the lengths of the features.
+    """
+    registry = registry if registry is not None else LengthsRegistry()
+    return registry.lengths( filename, [ mode or default_mode ] )
+
+
+def _encode( values ) -> np.ndarray:
+    """
+    Encodes strings as a single block of newline-separated UTF-8 bytes.
+    """
+    return np.frombuffer( "\n".join( str( i ) for i in values ).encode(), dtype = np.uint8 )
+
+def _decode( block : np.ndarray ) -> list:
+    """
+    Decodes a block of newline-separated UTF-8 bytes.
+    """
+    return block.tobytes().decode().split( "\n" )
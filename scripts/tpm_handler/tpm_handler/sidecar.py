@@ -0,0 +1,291 @@
+"""
+Defines a compact sidecar file that records how a normalised table was computed.
+
+Normalising a countTable computes one scaling factor per sample (the column sums of the (length-normalised)
+counts), which are otherwise discarded. The sidecar (`<table>.factors.npz`) stores these factors together
+with the normalisation method, the order of the genes and samples in the table, the lengths of the genes
+and a fingerprint of the lengths that were used. With it, a normalised table can be re-exported at another
+precision, restored to (length-scaled) counts, or converted to another method that uses the same kind of
+factors (e.g. `cpm` to `rpkm`) in a single streaming pass over the table, without re-reading the raw counts.
+"""
+
+import time
+import hashlib
+import logging
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+
+from .engines import get_engine
+from .registry import _encode, _decode
+from .pipeline import Timings, Writer, background
+from .writer import format_rows, format_header
+from .columnar import columnar_format, write_columnar
+from .compression import open_file
+
+logger = logging.getLogger( "tpm_handler" )
+
+sidecar_suffix = ".factors.npz"
+"""
+The suffix of sidecar files (appended to the name of the normalised table).
+"""
+
+restore_targets = [ "counts", "length-scaled" ]
+"""
+The values that normalised values can be restored to (besides other methods using the same kind of factors).
+`counts` are the raw counts and `length-scaled` are the counts divided by the feature lengths.
+"""
+
+
+def sidecar_file( filename : str ) -> str:
+    """
+    Gets the sidecar file of a normalised table.
+    """
+    return filename if filename.endswith( sidecar_suffix ) else filename + sidecar_suffix
+
+def lengths_fingerprint( lengths : pd.DataFrame ) -> str:
+    """
+    Computes a fingerprint of lengths (their IDs and lengths, in order).
+
+    Parameters
+    ----------
+    lengths : pd.DataFrame
+        The lengths (the IDs as index and the lengths as last column), as returned by `read_lengths`.
+
+    Returns
+    -------
+    str
+        The fingerprint (sha1).
+    """
+    sha = hashlib.sha1( _encode( lengths.index ).tobytes() )
+    sha.update( lengths.iloc[ :,-1 ].to_numpy( dtype = float ).tobytes() )
+    return sha.hexdigest()
+
+
+class Sidecar:
+    """
+    The scaling factors and layout of a normalised table.
+
+    Parameters
+    ----------
+    method : str
+        The normalisation method (engine) of the table.
+    factors : np.ndarray
+        The scaling factor of each sample.
+    samples : list or pd.Index
+        The samples (columns) of the table.
+    genes : list or pd.Index
+        The genes (rows) of the table, in order.
+    lengths : np.ndarray, optional
+        The length of each gene (in order). Not available if the rows were aggregated.
+    fingerprint : str, optional
+        The fingerprint of the lengths used for the normalisation.
+    digits : int, optional
+        The number of digits the table was written with.
+    """
+    def __init__( self, method : str, factors : np.ndarray, samples, genes, lengths : np.ndarray = None, fingerprint : str = None, digits : int = None ):
+        self.method = method
+        self.factors = np.asarray( factors, dtype = float )
+        self.samples = pd.Index( samples )
+        self.genes = pd.Index( genes )
+        self.lengths = np.asarray( lengths, dtype = float ) if lengths is not None else None
+        self.fingerprint = fingerprint
+        self.digits = digits
+        if len( self.factors ) != len( self.samples ):
+            raise ValueError( f"Got {len( self.factors )} scaling factors but {len( self.samples )} samples." )
+        if self.lengths is not None and len( self.lengths ) != len( self.genes ):
+            raise ValueError( f"Got {len( self.lengths )} lengths but {len( self.genes )} genes." )
+
+    @property
+    def engine( self ):
+        """
+        The normalisation engine of the table.
+        """
+        return get_engine( self.method )
+
+    def write( self, filename : str ):
+        """
+        Writes the sidecar.
+
+        Parameters
+        ----------
+        filename : str
+            The normalised table (the sidecar is written to `<filename>.factors.npz`) or the sidecar file itself.
+        """
+        np.savez(
+                    sidecar_file( filename ),
+                    method = np.array( self.method ),
+                    factors = self.factors,
+                    samples = _encode( self.samples ),
+                    genes = _encode( self.genes ),
+                    lengths = self.lengths if self.lengths is not None else np.zeros( 0 ),
+                    has_lengths = np.array( self.lengths is not None ),
+                    fingerprint = np.array( self.fingerprint or "" ),
+                    digits = np.array( self.digits if self.digits is not None else -1 ),
+                )
+
+    @classmethod
+    def read( cls, filename : str ) -> "Sidecar":
+        """
+        Reads a sidecar.
+
+        Parameters
+        ----------
+        filename : str
+            The normalised table or the sidecar file itself.
+
+        Returns
+        -------
+        Sidecar
+            The sidecar.
+        """
+        with np.load( sidecar_file( filename ) ) as data:
+            digits = int( data[ "digits" ] )
+            return cls(
+                        str( data[ "method" ] ),
+                        data[ "factors" ],
+                        _decode( data[ "samples" ] ),
+                        _decode( data[ "genes" ] ),
+                        lengths = data[ "lengths" ] if bool( data[ "has_lengths" ] ) else None,
+                        fingerprint = str( data[ "fingerprint" ] ) or None,
+                        digits = digits if digits >= 0 else None,
+                    )
+
+    def check_lengths( self, lengths : pd.DataFrame ):
+        """
+        Checks that lengths are the same as those used for the normalisation.
+
+        Parameters
+        ----------
+        lengths : pd.DataFrame
+            The lengths, as returned by `read_lengths`.
+        """
+        if self.fingerprint is not None and lengths_fingerprint( lengths ) != self.fingerprint:
+            raise ValueError( "The lengths differ from the lengths the table was normalised with." )
+
+    def convert( self, values : np.ndarray, start : int = 0, to : str = None, out : np.ndarray = None ) -> np.ndarray:
+        """
+        Converts (a chunk of rows of) the normalised values.
+
+        Parameters
+        ----------
+        values : np.ndarray
+            The normalised values.
+        start : int, optional
+            The position of the first row of `values` in the table. The default is 0.
+        to : str, optional
+            What to convert the values to: `counts` (the raw counts), `length-scaled` (the counts divided
+            by the feature lengths), or another method (engine) that uses the same kind of scaling factors.
+            By default the values are returned as they are.
+        out : np.ndarray, optional
+            An array to store the values in (may be `values` itself). By default a new array is created.
+
+        Returns
+        -------
+        np.ndarray
+            The converted values.
+        """
+        if to is None or to == self.method:
+            return values
+        engine = self.engine
+        target = None if to in restore_targets else get_engine( to )
+        if target is not None and target.factor_kind != engine.factor_kind:
+            raise ValueError( f"The {self.method} values can not be converted to {to} (which uses different scaling factors)." )
+
+        lengths = None
+        if engine.uses_lengths or to == "length-scaled" or ( target is not None and target.uses_lengths ):
+            if self.lengths is None:
+                raise ValueError( "The sidecar has no lengths (were the rows aggregated?), so the values can not be converted." )
+            lengths = self.lengths[ start:start + len( values ) ]
+
+        counts = engine.invert( values, lengths, self.factors, out = out )
+        if to == "counts":
+            return counts
+        if to == "length-scaled":
+            return np.divide( counts, lengths[ :, None ], out = counts )
+        return target.apply( counts, lengths, factors = self.factors, out = counts )
+
+    def __repr__( self ) -> str:
+        return f"Sidecar(method='{self.method}', {len( self.genes )} genes x {len( self.samples )} samples)"
+
+
+def reexport( filename : str, outfile : str, digits : int = 5, to : str = None, lengths : pd.DataFrame = None, chunksize : int = 10000, sep : str = "\t", queue_size : int = 4 ) -> Timings:
+    """
+    Re-exports a normalised table using its sidecar, at another precision and / or converted
+    to (length-scaled) counts or another method, in a single streaming pass over the table.
+
+    Parameters
+    ----------
+    filename : str
+        The normalised table (with a sidecar).
+    outfile : str
+        The output file. Parquet and Feather outputs are assembled in memory.
+    digits : int, optional
+        The number of digits to round to. The default is 5.
+        If None, the values are written as they are.
+    to : str, optional
+        Convert the values to `counts`, `length-scaled` counts or another method that uses the
+        same kind of scaling factors (see `Sidecar.convert`). By default the values are not converted.
+    lengths : pd.DataFrame, optional
+        Check that the table was normalised with these lengths.
+    chunksize : int, optional
+        The number of rows per chunk. The default is 10000.
+    sep : str, optional
+        The separator of the table. The default is "\t".
+    queue_size : int, optional
+        The number of chunks that are held between the stages of the pipeline. The default is 4.
+
+    Returns
+    -------
+    Timings
+        The time spent reading, converting and writing.
+    """
+    from .stream import read_chunks
+
+    sidecar = Sidecar.read( filename )
+    if lengths is not None:
+        sidecar.check_lengths( lengths )
+    if to is None and sidecar.digits is not None and digits is not None and digits > sidecar.digits:
+        logger.warning( f"The table was written with {sidecar.digits} digits, so re-exporting it at {digits} digits does not increase its precision." )
+
+    timings = Timings()
+    fmt = columnar_format( outfile )
+    parts = []
+    start = 0
+    with open_file( outfile, "w" ) if fmt is None else nullcontext() as f, Writer( queue_size, timings ) as writer:
+        for chunk in background( read_chunks( filename, chunksize, sep ), queue_size, timings ):
+            began = time.perf_counter()
+            if start == 0 and not chunk.columns.equals( sidecar.samples ):
+                raise ValueError( f"The samples of {filename} do not match its sidecar." )
+            if not chunk.index.equals( sidecar.genes[ start:start + len( chunk ) ] ):
+                raise ValueError( f"The genes of {filename} do not match its sidecar (rows {start} to {start + len( chunk )})." )
+
+            values = sidecar.convert( chunk.to_numpy( dtype = float ), start, to )
+            if fmt is not None:
+                parts.append( values )
+            else:
+                if start == 0:
+                    writer.write( f, format_header( chunk.index.name, chunk.columns, sep ) )
+                if digits is None:
+                    text = pd.DataFrame( values, index = chunk.index, columns = chunk.columns ).to_csv( None, sep = sep, header = False )
+                else:
+                    text = format_rows( values, chunk.index, digits, sep )
+                writer.write( f, text )
+            start += len( chunk )
+            timings.add( "compute", time.perf_counter() - began )
+
+    if start != len( sidecar.genes ):
+        raise ValueError( f"{filename} has {start} genes, but its sidecar has {len( sidecar.genes )}." )
+    if fmt is not None:
+        array = np.concatenate( parts ) if parts else np.zeros( ( 0, len( sidecar.samples ) ) )
+        write_columnar( outfile, array, sidecar.genes, sidecar.samples, digits = digits )
+
+    # the re-exported table gets its own sidecar (unless it holds counts)
+    if to not in restore_targets:
+        method = to if to is not None else sidecar.method
+        Sidecar( method, sidecar.factors, sidecar.samples, sidecar.genes, sidecar.lengths, sidecar.fingerprint, digits ).write( outfile )
+
+    logger.info( f"Saved to file: {outfile}" )
+    logger.info( f"Stage timings: {timings}" )
+    return timings
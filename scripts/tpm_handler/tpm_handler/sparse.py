@@ -0,0 +1,245 @@
+"""
+Defines classes and functions for handling sparse countTables (e.g. from single-cell data) without ever making them dense.
+
+Single-cell countTables are usually dominated by zeros. Hence, they are kept as a scipy.sparse CSC matrix
+(one compressed column per sample) and TPM is only computed on the non-zero entries. The `SparseFrame`
+imitates the few methods of a pandas DataFrame that the `Table` requires, so it can be used just like the dense data.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from scipy.io import mmread
+from contextlib import nullcontext
+
+from .compression import open_file
+
+
+def read_mtx( filename : str, rows : str = None, cols : str = None ) -> "SparseFrame":
+    """
+    Reads a countTable from a MatrixMarket (mtx) file.
+
+    Parameters
+    ----------
+    filename : str
+        The mtx file (features x samples).
+    rows : str, optional
+        A file containing the feature IDs (one per line, the first column is used).
+        By default a `mtx_rows` file of the same name as the input file is used (if it exists).
+    cols : str, optional
+        A file containing the sample names (one per line, the first column is used).
+        By default a `mtx_cols` file of the same name as the input file is used (if it exists).
+
+    Returns
+    -------
+    SparseFrame
+        The sparse countTable.
+    """
+    matrix = mmread( filename ).tocsc()
+
+    rows = rows if rows is not None else f"{filename}_rows"
+    cols = cols if cols is not None else f"{filename}_cols"
+    index = _read_names( rows, matrix.shape[0] )
+    columns = _read_names( cols, matrix.shape[1] )
+
+    return SparseFrame( matrix, index, columns )
+
+def _read_names( filename : str, n : int ) -> pd.Index:
+    """
+    Reads the first column of a names file (such as `mtx_rows`)
+    or enumerates the names if the file does not exist.
+    """
+    if not os.path.exists( filename ):
+        return pd.RangeIndex( n )
+    names = pd.read_csv( filename, sep = "\t", header = None, usecols = [0], dtype = str )
+    return pd.Index( names.iloc[ :,0 ] )
+
+def sparse_to_tpm( matrix : sparse.spmatrix, lengths : np.ndarray, factors : np.ndarray = None ):
+    """
+    Convert raw counts to TPM, computing only on the non-zero entries.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.spmatrix
+        The raw counts. As a sparse (preferably CSC) matrix.
+    lengths : np.ndarray
+        The lengths of the features. As a 1D ndarray.
+    factors : np.ndarray, optional
+        The column sums of the length-normalised counts to scale each column by.
+        By default these are computed from `matrix` itself.
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix
+        The TPM values.
+
+    Note
+    ----
+    Columns without any counts remain zeros (whereas the dense conversion yields NaNs).
+    """
+    return sparse_scale_columns( matrix, lengths, factors )
+
+def sparse_scale_columns( matrix : sparse.spmatrix, lengths : np.ndarray = None, factors : np.ndarray = None, scale : float = 10**6, length_before : bool = True, length_after : bool = False ):
+    """
+    The column-scaling kernel of the normalisation engines for sparse matrices, 
+    computing only on the non-zero entries.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.spmatrix
+        The raw counts. As a sparse (preferably CSC) matrix.
+    lengths : np.ndarray, optional
+        The lengths of the features. Only required if `length_before` or `length_after`.
+    factors : np.ndarray, optional
+        The column sums to scale each column by. By default these are computed from `matrix` itself.
+    scale : float, optional
+        The value each column is scaled to sum up to. The default is one million.
+    length_before : bool, optional
+        Divide the counts by the lengths before scaling. The default is True.
+    length_after : bool, optional
+        Divide the scaled values by the lengths. The default is False.
+
+    Returns
+    -------
+    scipy.sparse.csc_matrix
+        The scaled values.
+    """
+    if length_before or length_after:
+        lengths = np.asarray( lengths, dtype = float )
+        if len(lengths) != matrix.shape[0]:
+            raise IndexError( "The length of the lengths array does not match the length of the raw counts array." )
+
+    values = sparse.csc_matrix( matrix, dtype = float, copy = True )
+    if length_before:
+        values.data /= lengths[ values.indices ]
+
+    if factors is None:
+        factors = np.asarray( values.sum( axis = 0 ) ).ravel()
+    values.data /= np.repeat( factors / scale, np.diff( values.indptr ) )
+
+    if length_after:
+        values.data /= lengths[ values.indices ]
+    return values
+
+def round_sparse( matrix : sparse.spmatrix, digits : int = 5 ):
+    """
+    Rounds the non-zero entries of a sparse matrix to a certain number of digits (in place).
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.spmatrix
+        The matrix.
+    digits : int, optional
+        The number of digits to round to. The default is 5.
+
+    Returns
+    -------
+    scipy.sparse.spmatrix
+        The rounded matrix.
+    """
+    np.round( matrix.data, digits, out = matrix.data )
+    matrix.eliminate_zeros()
+    return matrix
+
+
+class _SparseIndexer:
+    """
+    Imitates the `iloc` row indexing of a pandas DataFrame for a SparseFrame.
+    """
+    def __init__( self, frame : "SparseFrame" ):
+        self._frame = frame
+
+    def __getitem__( self, key ):
+        rows = key[0] if isinstance( key, tuple ) else key
+        frame = self._frame
+        return SparseFrame( frame.matrix[ rows,: ], frame.index[ rows ], frame.columns )
+
+
+class SparseFrame:
+    """
+    A sparse countTable that imitates the methods of a pandas DataFrame that the `Table` requires.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.spmatrix
+        The counts (features x samples).
+    index : list or pd.Index
+        The feature IDs.
+    columns : list or pd.Index
+        The sample names.
+    """
+    def __init__( self, matrix : sparse.spmatrix, index, columns ):
+        self.matrix = sparse.csc_matrix( matrix )
+        self.index = index
+        self.columns = columns
+        if self.matrix.shape != ( len(self.index), len(self.columns) ):
+            raise ValueError( f"The shape of the matrix {self.matrix.shape} does not match the index and columns ({len(self.index)}, {len(self.columns)})." )
+
+    @property
+    def index( self ) -> pd.Index:
+        return self._index
+
+    @index.setter
+    def index( self, index ):
+        self._index = pd.Index( index )
+
+    @property
+    def columns( self ) -> pd.Index:
+        return self._columns
+
+    @columns.setter
+    def columns( self, columns ):
+        self._columns = pd.Index( columns )
+
+    @property
+    def iloc( self ):
+        return _SparseIndexer( self )
+
+    @property
+    def shape( self ):
+        return self.matrix.shape
+
+    def to_numpy( self ):
+        """
+        Returns the sparse matrix (not a dense array!).
+        """
+        return self.matrix
+
+    def copy( self ):
+        return SparseFrame( self.matrix.copy(), self.index.copy(), self.columns.copy() )
+
+    def head( self, n : int = 5 ) -> pd.DataFrame:
+        return self.to_frame( slice( 0, n ) )
+
+    def to_frame( self, rows = slice( None ) ) -> pd.DataFrame:
+        """
+        Returns a dense pandas DataFrame of (a subset of) the rows.
+        """
+        matrix = self.matrix[ rows,: ]
+        return pd.DataFrame( matrix.toarray(), index = self.index[ rows ], columns = self.columns )
+
+    def to_csv( self, filename : str, sep : str = "\t", index : bool = True, chunksize : int = 10000, **kwargs ):
+        """
+        Writes the table to a file, making only chunks of rows dense at a time.
+
+        Parameters
+        ----------
+        filename : str or file
+            The output file (or an open file).
+        sep : str, optional
+            The separator of the table. The default is "\t".
+        index : bool, optional
+            Whether to write the index. The default is True.
+        chunksize : int, optional
+            The number of rows to make dense at a time. The default is 10000.
+        """
+        rows = sparse.csr_matrix( self.matrix )
+        with open_file( filename, "w" ) if isinstance( filename, str ) else nullcontext( filename ) as f:
+            for start in range( 0, max( rows.shape[0], 1 ), chunksize ):
+                stop = start + chunksize
+                chunk = pd.DataFrame( rows[ start:stop,: ].toarray(), index = self.index[ start:stop ], columns = self.columns )
+                chunk.to_csv( f, sep = sep, index = index, header = start == 0, **kwargs )
+
+    def __len__( self ) -> int:
+        return self.matrix.shape[0]
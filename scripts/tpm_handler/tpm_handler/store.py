@@ -0,0 +1,445 @@
+"""
+Defines a chunked on-disk matrix store for expression matrices that are too large for memory.
+
+The store is an HDF5 file that holds the counts as a chunked (genes x samples) array alongside the gene IDs and
+sample names. Normalisation runs block by block over the rows of the store (in two passes, like `--stream`) and
+writes the normalised values as another chunked array into the same store, together with the per-sample scaling
+factors and the lengths that were used. Since all arrays are chunked, consumers can read arbitrary genes or
+samples without reading the whole store.
+
+Layout of a store::
+
+    /counts             genes x samples (chunked, compressed)
+    /genes              gene IDs (with the index name as attribute)
+    /samples            sample names
+    /lengths            the lengths of the genes (NaN if not available), set when normalising
+    /<method>           the normalised values (e.g. /tpm), genes without lengths are NaN
+    /factors/<method>   the per-sample scaling factors of each method
+
+Note
+----
+This requires the optional dependency `h5py`.
+"""
+
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .engines import get_engine
+from .geneindex import gene_index
+from .writer import format_rows, format_header
+from .compression import open_file
+
+logger = logging.getLogger( "tpm_handler" )
+
+store_suffixes = ( ".h5", ".hdf5" )
+"""
+The file suffixes of matrix stores.
+"""
+
+
+def is_store( filename : str ) -> bool:
+    """
+    Checks if a file is a matrix store (based on its suffix).
+    """
+    return os.path.splitext( str( filename ) )[1].lower() in store_suffixes
+
+
+class MatrixStore:
+    """
+    A chunked on-disk store of an expression matrix.
+
+    Parameters
+    ----------
+    filename : str
+        The store file (`.h5`).
+    mode : str, optional
+        The mode to open the store in (`r`, `r+`, `w` or `a`). The default is `r`.
+    """
+    def __init__( self, filename : str, mode : str = "r" ):
+        h5py = _import_h5py()
+        self.filename = filename
+        self.file = h5py.File( filename, mode )
+
+    @classmethod
+    def create( cls, filename : str, samples, index_name : str = "gene_id", dtype = np.float64, block_rows : int = 4096, block_cols : int = 64, compression : str = "gzip" ) -> "MatrixStore":
+        """
+        Creates a new (empty) store. Rows (genes) can then be added using `append`.
+
+        Parameters
+        ----------
+        filename : str
+            The store file. An existing file is overwritten.
+        samples : list
+            The sample names.
+        index_name : str, optional
+            The name of the gene index. The default is "gene_id".
+        dtype : type, optional
+            The dtype of the counts. The default is float64 (float32 halves the size of the store
+            and is exact for integer counts below ~16 million).
+        block_rows : int, optional
+            The number of genes per chunk. The default is 4096.
+        block_cols : int, optional
+            The number of samples per chunk. The default is 64.
+        compression : str, optional
+            The compression of the chunks (`gzip`, `lzf` or None). The default is `gzip`.
+
+        Returns
+        -------
+        MatrixStore
+            The store (opened for writing).
+        """
+        h5py = _import_h5py()
+        store = cls( filename, "w" )
+        samples = [ str( i ) for i in samples ]
+        store.file.create_dataset( "samples", data = samples, dtype = h5py.string_dtype() )
+        genes = store.file.create_dataset( "genes", shape = ( 0, ), maxshape = ( None, ), dtype = h5py.string_dtype(), chunks = ( block_rows, ) )
+        genes.attrs[ "index_name" ] = index_name if index_name is not None else "gene_id"
+        store._create_matrix( "counts", 0, dtype, block_rows, block_cols, compression )
+        return store
+
+    def append( self, array, genes ):
+        """
+        Appends rows (genes) to the counts of the store.
+
+        Parameters
+        ----------
+        array : np.ndarray
+            The counts of the genes. As a 2D ndarray (or a sparse matrix).
+        genes : list
+            The gene IDs.
+        """
+        array = array.toarray() if hasattr( array, "toarray" ) else np.asarray( array )
+        counts, ids = self.file[ "counts" ], self.file[ "genes" ]
+        if array.shape[1] != counts.shape[1]:
+            raise IndexError( f"Got {array.shape[1]} samples but the store has {counts.shape[1]} samples." )
+        start = counts.shape[0]
+        counts.resize( start + len( array ), axis = 0 )
+        ids.resize( start + len( array ), axis = 0 )
+        counts[ start:, : ] = array
+        ids[ start: ] = [ str( i ) for i in genes ]
+
+    @property
+    def genes( self ) -> pd.Index:
+        """
+        The gene IDs.
+        """
+        genes = self.file[ "genes" ]
+        return pd.Index( genes.asstr()[:], name = genes.attrs.get( "index_name" ) )
+
+    @property
+    def samples( self ) -> pd.Index:
+        """
+        The sample names.
+        """
+        return pd.Index( self.file[ "samples" ].asstr()[:] )
+
+    @property
+    def shape( self ) -> tuple:
+        """
+        The shape of the matrix (genes x samples).
+        """
+        return self.file[ "counts" ].shape
+
+    @property
+    def datasets( self ) -> list:
+        """
+        The matrices in the store (the counts and any normalised values).
+        """
+        return [ name for name, item in self.file.items() if name not in ( "genes", "samples", "lengths" ) and getattr( item, "ndim", 0 ) == 2 ]
+
+    def factors( self, method : str ) -> np.ndarray:
+        """
+        Gets the per-sample scaling factors of a normalisation method.
+
+        Parameters
+        ----------
+        method : str
+            The normalisation method.
+
+        Returns
+        -------
+        np.ndarray
+            The scaling factors.
+        """
+        return self.file[ f"factors/{method}" ][:]
+
+    def get( self, genes = None, samples = None, dataset : str = "counts" ) -> pd.DataFrame:
+        """
+        Reads a subset of a matrix from the store.
+
+        Parameters
+        ----------
+        genes : list or slice, optional
+            The gene IDs (or a slice of rows) to read. By default all genes are read.
+        samples : list or slice, optional
+            The sample names (or a slice of columns) to read. By default all samples are read.
+        dataset : str, optional
+            The matrix to read (e.g. `counts` or `tpm`). The default is `counts`.
+
+        Returns
+        -------
+        pd.DataFrame
+            The matrix subset (gene IDs as index).
+        """
+        data = self.file[ dataset ]
+        rows, index = _select( genes, self.genes )
+        cols, columns = _select( samples, self.samples )
+
+        # h5py can only select increasing positions along a single axis
+        # so the rows are read first (as a block of the columns' range)
+        if isinstance( cols, slice ):
+            array = data[ rows, cols ] if isinstance( rows, slice ) else _take( data, rows, cols )
+        else:
+            order = np.argsort( cols )
+            span = slice( int( cols[ order[0] ] ), int( cols[ order[-1] ] ) + 1 ) if len( cols ) else slice( 0, 0 )
+            array = data[ rows, span ] if isinstance( rows, slice ) else _take( data, rows, span )
+            array = array[ :, np.asarray( cols ) - span.start ]
+
+        return pd.DataFrame( np.asfortranarray( array ), index = index, columns = columns, copy = False )
+
+    def blocks( self, dataset : str = "counts", block_rows : int = None ):
+        """
+        Iterates over a matrix of the store in blocks of rows.
+
+        Parameters
+        ----------
+        dataset : str, optional
+            The matrix to iterate over. The default is `counts`.
+        block_rows : int, optional
+            The number of rows per block. By default the chunk size of the store.
+
+        Yields
+        ------
+        start : int
+            The first row of the block.
+        block : np.ndarray
+            The block of rows.
+        """
+        data = self.file[ dataset ]
+        block_rows = block_rows or ( data.chunks[0] if data.chunks else 4096 )
+        for start in range( 0, data.shape[0], block_rows ):
+            yield start, data[ start:start + block_rows ]
+
+    def normalise( self, lengths : pd.DataFrame = None, method : str = "tpm", digits : int = None, block_rows : int = None, dtype = np.float64 ):
+        """
+        Normalises the counts of the store block by block and stores the values as a new matrix.
+
+        Parameters
+        ----------
+        lengths : pd.DataFrame, optional
+            The lengths of the features (the IDs as index, lengths as last column). As returned by `read_lengths`.
+            Genes without lengths are NaN in the normalised matrix and are ignored for the scaling factors.
+        method : str, optional
+            The normalisation method (engine) to use. The default is "tpm".
+            The values are stored in a matrix of the same name.
+        digits : int, optional
+            The number of digits to round to. By default the values are not rounded.
+        block_rows : int, optional
+            The number of rows per block. By default the chunk size of the store.
+        dtype : type, optional
+            The dtype of the normalised values. The default is float64.
+        """
+        engine = get_engine( method )
+        if engine.uses_lengths and lengths is None:
+            raise ValueError( f"The method '{engine.name}' requires lengths." )
+        if lengths is not None:
+            self.set_lengths( lengths )
+        gene_lengths = self.file[ "lengths" ][:] if "lengths" in self.file else np.ones( self.shape[0] )
+        mask = ~np.isnan( gene_lengths )
+
+        logger.info( f"Computing {engine.name} scaling factors (first pass)..." )
+        factors = np.zeros( self.shape[1] )
+        for start, block in self.blocks( block_rows = block_rows ):
+            m = mask[ start:start + len( block ) ]
+            factors += engine.factors( block[ m ].astype( float ), gene_lengths[ start:start + len( block ) ][ m ] )
+        self._write( f"factors/{engine.name}", factors )
+
+        logger.info( f"Normalising to {engine.name} (second pass)..." )
+        counts = self.file[ "counts" ]
+        self._create_matrix( engine.name, self.shape[0], dtype, *counts.chunks, counts.compression )
+        out = self.file[ engine.name ]
+        for start, block in self.blocks( block_rows = block_rows ):
+            m = mask[ start:start + len( block ) ]
+            values = np.full( block.shape, np.nan )
+            values[ m ] = engine.apply( block[ m ].astype( float ), gene_lengths[ start:start + len( block ) ][ m ], factors = factors )
+            if digits is not None:
+                np.round( values, digits, out = values )
+            out[ start:start + len( block ) ] = values
+
+        logger.info( f"Stored {engine.name} values in {self.filename}" )
+
+    def set_lengths( self, lengths : pd.DataFrame ):
+        """
+        Stores the lengths of the genes (aligned to the genes of the store).
+
+        Parameters
+        ----------
+        lengths : pd.DataFrame
+            The lengths of the features (the IDs as index, lengths as last column).
+        """
+        idx = gene_index( lengths ).join( self.genes )
+        aligned = np.full( len( idx ), np.nan )
+        aligned[ idx >= 0 ] = lengths.iloc[ idx[ idx >= 0 ], -1 ].to_numpy( dtype = float )
+        self._write( "lengths", aligned )
+
+    def export( self, filename : str, dataset : str = "tpm", digits : int = 5, block_rows : int = None, sep : str = "\t" ):
+        """
+        Writes a matrix of the store to a text file block by block.
+        Genes without lengths (if lengths were set) are omitted.
+
+        Parameters
+        ----------
+        filename : str
+            The output file.
+        dataset : str, optional
+            The matrix to export. The default is `tpm`.
+        digits : int, optional
+            The number of digits to round to. The default is 5.
+        block_rows : int, optional
+            The number of rows per block. By default the chunk size of the store.
+        sep : str, optional
+            The separator to use. The default is "\t".
+        """
+        genes = self.genes
+        mask = ~np.isnan( self.file[ "lengths" ][:] ) if "lengths" in self.file else np.ones( len( genes ), dtype = bool )
+        with open_file( filename, "w" ) as f:
+            f.write( format_header( genes.name, self.samples, sep ) )
+            for start, block in self.blocks( dataset, block_rows ):
+                m = mask[ start:start + len( block ) ]
+                f.write( format_rows( block[ m ], genes[ start:start + len( block ) ][ m ], digits, sep ) )
+        logger.info( f"Saved to file: {filename}" )
+
+    def close( self ):
+        """
+        Closes the store.
+        """
+        self.file.close()
+
+    def _create_matrix( self, name : str, rows : int, dtype, block_rows : int, block_cols : int, compression : str = None ):
+        """
+        Creates a (resizable) chunked matrix, replacing any existing matrix of the same name.
+        """
+        if name in self.file:
+            del self.file[ name ]
+        samples = len( self.file[ "samples" ] )
+        self.file.create_dataset(
+                                    name,
+                                    shape = ( rows, samples ),
+                                    maxshape = ( None, samples ),
+                                    dtype = dtype,
+                                    chunks = ( max( block_rows, 1 ), max( min( block_cols, samples ), 1 ) ),
+                                    compression = compression,
+                                )
+
+    def _write( self, name : str, values : np.ndarray ):
+        """
+        Writes (or replaces) a small dataset.
+        """
+        if name in self.file:
+            del self.file[ name ]
+        self.file.create_dataset( name, data = values )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+    def __repr__( self ) -> str:
+        return f"MatrixStore('{self.filename}', shape={self.shape}, datasets={self.datasets})"
+
+
+def write_store( filename : str, array, index, columns, index_name : str = None, block_rows : int = 4096, **kwargs ):
+    """
+    Writes an (in-memory) expression matrix to a new store.
+
+    Parameters
+    ----------
+    filename : str
+        The store file.
+    array : np.ndarray
+        The matrix. As a 2D ndarray (or a sparse matrix).
+    index : list
+        The gene IDs.
+    columns : list
+        The sample names.
+    index_name : str, optional
+        The name of the gene index.
+    block_rows : int, optional
+        The number of genes per chunk. The default is 4096.
+    **kwargs
+        Any other arguments for `MatrixStore.create`.
+    """
+    if hasattr( array, "tocsr" ):
+        array = array.tocsr()
+    index = list( index )
+    with MatrixStore.create( filename, columns, index_name, block_rows = block_rows, **kwargs ) as store:
+        for start in range( 0, array.shape[0], block_rows ):
+            store.append( array[ start:start + block_rows ], index[ start:start + block_rows ] )
+
+def build_store( filename : str, outfile : str, chunksize : int = 10000, sep : str = "\t", **kwargs ):
+    """
+    Converts a countTable to a store chunk-wise (without loading it into memory entirely).
+
+    Parameters
+    ----------
+    filename : str
+        The input count table.
+    outfile : str
+        The store file.
+    chunksize : int, optional
+        The number of rows to read at once. The default is 10000.
+    sep : str, optional
+        The separator of the table. The default is "\t".
+    **kwargs
+        Any other arguments for `MatrixStore.create`.
+    """
+    from .stream import read_chunks
+
+    store = None
+    try:
+        for chunk in read_chunks( filename, chunksize, sep ):
+            if store is None:
+                store = MatrixStore.create( outfile, chunk.columns, chunk.index.name, **kwargs )
+            store.append( chunk.to_numpy(), chunk.index )
+    finally:
+        if store is not None:
+            store.close()
+    logger.info( f"Saved to file: {outfile}" )
+
+
+def _select( key, names : pd.Index ):
+    """
+    Converts a selection of names (or a slice) to positions.
+    """
+    if key is None:
+        return slice( None ), names
+    if isinstance( key, slice ):
+        return key, names[ key ]
+    positions = names.get_indexer( key )
+    if ( positions < 0 ).any():
+        raise KeyError( f"{np.sum( positions < 0 )} of the selected entries are not part of the store." )
+    return positions, names[ positions ]
+
+def _take( data, rows : np.ndarray, cols : slice ) -> np.ndarray:
+    """
+    Reads arbitrary rows (in any order, possibly repeated) of a column range of a dataset.
+    """
+    if not len( rows ):
+        return np.empty( ( 0, len( range( *cols.indices( data.shape[1] ) ) ) ), dtype = data.dtype )
+    # h5py needs strictly increasing positions, so each row is read once
+    unique, inverse = np.unique( np.asarray( rows ), return_inverse = True )
+    return data[ unique, cols ][ inverse ]
+
+def _import_h5py():
+    """
+    Imports h5py (an optional dependency).
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError( "Matrix stores require h5py. Install it using `pip install h5py`." )
+    return h5py
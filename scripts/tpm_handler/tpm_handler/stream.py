@@ -0,0 +1,354 @@
+"""
+Defines functions for converting raw counts to TPM (or other normalisations) chunk-wise, without ever loading
+the entire countTable into memory.
+
+The conversion is done in two passes over the countTable. The first pass accumulates the column sums of
+the (length-normalised) counts of each sample, and the second pass converts the counts chunk by chunk
+and writes them directly to the output file. Hence, memory usage is bounded by the chunk size rather than
+by the size of the countTable. Both passes are pipelined (see `pipeline`), so that reading, converting
+and writing the chunks overlap.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from .core import logger, index_name, _is_mtx
+from .engines import get_engine
+from .geneindex import gene_index
+from .aggregate import RowAccumulator
+from .pipeline import Timings, Writer, background
+from .writer import format_rows, format_header, choose_precision
+from .columnar import columnar_format
+from .reader import probe_table
+from .compression import open_file
+from .sidecar import Sidecar, lengths_fingerprint
+
+
+def read_chunks( filename : str, chunksize : int = 10000, sep : str = "\t", samples : list = None, filters = None, **kwargs ):
+    """
+    Reads a countTable in chunks of rows.
+
+    Parameters
+    ----------
+    filename : str
+        The input count table. Parquet and Feather files are read by row batches.
+    chunksize : int, optional
+        The number of rows per chunk. The default is 10000.
+    sep : str, optional
+        The separator of the table. The default is "\t".
+    samples : list, optional
+        Only read these samples (columns). By default all samples are read.
+    filters : Filters, optional
+        Filters for the genes of each chunk (see `Filters.filter_chunk`).
+        The samples to keep must be selected beforehand (see `Filters.samples`).
+
+    Yields
+    ------
+    chunk : pandas.DataFrame
+        The next chunk of rows.
+    """
+    chunks = _read_chunks( filename, chunksize, sep, samples, **kwargs )
+    if filters is None or not filters.active:
+        yield from chunks
+        return
+    for chunk in chunks:
+        yield filters.filter_chunk( chunk )
+
+def _read_chunks( filename : str, chunksize : int, sep : str, samples : list = None, **kwargs ):
+    """
+    Reads a countTable in chunks of rows (see `read_chunks`).
+    """
+    if _is_mtx( filename ):
+        raise ValueError( f"{filename} is a MatrixMarket file, which can not be read in chunks of rows (use a `Table` instead)." )
+    fmt = columnar_format( filename )
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        source = pq.ParquetFile( filename )
+        columns = [ source.schema_arrow.names[0] ] + list( samples ) if samples is not None else None
+        for batch in source.iter_batches( batch_size = chunksize, columns = columns ):
+            chunk = batch.to_pandas()
+            yield chunk.set_index( chunk.columns[0] )
+        return
+    elif fmt == "feather":
+        import pyarrow as pa
+        import pyarrow.ipc as ipc
+        with pa.memory_map( filename, "r" ) as source:
+            reader = ipc.open_file( source )
+            for i in range( reader.num_record_batches ):
+                batch = reader.get_batch( i )
+                if samples is not None:
+                    batch = batch.select( [ reader.schema.names[0] ] + list( samples ) )
+                for start in range( 0, batch.num_rows, chunksize ):
+                    chunk = batch.slice( start, chunksize ).to_pandas()
+                    yield chunk.set_index( chunk.columns[0] )
+        return
+
+    # skip leading comment lines and declare the dtypes up front
+    probe = probe_table( filename, sep, count_rows = False )
+    kwargs[ "index_col" ] = kwargs.get( "index_col", 0 )
+    kwargs[ "dtype" ] = kwargs.get( "dtype", { probe[ "index_name" ] : str, **{ i : np.float64 for i in probe[ "samples" ] } } )
+    if samples is not None:
+        # the excluded samples are not parsed at all
+        kwargs[ "usecols" ] = [ probe[ "index_name" ] ] + list( samples )
+    reader = pd.read_csv(
+                            filename,
+                            sep = sep,
+                            skiprows = probe[ "skiprows" ],
+                            chunksize = chunksize,
+                            **kwargs
+                        )
+    with reader:
+        for chunk in reader:
+            yield chunk if samples is None else chunk.loc[ :,samples ]
+
+def align_chunk( chunk : pd.DataFrame, lengths : pd.DataFrame ):
+    """
+    Restricts a chunk of counts to the features for which lengths are available.
+
+    Parameters
+    ----------
+    chunk : pd.DataFrame
+        The chunk of counts.
+    lengths : pd.DataFrame
+        The lengths of the features (the IDs as index, names and lengths as columns).
+
+    Returns
+    -------
+    chunk : pd.DataFrame
+        The restricted chunk of counts.
+    lengths : pd.DataFrame
+        The lengths of the features in the chunk (in the same order).
+    """
+    idx = gene_index( lengths ).join( chunk.index, report = False )
+    mask = idx >= 0
+    return chunk.iloc[ mask,: ], lengths.iloc[ idx[mask],: ]
+
+def tpm_factors( filename : str, lengths : pd.DataFrame, chunksize : int = 10000, sep : str = "\t", **kwargs ) -> tuple:
+    """
+    Computes the TPM scaling factors of each sample (column) in a countTable
+    by reading it chunk-wise (first pass).
+
+    Parameters
+    ----------
+    filename : str
+        The input count table.
+    lengths : pd.DataFrame
+        The lengths of the features (the IDs as index, names and lengths as columns).
+    chunksize : int, optional
+        The number of rows per chunk. The default is 10000.
+    sep : str, optional
+        The separator of the table. The default is "\t".
+
+    Returns
+    -------
+    factors : np.ndarray
+        The column sums of the length-normalised counts of each sample.
+    rows : int
+        The number of rows (features) that have a corresponding length.
+    """
+    factors, rows = stream_factors( filename, lengths, [ "tpm" ], chunksize, sep, **kwargs )
+    return factors[ "rates" ], rows
+
+def stream_factors( filename : str, lengths : pd.DataFrame, methods : list, chunksize : int = 10000, sep : str = "\t", timings : Timings = None, queue_size : int = 4, **kwargs ) -> tuple:
+    """
+    Computes the scaling factors of each sample (column) in a countTable required
+    by one or more normalisation methods by reading it chunk-wise (first pass).
+
+    Parameters
+    ----------
+    filename : str
+        The input count table.
+    lengths : pd.DataFrame
+        The lengths of the features (the IDs as index, names and lengths as columns).
+    methods : list
+        The normalisation methods (engines). Methods that require the same kind of factors share them.
+    chunksize : int, optional
+        The number of rows per chunk. The default is 10000.
+    sep : str, optional
+        The separator of the table. The default is "\t".
+    timings : Timings, optional
+        Record the time spent reading and computing.
+    queue_size : int, optional
+        The number of chunks that are read ahead (in a background thread). The default is 4.
+
+    Returns
+    -------
+    factors : dict
+        The scaling factors of each sample for each kind of factors (see `Engine.factor_kind`).
+    rows : int
+        The number of rows (features) that have a corresponding length.
+    """
+    engines = { engine.factor_kind : engine for engine in ( get_engine( i ) for i in methods ) }
+    factors = dict.fromkeys( engines )
+    timings = timings if timings is not None else Timings()
+    rows = total = 0
+    for chunk in background( read_chunks( filename, chunksize, sep, **kwargs ), queue_size, timings, "read (first pass)" ):
+        start = time.perf_counter()
+        total += len( chunk )
+        chunk, chunk_lengths = align_chunk( chunk, lengths )
+        array = chunk.to_numpy( dtype = float )
+        chunk_lengths = chunk_lengths.iloc[ :,-1 ].to_numpy( dtype = float )
+        for kind, engine in engines.items():
+            sums = engine.factors( array, chunk_lengths )
+            factors[ kind ] = sums if factors[ kind ] is None else factors[ kind ] + sums
+        rows += len( chunk )
+        timings.add( "compute (first pass)", time.perf_counter() - start )
+
+    logger.info( f"Matched {rows} of {total} genes ({rows / max( total, 1 ):.1%}) to the lengths." )
+    if not rows:
+        raise ValueError( f"No features in {filename} have a corresponding length!" )
+    logger.debug( f"Computed scaling factors on {rows} rows." )
+    return factors, rows
+
+def normalise_stream( filename : str, lengths : pd.DataFrame, outfile, digits : int = 5, chunksize : int = 10000, use_names : bool = False, max_bytes : int = None, sep : str = "\t", method = "tpm", aggregate : str = None, queue_size : int = 4, sidecar : bool = False, filters = None, **kwargs ) -> Timings:
+    """
+    Normalises a countTable chunk-wise and writes the normalised values directly to a file.
+
+    Each pass runs as a pipeline: chunks are read by a reader thread and written by a writer thread,
+    while the calling thread converts (and formats) them. The stages are joined by bounded queues.
+
+    Parameters
+    ----------
+    filename : str
+        The input count table.
+    lengths : pd.DataFrame
+        The lengths of the features (the IDs as index, names and lengths as columns).
+        As returned by `read_lengths`.
+    outfile : str or list
+        The output file. If multiple methods are given, one output file per method.
+    digits : int, optional
+        The number of digits to round to. The default is 5.
+        If None, the values are written as they are.
+    chunksize : int, optional
+        The number of rows per chunk. The default is 10000.
+    use_names : bool, optional
+        Save the file with gene_names instead of gene_ids in the first column.
+    max_bytes : int, optional
+        A size limit for the output file(s). If provided, the highest precision (up to `digits`)
+        at which the file is estimated to stay within the limit is used (based on the first chunk).
+    sep : str, optional
+        The separator of the table. The default is "\t".
+    method : str or list, optional
+        The normalisation method(s) to use. The default is "tpm".
+        Multiple methods are computed from the same two passes over the countTable.
+    aggregate : str, optional
+        If `use_names`, aggregate the rows of features that share the same name (`sum`, `max` or `mean`).
+        The aggregated rows of duplicated names are written after all other rows.
+        By default duplicate names are kept as separate rows.
+    queue_size : int, optional
+        The number of chunks that are held between the stages of the pipeline. The default is 4.
+    sidecar : bool, optional
+        Also save the scaling factors, gene order and lengths fingerprint of each output file 
+        in a sidecar file (`<outfile>.factors.npz`, see `sidecar`).
+    filters : Filters, optional
+        Filters for genes and samples that are applied to each chunk before it is normalised.
+        Filtering samples by their number of detected genes requires an additional pass over the countTable.
+
+    Returns
+    -------
+    Timings
+        The time spent in each stage (reading, computing and writing) of both passes.
+    """
+    methods = [ method ] if isinstance( method, str ) else list( method )
+    outfiles = [ outfile ] if isinstance( outfile, str ) else list( outfile )
+    if len( methods ) != len( outfiles ):
+        raise ValueError( f"Got {len( methods )} methods but {len( outfiles )} output files." )
+    engines = [ get_engine( i ) for i in methods ]
+
+    timings = Timings()
+    if filters is not None and filters.active:
+        if filters.min_detected is not None:
+            logger.info( "Selecting samples by their detected genes..." )
+            kwargs[ "samples" ] = list( filters.samples( read_chunks( filename, chunksize, sep, **kwargs ) ) )
+        kwargs[ "filters" ] = filters
+
+    logger.info( "Computing scaling factors (first pass)..." )
+    factors, rows = stream_factors( filename, lengths, engines, chunksize, sep, timings = timings, queue_size = queue_size, **kwargs )
+
+    logger.info( f"Normalising to {', '.join( i.name for i in engines )} (second pass)..." )
+    precision = [ digits ] * len( engines )
+    accumulators = [ None ] * len( engines )
+    layout = [] if sidecar else None
+    files = [ open_file( i, "w" ) for i in outfiles ]
+    try:
+        with Writer( queue_size, timings ) as writer:
+            samples = _normalise_chunks( 
+                                background( read_chunks( filename, chunksize, sep, **kwargs ), queue_size, timings ), 
+                                writer, files, engines, factors, lengths, rows, 
+                                precision, accumulators, digits, use_names, aggregate, max_bytes, sep, timings, layout 
+                            )
+    finally:
+        for f in files:
+            f.close()
+
+    if sidecar and samples is not None:
+        genes = [ index for index, _ in layout ]
+        genes = genes[0].append( genes[1:] ) if genes else pd.Index( [] )
+        aggregated = use_names and aggregate is not None
+        row_lengths = np.concatenate( [ i for _, i in layout ] ) if layout and not aggregated else None
+        fingerprint = lengths_fingerprint( lengths )
+        for engine, i, places in zip( engines, outfiles, precision ):
+            Sidecar( engine.name, factors[ engine.factor_kind ], samples, genes, row_lengths, fingerprint, places ).write( i )
+
+    for i in outfiles:
+        logger.info( f"Saved to file: {i}" )
+    logger.info( f"Stage timings: {timings}" )
+    return timings
+
+def _normalise_chunks( chunks, writer : Writer, files : list, engines : list, factors : dict, lengths : pd.DataFrame, rows : int, precision : list, accumulators : list, digits : int, use_names : bool, aggregate : str, max_bytes : int, sep : str, timings : Timings, layout : list = None ):
+    """
+    The compute stage of the second pass of `normalise_stream`.
+    Converts and formats each chunk and passes the text on to the writer.
+    If a `layout` list is given, the index and lengths of the written rows are collected in it.
+    Returns the samples (columns).
+    """
+    columns = None
+    for chunk in chunks:
+        start = time.perf_counter()
+        chunk, chunk_lengths = align_chunk( chunk, lengths )
+        if use_names:
+            # features without a name keep their ID
+            names = chunk_lengths.iloc[ :,0 ]
+            index = pd.Index( names.where( names.notna(), chunk.index.to_numpy() ), name = chunk.index.name )
+        else:
+            index = chunk.index
+        array = chunk.to_numpy( dtype = float )
+        chunk_lengths = chunk_lengths.iloc[ :,-1 ].to_numpy()
+
+        for i, ( engine, f ) in enumerate( zip( engines, files ) ):
+            values = engine.apply( array, chunk_lengths, factors = factors[ engine.factor_kind ] )
+
+            if columns is None:
+                if use_names and aggregate is not None:
+                    accumulators[i] = RowAccumulator( lengths.iloc[ :,0 ].dropna(), len( chunk.columns ), aggregate )
+                if max_bytes is not None:
+                    precision[i] = choose_precision( values, index, max_bytes, rows = rows, columns = chunk.columns, max_digits = digits if digits is not None else 5, sep = sep )
+                writer.write( f, format_header( index_name( chunk, lengths ), chunk.columns, sep ) )
+
+            rows_index = index
+            if accumulators[i] is not None:
+                values, rows_index = accumulators[i].add( values, index )
+            writer.write( f, _format_rows( values, rows_index, chunk.columns, precision[i], sep ) )
+            if layout is not None and i == 0:
+                layout.append( ( rows_index, chunk_lengths ) )
+        columns = chunk.columns
+        timings.add( "compute", time.perf_counter() - start )
+
+    for i, ( f, accumulator, places ) in enumerate( zip( files, accumulators, precision ) ):
+        if accumulator is not None:
+            values, index = accumulator.result()
+            writer.write( f, _format_rows( values, index, columns, places, sep ) )
+            if layout is not None and i == 0:
+                layout.append( ( index, None ) )
+    return columns
+
+def _format_rows( values : np.ndarray, index, columns, digits : int = None, sep : str = "\t" ) -> str:
+    """
+    Formats rows of values (at a fixed precision, unless `digits` is None).
+    """
+    if digits is None:
+        values = pd.DataFrame( values, columns = columns, index = index )
+        return values.to_csv( None, sep = sep, header = False )
+    return format_rows( values, index, digits, sep )
@@ -0,0 +1,199 @@
+"""
+Defines a fast writer for (normalised) expression matrices.
+
+Instead of rounding the values first and then writing their full representation, the values are directly
+formatted at a fixed precision (which rounds them in the process). The rows are formatted in large chunks
+using a single format call per chunk, optionally spread across multiple processes. Zeros are written as `0`
+which considerably reduces the size of sparse (e.g. single-cell) matrices.
+"""
+
+import itertools
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .compression import open_file
+
+logger = logging.getLogger( "tpm_handler" )
+
+
+def format_rows( array : np.ndarray, index, digits : int = 5, sep : str = "\t" ) -> str:
+    """
+    Formats rows of a matrix as text at a fixed precision.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The rows to format. As a 2D ndarray (or a sparse matrix).
+    index : list
+        The row names (one per row).
+    digits : int, optional
+        The number of digits to round to. The default is 5.
+    sep : str, optional
+        The separator to use. The default is "\t".
+
+    Returns
+    -------
+    str
+        The formatted rows (each terminated by a newline).
+    """
+    if hasattr( array, "toarray" ):
+        array = array.toarray()
+    if not len( array ):
+        return ""
+
+    value = f"{sep}%.{digits}f"
+    fmt = ( "%s" + value * array.shape[1] + "\n" ) * array.shape[0]
+    values = itertools.chain.from_iterable( [ name ] + row for name, row in zip( index, array.tolist() ) )
+    text = fmt % tuple( values )
+
+    # since all values have the same precision, an exact zero
+    # can only ever be formatted as this one token
+    zero = value % 0.0
+    text = text.replace( zero + sep, sep + "0" + sep ).replace( zero + sep, sep + "0" + sep ).replace( zero + "\n", sep + "0\n" )
+    if np.isnan( array ).any():
+        nan = value % np.nan
+        text = text.replace( nan + sep, sep + sep ).replace( nan + sep, sep + sep ).replace( nan + "\n", sep + "\n" )
+    return text
+
+def format_header( index_name : str, columns, sep : str = "\t" ) -> str:
+    """
+    Formats the header line of a matrix.
+
+    Parameters
+    ----------
+    index_name : str
+        The name of the index column.
+    columns : list
+        The column names.
+    sep : str, optional
+        The separator to use. The default is "\t".
+
+    Returns
+    -------
+    str
+        The header line.
+    """
+    index_name = "" if index_name is None else str( index_name )
+    return sep.join( [ index_name ] + [ str( i ) for i in columns ] ) + "\n"
+
+def iter_formatted( array, index, digits : int = 5, chunksize : int = 10000, workers : int = 1, sep : str = "\t" ):
+    """
+    Formats the rows of a matrix chunk by chunk.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The matrix. As a 2D ndarray (or a sparse matrix).
+    index : list
+        The row names.
+    digits : int, optional
+        The number of digits to round to. The default is 5.
+    chunksize : int, optional
+        The number of rows to format at once. The default is 10000.
+    workers : int, optional
+        The number of processes to format chunks in parallel. The default is 1.
+    sep : str, optional
+        The separator to use. The default is "\t".
+
+    Yields
+    ------
+    str
+        The formatted chunks (in order).
+    """
+    index = list( index )
+    chunks = ( ( array[ start:start + chunksize ], index[ start:start + chunksize ], digits, sep ) for start in range( 0, array.shape[0], chunksize ) )
+
+    if workers <= 1:
+        for chunk in chunks:
+            yield format_rows( *chunk )
+        return
+
+    # only keep a few chunks in flight at a time so that
+    # the matrix is never copied to the workers as a whole
+    with ProcessPoolExecutor( max_workers = workers ) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append( pool.submit( format_rows, *chunk ) )
+            if len( pending ) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def write_table( filename : str, array, index, columns, index_name : str = None, digits : int = 5, chunksize : int = 10000, workers : int = 1, sep : str = "\t" ):
+    """
+    Writes a matrix to a file at a fixed precision.
+
+    Parameters
+    ----------
+    filename : str
+        The output file.
+    array : np.ndarray
+        The matrix. As a 2D ndarray (or a sparse matrix).
+    index : list
+        The row names.
+    columns : list
+        The column names.
+    index_name : str, optional
+        The name of the index column.
+    digits : int, optional
+        The number of digits to round to. The default is 5.
+    chunksize : int, optional
+        The number of rows to format at once. The default is 10000.
+    workers : int, optional
+        The number of processes to format chunks in parallel. The default is 1.
+    sep : str, optional
+        The separator to use. The default is "\t".
+    """
+    with open_file( filename, "w", workers = max( workers, 1 ) ) as f:
+        f.write( format_header( index_name, columns, sep ) )
+        for text in iter_formatted( array, index, digits, chunksize, workers, sep ):
+            f.write( text )
+
+def choose_precision( array, index, max_bytes : int, rows : int = None, columns = None, max_digits : int = 5, sample_rows : int = 1000, sep : str = "\t" ) -> int:
+    """
+    Chooses the highest precision at which a matrix can be written without exceeding a size limit.
+    The size of the output is estimated from a sample of rows.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The matrix (or a representative subset of rows). As a 2D ndarray (or a sparse matrix).
+    index : list
+        The row names.
+    max_bytes : int
+        The maximum size of the output in bytes.
+    rows : int, optional
+        The total number of rows that will be written. By default the number of rows of `array`.
+    columns : list, optional
+        The column names (to account for the header).
+    max_digits : int, optional
+        The highest precision to consider. The default is 5.
+    sample_rows : int, optional
+        The number of rows to sample for the estimate. The default is 1000.
+    sep : str, optional
+        The separator to use. The default is "\t".
+
+    Returns
+    -------
+    int
+        The number of digits to round to.
+    """
+    rows = rows if rows is not None else array.shape[0]
+    header = len( format_header( None, columns if columns is not None else [], sep ).encode() )
+
+    sample = np.unique( np.linspace( 0, array.shape[0] - 1, min( sample_rows, array.shape[0] ) ).astype( int ) )
+    index = np.asarray( index, dtype = object )[ sample ]
+    array = array[ sample ]
+
+    for digits in range( max_digits, -1, -1 ):
+        size = len( format_rows( array, index, digits, sep ).encode() )
+        size = header + size * rows / max( len( sample ), 1 )
+        if size <= max_bytes:
+            logger.info( f"Writing values with {digits} digits (estimated size: {size / 1024**2:.1f} MB)" )
+            return digits
+
+    logger.warning( f"The output will likely exceed {max_bytes / 1024**2:.1f} MB even without any decimals!" )
+    return 0